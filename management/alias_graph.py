@@ -0,0 +1,127 @@
+#!/usr/local/lib/mailinabox/env/bin/python
+#
+# Resolves mail aliases the way Postfix does with the lookup tables that
+# setup/mail-users.sh configures, from an index of the users and aliases
+# built once (see mailconfig.get_alias_graph), rather than by going through
+# all of the aliases for each address.
+#
+# An address is looked up as is, then without its +tag, then as a catch-all
+# or domain alias (@domain). A domain alias to "@otherdomain" keeps the local
+# part of the address. Forwarding is followed until it ends at a user's
+# mailbox or an address that isn't ours, or goes around in a loop.
+
+RECIPIENT_DELIMITER = "+"
+
+
+def lookup_keys(address):
+	# The keys an address is looked up by, in order.
+	keys = [address]
+	if "@" not in address:
+		return keys
+	localpart, domain = address.rsplit("@", 1)
+	if RECIPIENT_DELIMITER in localpart:
+		keys.append(localpart.split(RECIPIENT_DELIMITER, 1)[0] + "@" + domain)
+	keys.append("@" + domain)
+	return keys
+
+
+def split_addresses(value):
+	return tuple(address.strip() for address in (value or "").split(",") if address.strip() != "")
+
+
+class AliasGraph:
+
+	def __init__(self, users, aliases):
+		# users is a list of the user accounts, aliases is a list of tuples of
+		# (address, forwards-tos, permitted-senders, auto) as get_mail_aliases returns.
+		self.users = set(users)
+
+		# Where mail to an address goes, as virtual-alias-maps.cf: an alias (with
+		# forwards) first, then a user (to itself), then an automatic alias.
+		self.forwards = {}
+		for address, forwards_to, _, auto in aliases:
+			if auto and forwards_to:
+				self.forwards[address] = split_addresses(forwards_to)
+		for user in self.users:
+			self.forwards[user] = (user, )
+		for address, forwards_to, _, auto in aliases:
+			if not auto and forwards_to:
+				self.forwards[address] = split_addresses(forwards_to)
+
+		# Who may send as an address, as sender-login-maps.cf: the permitted senders
+		# of an alias, or its forwards if it has none, then a user itself.
+		self.senders = {user: (user, ) for user in self.users}
+		for address, forwards_to, permitted_senders, auto in aliases:
+			if not auto:
+				self.senders[address] = split_addresses(
+					permitted_senders if permitted_senders is not None else forwards_to)
+
+	def lookup(self, address):
+		# Returns the addresses that mail to address is forwarded to by the first
+		# matching entry, or None if there isn't one.
+		for key in lookup_keys(address):
+			forwards = self.forwards.get(key)
+			if forwards is not None:
+				if key.startswith("@"):
+					localpart = address.rsplit("@", 1)[0]
+					forwards = tuple(localpart + f if f.startswith("@") else f for f in forwards)
+				return forwards
+		return None
+
+	def receivers(self, address):
+		# Follows the forwards from address. Returns the final recipients: the
+		# mailboxes of users and addresses elsewhere, and the addresses at which
+		# forwarding went around in a loop. Each address is looked up once.
+		receivers = set()
+		loops = set()
+		expanding = set()  # on the current path
+		expanded = set()
+		stack = [(address, None)]
+		while stack:
+			address, forwards = stack.pop()
+			if forwards is None:
+				# First visit.
+				if address in expanding:
+					loops.add(address)
+					continue
+				if address in expanded:
+					continue
+				forwards = self.lookup(address)
+				if forwards is None or forwards == (address, ):
+					# Not ours, or a user's mailbox.
+					receivers.add(address)
+					expanded.add(address)
+					continue
+				expanding.add(address)
+				forwards = iter(forwards)
+			forward = next(forwards, None)
+			if forward is None:
+				# All of its forwards are done.
+				expanding.discard(address)
+				expanded.add(address)
+				continue
+			stack.append((address, forwards))
+			if forward == address:
+				receivers.add(address)
+			else:
+				stack.append((forward, None))
+		return receivers, loops
+
+	def permitted_senders(self, address):
+		# Returns the logins that may send mail as address.
+		for key in lookup_keys(address):
+			senders = self.senders.get(key)
+			if senders is not None:
+				return senders
+		return ()
+
+	def resolve(self, address):
+		receivers, loops = self.receivers(address)
+		return {
+			"address": address,
+			"forwards_to": list(self.lookup(address) or []),
+			"receivers": sorted(receivers),
+			"mailboxes": sorted(receivers & self.users),
+			"loops": sorted(loops),
+			"permitted_senders": list(self.permitted_senders(address)),
+		}
@@ -8,7 +8,7 @@ from datetime import timedelta
 
 from expiringdict import ExpiringDict
 
-import utils
+from passwords import check_password
 from mailconfig import get_mail_password, get_mail_user_privileges
 from mfa import get_hash_mfa_state, validate_auth_mfa
 
@@ -120,17 +120,8 @@ class AuthService:
 			# if an email address is valid.
 			pw_hash = get_mail_password(email, env)
 
-			# Use 'doveadm pw' to check credentials. doveadm will return
-			# a non-zero exit status if the credentials are no good,
-			# and check_call will raise an exception in that case.
-			utils.shell('check_call', [
-				"/usr/bin/doveadm",
-				"pw",
-				"-p",
-				pw,
-				"-t",
-				pw_hash,
-			])
+			if not check_password(pw, pw_hash):
+				raise ValueError()
 		except:
 			# Login failed.
 			raise ValueError("Incorrect email address or password.")
@@ -77,6 +77,7 @@ if len(sys.argv) < 2:
 {cli} system default-quota [new default]       (set default quota for system)
 {cli} user                                     (lists users)
 {cli} user add user@domain.com [password]
+{cli} user import users.csv                    (adds users from CSV: email,password[,privileges[,quota]])
 {cli} user password user@domain.com [password]
 {cli} user remove user@domain.com
 {cli} user make-admin user@domain.com
@@ -89,6 +90,7 @@ if len(sys.argv) < 2:
 {cli} alias add incoming.name@domain.com sent.to@other.domain.com
 {cli} alias add incoming.name@domain.com 'sent.to@other.domain.com, multiple.people@other.domain.com'
 {cli} alias remove incoming.name@domain.com
+{cli} alias import aliases.csv                 (adds aliases from CSV: address,forwards_to[,permitted_senders])
 
 Removing a mail user does not delete their mail folders on disk. It only prevents IMAP/SMTP login.
 """.format(cli="management/cli.py"))
@@ -124,6 +126,26 @@ elif sys.argv[1] == "user" and sys.argv[2] in ("add", "password"):
 	elif sys.argv[2] == "password":
 		print(mgmt("/mail/users/password", {"email": email, "password": pw}))
 
+elif sys.argv[1] in ("user", "alias") and len(sys.argv) == 4 and sys.argv[2] == "import":
+	# Add users or aliases from a CSV file ("-" for stdin) in one request, so that
+	# the system is only updated once.
+	if sys.argv[3] == "-":
+		rows = sys.stdin.read()
+	else:
+		with open(sys.argv[3]) as f:
+			rows = f.read()
+	if sys.argv[1] == "user":
+		resp = mgmt("/mail/users/bulk", {"csv": rows}, is_json=True)
+	else:
+		resp = mgmt("/mail/aliases/bulk", {"csv": rows}, is_json=True)
+	failed = False
+	for row in resp["results"]:
+		print(row.get("email", row.get("address")), row["result"], row.get("message", ""))
+		failed = failed or row["result"] == "error"
+	print(resp["output"], end='')
+	if failed:
+		sys.exit(1)
+
 elif sys.argv[1] == "user" and sys.argv[2] == "remove" and len(sys.argv) == 4:
 	print(mgmt("/mail/users/remove", {"email": sys.argv[3]}))
 
@@ -13,8 +13,12 @@
 import os
 import os.path
 import re
+import csv
+import hashlib
+import io
 import json
 import time
+import threading
 import multiprocessing.pool
 import subprocess
 
@@ -23,17 +27,32 @@ from functools import wraps
 from flask import Flask, request, render_template, abort, Response, send_from_directory, make_response
 
 import auth
+import database
+import reconfigure
 import utils
-from mailconfig import get_mail_users, get_mail_users_ex, get_admins, add_mail_user, set_mail_password, remove_mail_user
-from mailconfig import get_mail_user_privileges, add_remove_mail_user_privilege, open_database
-from mailconfig import get_mail_aliases, get_mail_aliases_ex, get_mail_domains, add_mail_alias, remove_mail_alias
-from mailconfig import get_mail_quota, set_mail_quota, get_default_quota, validate_quota
+from mailconfig import get_mail_users, get_mail_users_page, get_mail_users_by_domain, sort_mail_users_by_domain, get_mailbox_usage_generation, get_admins, add_mail_user, add_mail_users, set_mail_password, remove_mail_user
+from mailconfig import get_mail_user_privileges, add_remove_mail_user_privilege
+from mailconfig import get_mail_aliases, get_mail_aliases_page, get_mail_aliases_by_domain, sort_mail_aliases_by_domain, get_mail_domains, add_mail_alias, add_mail_aliases, remove_mail_alias
+from mailconfig import get_alias_graph, sanitize_idn_email_address
+from mailconfig import get_mail_quota, set_mail_quota, set_mail_quotas, get_default_quota, validate_quota
 from mfa import get_public_mfa_state, provision_totp, validate_totp_secret, enable_mfa, disable_mfa
 
 env = utils.load_environment()
 
 auth_service = auth.AuthService()
 
+# Apply configuration changes in the background, see reconfigure.py
+reconfigure.start(env)
+
+# Mail log reports by time span as (time built, report), see /system/mail-stats. They are built in
+# background threads, one at a time since they share the index of the mail log, and rebuilt when
+# they are older than MAIL_STATS_MAX_AGE seconds.
+MAIL_STATS_MAX_AGE = 300
+mail_stats = {}
+mail_stats_building = set()  # the time spans being built
+mail_stats_lock = threading.Lock()  # guards the two above
+mail_stats_build_lock = threading.Lock()
+
 # We may deploy via a symbolic link, which confuses flask's template finding.
 me = __file__
 try:
@@ -133,6 +152,59 @@ def json_response(data, status=200):
 					mimetype='application/json')
 
 
+def bulk_rows(fields):
+	# The rows of a bulk request as dicts. The request is either a JSON list of
+	# objects, or CSV in the request body or in the 'csv' form field. The CSV
+	# may start with a header row, otherwise its columns are the given fields.
+	if request.is_json:
+		rows = request.get_json(silent=True)
+		if not isinstance(rows, list) or not all(isinstance(row, dict) for row in rows):
+			raise ValueError("The request must be a list of objects.")
+		return rows
+
+	text = request.form['csv'] if 'csv' in request.form else request.get_data(as_text=True)
+	rows = [row for row in csv.reader(io.StringIO(text)) if row]
+	if rows and fields[0] in (column.strip() for column in rows[0]):
+		fields = [column.strip() for column in rows.pop(0)]
+	return [dict(zip(fields, row)) for row in rows]
+
+
+def listing_page():
+	# The filters and the page of a listing of addresses, from the query string:
+	# ?domain= (the addresses in a domain), ?q= (the addresses that start with it),
+	# ?limit= (the number of addresses per page) and ?cursor= (the next_cursor
+	# of the previous page).
+	page = {"domain": None, "prefix": None, "after": None, "limit": None}
+	if request.args.get("domain", "").strip():
+		page["domain"] = sanitize_idn_email_address("@" + request.args["domain"].strip().lower())[1:]
+	if request.args.get("q", "").strip():
+		page["prefix"] = request.args["q"].strip().lower()
+	if request.args.get("cursor", ""):
+		page["after"] = request.args["cursor"]
+	if request.args.get("limit", ""):
+		try:
+			page["limit"] = int(request.args["limit"])
+		except ValueError:
+			page["limit"] = 0
+		if page["limit"] < 1:
+			raise ValueError("Invalid limit.")
+	return page
+
+
+def cached_json_response(version, build):
+	# Answers with 304 Not Modified if the client has the response for this
+	# version already (If-None-Match), otherwise with the JSON that build returns.
+	# Either way the version goes in the ETag, so it can be asked for next time.
+	etag = hashlib.sha1(repr((request.full_path, version)).encode("utf8")).hexdigest()
+	if request.if_none_match.contains(etag):
+		response = Response(status=304)
+	else:
+		response = json_response(build())
+	response.set_etag(etag)
+	response.headers["Cache-Control"] = "private, no-cache"
+	return response
+
+
 ###################################
 
 # Control Panel (unauthenticated views)
@@ -215,7 +287,22 @@ def logout():
 @authorized_personnel_only()
 def mail_users():
 	if request.args.get("format", "") == "json":
-		return json_response(get_mail_users_ex(env, with_archived=True))
+		try:
+			page = listing_page()
+		except ValueError as e:
+			return (str(e), 400)
+
+		def build():
+			accounts, more = get_mail_users_page(env, with_archived=True, **page)
+			domains = get_mail_users_by_domain(accounts, env)
+			if page["limit"] is None:
+				return sort_mail_users_by_domain(domains, env)
+			return {"domains": domains, "next_cursor": accounts[-1][0] if more else None}
+
+		# The users only change with the database and the usage of their mailboxes
+		# with the generation, so neither is read when the client has them already.
+		return cached_json_response(
+			(database.change_counter(env), get_mailbox_usage_generation()), build)
 	else:
 		return "".join(x + "\n" for x in get_mail_users(env))
 
@@ -232,6 +319,21 @@ def mail_users_add():
 		return (str(e), 400)
 
 
+@app.route('/mail/users/bulk', methods=['POST'])
+@authorized_personnel_only()
+def mail_users_bulk():
+	try:
+		rows = bulk_rows(["email", "password", "privileges", "quota"])
+	except ValueError as e:
+		return (str(e), 400)
+	for row in rows:
+		if isinstance(row.get("privileges"), str):
+			# privileges are separated by spaces in CSV
+			row["privileges"] = row["privileges"].split()
+	results, output = add_mail_users(rows, env)
+	return json_response({"results": results, "output": output})
+
+
 @app.route('/mail/users/quota', methods=['GET'])
 @authorized_personnel_only()
 def get_mail_users_quota():
@@ -254,6 +356,21 @@ def mail_users_quota():
 		return (str(e), 400)
 
 
+@app.route('/mail/users/quota/bulk', methods=['POST'])
+@authorized_personnel_only()
+def mail_users_quota_bulk():
+	if 'emails' in request.form:
+		# the same quota for all of the users, separated by commas or whitespace
+		rows = [{"email": email, "quota": request.form.get('quota')}
+				for email in re.split(r"[\s,]+", request.form['emails']) if email]
+	else:
+		try:
+			rows = bulk_rows(["email", "quota"])
+		except ValueError as e:
+			return (str(e), 400)
+	return json_response({"results": set_mail_quotas(rows, env)})
+
+
 @app.route('/mail/users/password', methods=['POST'])
 @authorized_personnel_only(admin = False)
 def mail_users_password():
@@ -304,13 +421,37 @@ def mail_user_privs_remove():
 @authorized_personnel_only()
 def mail_aliases():
 	if request.args.get("format", "") == "json":
-		return json_response(get_mail_aliases_ex(env))
+		try:
+			page = listing_page()
+		except ValueError as e:
+			return (str(e), 400)
+
+		def build():
+			aliases, more = get_mail_aliases_page(env, **page)
+			domains = get_mail_aliases_by_domain(aliases)
+			if page["limit"] is None:
+				return sort_mail_aliases_by_domain(domains, env)
+			return {"domains": domains, "next_cursor": aliases[-1][0] if more else None}
+
+		# The aliases only change with the database, so they aren't read at all
+		# when the client has them already.
+		return cached_json_response(database.change_counter(env), build)
 	else:
 		return "".join(
 			address + "\t" + receivers + "\t" + (senders or "") + "\n"
 			for address, receivers, senders, auto in get_mail_aliases(env))
 
 
+@app.route('/mail/aliases/resolve')
+@authorized_personnel_only()
+def mail_aliases_resolve():
+	address = request.args.get('address', '').strip()
+	if address == '':
+		return ("No email address provided.", 400)
+	address = sanitize_idn_email_address(address).lower()
+	return json_response(get_alias_graph(env).resolve(address))
+
+
 @app.route('/mail/aliases/add', methods=['POST'])
 @authorized_personnel_only()
 def mail_aliases_add():
@@ -322,6 +463,20 @@ def mail_aliases_add():
 							'update_if_exists', '') == '1'))
 
 
+@app.route('/mail/aliases/bulk', methods=['POST'])
+@authorized_personnel_only()
+def mail_aliases_bulk():
+	try:
+		rows = bulk_rows(["address", "forwards_to", "permitted_senders"])
+	except ValueError as e:
+		return (str(e), 400)
+	results, output = add_mail_aliases(
+		rows,
+		env,
+		update_if_exists=(request.values.get('update_if_exists', '') == '1'))
+	return json_response({"results": results, "output": output})
+
+
 @app.route('/mail/aliases/remove', methods=['POST'])
 @authorized_personnel_only()
 def mail_aliases_remove():
@@ -348,8 +503,13 @@ def dns_zones():
 @authorized_personnel_only()
 def dns_update():
 	from dns_update import do_dns_update
+	# Only the zones of the given domains are rebuilt, if domains are given.
+	domains = request.form.get('domains')
+	if domains is not None:
+		domains = [domain.strip() for domain in domains.split(",") if domain.strip()]
 	try:
-		return do_dns_update(env, force=request.form.get('force', '') == '1')
+		with reconfigure.lock:
+			return do_dns_update(env, force=request.form.get('force', '') == '1', domains=domains)
 	except Exception as e:
 		return (str(e), 500)
 
@@ -369,11 +529,12 @@ def dns_get_secondary_nameserver():
 def dns_set_secondary_nameserver():
 	from dns_update import set_secondary_dns
 	try:
-		return set_secondary_dns([
-			ns.strip() for ns in re.split(r"[, ]+",
-										request.form.get('hostnames') or "")
-			if ns.strip() != ""
-		], env)
+		with reconfigure.lock:
+			return set_secondary_dns([
+				ns.strip() for ns in re.split(r"[, ]+",
+											request.form.get('hostnames') or "")
+				if ns.strip() != ""
+			], env)
 	except ValueError as e:
 		return (str(e), 400)
 
@@ -437,7 +598,7 @@ def dns_get_records(qname=None, rtype=None):
 		methods=['GET', 'POST', 'PUT', 'DELETE'])
 @authorized_personnel_only()
 def dns_set_record(qname, rtype="A"):
-	from dns_update import do_dns_update, set_custom_dns_record
+	from dns_update import set_custom_dns_record
 	try:
 		# Normalize.
 		rtype = rtype.upper()
@@ -494,7 +655,10 @@ def dns_set_record(qname, rtype="A"):
 			action = "remove"
 
 		if set_custom_dns_record(qname, rtype, value, action, env, ttl=ttl):
-			return do_dns_update(env) or "Something isn't right."
+			# Only the zone of the record changes, except for the secondary
+			# nameservers, which are in every zone.
+			return reconfigure.schedule("dns", domains=None
+				if qname == "_secondary_nameserver" else [qname])
 		return "OK"
 
 	except ValueError as e:
@@ -517,6 +681,16 @@ def dns_get_zonefile(zone):
 					mimetype='text/plain')
 
 
+@app.route('/dns/zonefile/<zone>/changes')
+@authorized_personnel_only()
+def dns_get_zone_changes(zone):
+	from dns_update import get_dns_zone_changes
+	try:
+		return json_response(get_dns_zone_changes(zone, env))
+	except ValueError as e:
+		return (str(e), 400)
+
+
 # SSL
 
 
@@ -580,14 +754,16 @@ def ssl_install_cert():
 	ssl_chain = request.form.get('chain')
 	if domain not in get_web_domains(env):
 		return "Invalid domain name."
-	return install_cert(domain, ssl_cert, ssl_chain, env)
+	with reconfigure.lock:
+		return install_cert(domain, ssl_cert, ssl_chain, env)
 
 
 @app.route('/ssl/provision', methods=['POST'])
 @authorized_personnel_only()
 def ssl_provision_certs():
 	from ssl_certificates import provision_certificates
-	requests = provision_certificates(env, limit_domains=None)
+	with reconfigure.lock:
+		requests = provision_certificates(env, limit_domains=None)
 	return json_response({"requests": requests})
 
 
@@ -667,11 +843,7 @@ def web_get_domains():
 @app.route('/web/update', methods=['POST'])
 @authorized_personnel_only()
 def web_update():
-	from web_update import do_web_update
-	try:
-		return do_web_update(env)
-	except Exception as e:
-		return (str(e), 500)
+	return reconfigure.schedule("web")
 
 
 # System
@@ -745,6 +917,66 @@ def system_status():
 	return json_response(output.items)
 
 
+@app.route('/system/jobs')
+@authorized_personnel_only()
+def system_jobs():
+	return json_response(reconfigure.get_jobs())
+
+
+@app.route('/system/jobs/<int:job_id>')
+@authorized_personnel_only()
+def system_job(job_id):
+	job = reconfigure.get_job(job_id)
+	if job is None:
+		return ("No such job.", 404)
+	return json_response(job)
+
+
+@app.route('/system/mail-stats')
+@authorized_personnel_only()
+def system_mail_stats():
+	# Mail log statistics for one of the time spans of management/mail_log.py, e.g. ?timespan=hour.
+	# Add format=ndjson for one JSON object per line.
+	import mail_log
+	timespan = request.args.get("timespan", "day")
+	if timespan not in mail_log.TIME_DELTAS:
+		return ("Invalid time span. Possible values: %s" % ", ".join(mail_log.TIME_DELTAS), 400)
+
+	# Reading the logs takes a while, so reports are built in the background and dashboards polling
+	# for the same time span share one. Until a newer report is built, the last one is served.
+	with mail_stats_lock:
+		built, report = mail_stats.get(timespan, (0, None))
+		if time.time() - built >= MAIL_STATS_MAX_AGE and timespan not in mail_stats_building:
+			mail_stats_building.add(timespan)
+			threading.Thread(target=build_mail_stats, args=(timespan, ), name="mail-stats",
+				daemon=True).start()
+
+	if report is None:
+		response = Response("The report is being built. Try again later.\n", status=202,
+			mimetype='text/plain')
+		response.headers["Retry-After"] = "30"
+		return response
+
+	if request.args.get("format") == "ndjson":
+		return Response(report.to_ndjson(), status=200, mimetype='application/x-ndjson')
+	return json_response(report.as_dict())
+
+
+def build_mail_stats(timespan):
+	# Runs in a background thread, see system_mail_stats.
+	import mail_log
+	try:
+		with mail_stats_build_lock:
+			report = mail_log.report_for(env, timespan)
+		with mail_stats_lock:
+			mail_stats[timespan] = (time.time(), report)
+	except Exception:
+		app.logger.exception("Building the mail log report for %s failed" % timespan)
+	finally:
+		with mail_stats_lock:
+			mail_stats_building.discard(timespan)
+
+
 @app.route('/system/updates')
 @authorized_personnel_only()
 def show_updates():
@@ -1001,7 +1233,8 @@ def smtp_relay_set():
 
 		# Regenerate DNS (to apply whatever changes need to be made)
 		from dns_update import do_dns_update
-		do_dns_update(env)
+		with reconfigure.lock:
+			do_dns_update(env)
 
 		# Restart Postfix
 		return utils.shell("check_output", ["/usr/sbin/postfix", "reload"],
@@ -0,0 +1,78 @@
+# Access to the users database, $STORAGE_ROOT/mail/users.sqlite.
+#
+# Every thread keeps a connection to the database open and reuses it, along with the statements
+# prepared on it, instead of opening a new connection for every query. Changes are made in
+# transactions:
+#
+#	with database.transaction(env) as c:
+#		c.execute("UPDATE users SET quota=? WHERE email=?", (quota, email))
+#
+# The database stays in the rollback journal mode setup/mail-users.sh sets, because Postfix can't
+# read it in WAL mode. So while a change is being committed, other processes wait for up to
+# BUSY_TIMEOUT seconds rather than failing with "database is locked".
+
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+# Seconds to wait for another process (e.g. Roundcube changing a password) to release its lock
+BUSY_TIMEOUT = 15
+
+# Number of prepared statements kept per connection
+CACHED_STATEMENTS = 256
+
+connections = threading.local()
+
+
+def get_connection(env):
+	""" The calling thread's connection to the users database, opened on first use """
+	path = os.path.join(env["STORAGE_ROOT"], "mail/users.sqlite")
+	try:
+		inode = os.stat(path).st_ino
+	except FileNotFoundError:
+		inode = None
+
+	# A connection is only reused by the process that opened it (not by processes forked from it,
+	# e.g. by multiprocessing) and while the file wasn't replaced (e.g. restored from a backup).
+	key = (path, os.getpid())
+	entry = getattr(connections, "by_path", {}).get(key)
+	if entry is None or entry[1] != inode:
+		if entry is not None:
+			entry[0].close()
+		conn = sqlite3.connect(path,
+							timeout=BUSY_TIMEOUT,
+							cached_statements=CACHED_STATEMENTS)
+		if not hasattr(connections, "by_path"):
+			connections.by_path = {}
+		entry = connections.by_path[key] = (conn, os.stat(path).st_ino)
+	return entry[0]
+
+
+def cursor(env):
+	""" A cursor to query the users database with """
+	return get_connection(env).cursor()
+
+
+@contextmanager
+def transaction(env):
+	""" A cursor to change the users database with
+
+	The changes are committed when the with block ends, or rolled back if it raises an exception.
+	"""
+	with get_connection(env) as conn:
+		yield conn.cursor()
+
+
+def change_counter(env):
+	""" A value that changes whenever a change to the users database is committed
+
+	It's the same in every thread and process, so it can key what's cached from the database (e.g. the
+	directory snapshot of mailconfig.py) and be handed out (e.g. in an ETag). It's the file change
+	counter in the header of the database, which SQLite increments on every commit in rollback
+	journal mode.
+	"""
+	path = os.path.join(env["STORAGE_ROOT"], "mail/users.sqlite")
+	with open(path, "rb") as f:
+		f.seek(24)
+		return (os.fstat(f.fileno()).st_ino, int.from_bytes(f.read(4), "big"))
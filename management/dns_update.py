@@ -13,6 +13,17 @@ import re
 import hashlib
 import base64
 import ipaddress
+import json
+import struct
+import shutil
+import tempfile
+import threading
+import time
+import atexit
+import itertools
+import glob
+from collections import namedtuple
+from multiprocessing.pool import ThreadPool
 import rtyaml
 import idna
 import dns.resolver
@@ -32,6 +43,13 @@ DEFAULT_TTL = 86400
 TTL_MIN = 30
 TTL_MAX = 2592000  # 30 days; some DNS services have lower caps (7 days)
 
+NSD_ZONES_DIR = "/etc/nsd/zones"
+NSD_CONF_FILE = "/etc/nsd/nsd.conf.d/zones.conf"
+LDNS_SIGNZONE = "/usr/bin/ldns-signzone"
+
+# How many zones to sign at the same time. ldns-signzone uses a single core.
+SIGNING_WORKERS = min(8, os.cpu_count() or 1)
+
 
 def get_dns_domains(env):
 	# Add all domain names in use by email users and mail aliases, any
@@ -46,6 +64,13 @@ def get_dns_domains(env):
 	return domains
 
 
+def get_parent_domains(domain):
+	# "a.b.example.com" => "b.example.com", "example.com", "com"
+	labels = domain.split(".")
+	for i in range(1, len(labels)):
+		yield ".".join(labels[i:])
+
+
 def get_dns_zones(env):
 	# What domains should we create DNS zones for? Never create a zone for
 	# a domain & a subdomain of that domain.
@@ -55,12 +80,8 @@ def get_dns_zones(env):
 	# by looking at shorter domains first.
 	zone_domains = set()
 	for domain in sorted(domains, key=lambda d: len(d)):
-		for d in zone_domains:
-			if domain.endswith("." + d):
-				# We found a parent domain already in the list.
-				break
-		else:
-			# 'break' did not occur: there is no parent domain.
+		if not any(d in zone_domains for d in get_parent_domains(domain)):
+			# There is no parent domain in the list.
 			zone_domains.add(domain)
 
 	# Make a nice and safe filename for each domain.
@@ -71,44 +92,83 @@ def get_dns_zones(env):
 	# Sort the list so that the order is nice and so that nsd.conf has a
 	# stable order so we don't rewrite the file & restart the service
 	# meaninglessly.
-	zone_order = sort_domains([zone[0] for zone in zonefiles], env)
-	zonefiles.sort(key=lambda zone: zone_order.index(zone[0]))
+	zone_order = {
+		domain: i
+		for i, domain in enumerate(sort_domains([zone[0] for zone in zonefiles], env))
+	}
+	zonefiles.sort(key=lambda zone: zone_order[zone[0]])
 
 	return zonefiles
 
 
-def do_dns_update(env, force=False):
+def get_affected_zones(domains, zones):
+	# Returns the zones (of the (domain, zonefile) list from get_dns_zones)
+	# that the domains are in, i.e. whose records may change when something
+	# about the domains (their custom records, mail addresses or certificates)
+	# changes.
+	zone_domains = set(zone for zone, zonefile in zones)
+	affected = set()
+	for domain in domains:
+		for d in itertools.chain([domain], get_parent_domains(domain)):
+			if d in zone_domains:
+				affected.add(d)
+				break
+	return affected
+
+
+def get_nsd_zones():
+	# The zones in nsd's configuration, as last written by write_nsd_conf.
+	try:
+		with open(NSD_CONF_FILE) as f:
+			return set(re.findall(r"^\tname: (\S+)$", f.read(), re.M))
+	except FileNotFoundError:
+		return set()
+
+
+def do_dns_update(env, force=False, domains=None):
+	# Rebuilds the DNS zones and tells nsd about the ones that changed. If
+	# domains is given, only the zones that those domains are in and the zones
+	# nsd doesn't have yet are rebuilt.
+	zones = get_dns_zones(env)
+	zonefiles = [(domain, zonefile + ".signed") for domain, zonefile in zones]
+	affected_zones = None
+	removed_zones = set()
+	if domains is not None:
+		zone_domains = set(zone for zone, zonefile in zones)
+		nsd_zones = get_nsd_zones()
+		affected_zones = get_affected_zones(domains, zones) | (zone_domains - nsd_zones)
+		removed_zones = nsd_zones - zone_domains
+
 	# Write zone files.
-	os.makedirs('/etc/nsd/zones', exist_ok=True)
-	zonefiles = []
+	os.makedirs(NSD_ZONES_DIR, exist_ok=True)
 	updated_domains = []
-	for (domain, zonefile, records) in build_zones(env):
-		# The final set of files will be signed.
-		zonefiles.append((domain, zonefile + ".signed"))
-
+	for (domain, zonefile, records) in build_zones(env, affected_zones):
 		# See if the zone has changed, and if so update the serial number
 		# and write the zone file.
-		if not write_nsd_zone(domain, "/etc/nsd/zones/" + zonefile, records,
+		if not write_nsd_zone(domain, os.path.join(NSD_ZONES_DIR, zonefile), records,
 							env, force):
 			# Zone was not updated. There were no changes.
 			continue
 
 		# Mark that we just updated this domain.
-		updated_domains.append(domain)
+		updated_domains.append((domain, zonefile))
 
-		# Sign the zone.
-		#
-		# Every time we sign the zone we get a new result, which means
-		# we can't sign a zone without bumping the zone's serial number.
-		# Thus we only sign a zone if write_nsd_zone returned True
-		# indicating the zone changed, and thus it got a new serial number.
-		# write_nsd_zone is smart enough to check if a zone's signature
-		# is nearing expiration and if so it'll bump the serial number
-		# and return True so we get a chance to re-sign it.
-		sign_zone(domain, zonefile, env)
+	# Sign the zones.
+	#
+	# Every time we sign the zone we get a new result, which means
+	# we can't sign a zone without bumping the zone's serial number.
+	# Thus we only sign a zone if write_nsd_zone returned True
+	# indicating the zone changed, and thus it got a new serial number.
+	# write_nsd_zone is smart enough to check if a zone's signature
+	# is nearing expiration and if so it'll bump the serial number
+	# and return True so we get a chance to re-sign it.
+	signing_times = sign_zones(updated_domains, env)
+	updated_domains = [domain for domain, zonefile in updated_domains]
+	updated_zones = list(updated_domains)
 
 	# Write the main nsd.conf file.
-	if write_nsd_conf(zonefiles, list(get_custom_dns_config(env)), env):
+	nsd_conf_changed = write_nsd_conf(zonefiles, list(get_custom_dns_config(env)), env)
+	if nsd_conf_changed:
 		# Make sure updated_domains contains *something* if we wrote an updated
 		# nsd.conf so that we know to restart nsd.
 		if len(updated_domains) == 0:
@@ -117,13 +177,19 @@ def do_dns_update(env, force=False):
 	# Tell nsd to reload changed zone files.
 	if len(updated_domains) > 0:
 		# 'reconfig' is needed if there are added or removed zones, but
-		# it may not reload existing zones, so we call 'reload' too. If
-		# nsd isn't running, nsd-control fails, so in that case revert
-		# to restarting nsd to make sure it is running. Restarting nsd
+		# it may not reload existing zones, so we reload the zones that
+		# changed too, one by one unless they all did. If nsd isn't
+		# running, nsd-control fails, so in that case revert to
+		# restarting nsd to make sure it is running. Restarting nsd
 		# should also refresh everything.
 		try:
-			shell('check_call', ["/usr/sbin/nsd-control", "reconfig"])
-			shell('check_call', ["/usr/sbin/nsd-control", "reload"])
+			if nsd_conf_changed:
+				shell('check_call', ["/usr/sbin/nsd-control", "reconfig"])
+			if len(updated_zones) == len(zones):
+				shell('check_call', ["/usr/sbin/nsd-control", "reload"])
+			else:
+				for zone in updated_zones:
+					shell('check_call', ["/usr/sbin/nsd-control", "reload", zone])
 		except:
 			shell('check_call', ["/usr/sbin/service", "nsd", "restart"])
 
@@ -136,24 +202,36 @@ def do_dns_update(env, force=False):
 			# If this is the only thing that changed?
 			updated_domains.append("OpenDKIM configuration")
 
-	# Clear bind9's DNS cache so our own DNS resolver is up to date.
+	# Clear bind9's DNS cache so our own DNS resolver is up to date, for
+	# the zones that changed or were removed if not all of them could have.
 	# (ignore errors with trap=True)
-	shell('check_call', ["/usr/sbin/rndc", "flush"], trap=True)
+	if affected_zones is None:
+		shell('check_call', ["/usr/sbin/rndc", "flush"], trap=True)
+	else:
+		for zone in updated_zones + sorted(removed_zones):
+			shell('check_call', ["/usr/sbin/rndc", "flushtree", zone], trap=True)
 
 	if len(updated_domains) == 0:
 		# if nothing was updated (except maybe OpenDKIM's files), don't show any output
 		return ""
 	else:
-		return "updated DNS: " + ",".join(updated_domains) + "\n"
+		ret = "updated DNS: " + ",".join(updated_domains) + "\n"
+		if signing_times:
+			ret += "signed DNS zones: " + ", ".join(
+				"%s %.1fs" % (domain, seconds) for domain, seconds in signing_times) + "\n"
+		return ret
 
 
 ########################################################################
 
 
-def build_zones(env):
-	# What domains (and their zone filenames) should we build?
+def build_zones(env, zones=None):
+	# What domains (and their zone filenames) should we build? All of them,
+	# unless given a set of zones.
 	domains = get_dns_domains(env)
 	zonefiles = get_dns_zones(env)
+	if zones is not None:
+		zonefiles = [(domain, zonefile) for domain, zonefile in zonefiles if domain in zones]
 
 	# Create a dictionary of domains to a set of attributes for each
 	# domain, such as whether there are mail users at the domain.
@@ -183,60 +261,158 @@ def build_zones(env):
 		for domain in domains
 	}
 
+	# Load custom records to add to zones.
+	additional_records = list(get_custom_dns_config(env))
+
+	# Work out what every zone needs to look up once, rather than for each zone.
+	index = ZoneIndex(domains, additional_records, env)
+
 	# For MTA-STS, we'll need to check if the PRIMARY_HOSTNAME certificate is
 	# singned and valid. Check that now rather than repeatedly for each domain.
 	domains[env["PRIMARY_HOSTNAME"]][
 		"certificate-is-valid"] = is_domain_cert_signed_and_valid(
-			env["PRIMARY_HOSTNAME"], env)
-
-	# Load custom records to add to zones.
-	additional_records = list(get_custom_dns_config(env))
+			env["PRIMARY_HOSTNAME"], env, index.get_ssl_certificates())
 
 	# Build DNS records for each zone.
 	for domain, zonefile in zonefiles:
 		# Build the records to put in the zone.
-		records = build_zone(domain, domains, additional_records, env)
+		records = build_zone(domain, domains, additional_records, env, index=index)
 		yield (domain, zonefile, records)
 
 
+def get_spf_extra(settings):
+	# Are there any other authorized servers for the domains?
+	spf_extra = ""
+	# Convert settings to spf elements
+	for r in settings.get("SMTP_RELAY_AUTHORIZED_SERVERS", []):
+		sr = ""
+		if r[0:4] == "spf:":
+			sr = f"include:{r[4:]}"
+		elif "/" in r:
+			net = ipaddress.ip_network(r)
+			if isinstance(net, ipaddress.IPv4Network):
+				sr = "ip4:" + net.compressed
+			elif isinstance(net, ipaddress.IPv6Network):
+				sr = "ip6:" + net.compressed
+		elif not (re.fullmatch(r"[0-9\.\:]+", r) is None):
+			addr = ipaddress.ip_address(r)
+			if isinstance(addr, ipaddress.IPv4Address):
+				sr = "ip4:" + addr.compressed
+			elif isinstance(addr, ipaddress.IPv6Address):
+				sr = "ip6:" + addr.compressed
+		elif idna.encode(r):
+			sr = "a:" + idna.encode(r).decode()
+		else:
+			raise ValueError(
+				f"Unexpected entry on authorized servers: {r}")
+		spf_extra += f"{sr} "
+	if spf_extra.strip() == "":
+		return None
+	return spf_extra
+
+
+class ZoneIndex:
+	# What build_zone looks up for every zone and subdomain, worked out once
+	# for all of them: the settings, the subdomains of each domain and the
+	# custom records of each domain. The DKIM record, the MTA-STS policy id and
+	# the certificates are read the first time they are needed.
+
+	def __init__(self, domain_properties, additional_records, env):
+		self.env = env
+		self.settings = load_settings(env)
+		self.relay_on = self.settings.get("SMTP_RELAY_ENABLED", False)
+		self.spf_extra = get_spf_extra(self.settings) if self.relay_on else None
+		self.secondary_ns = get_secondary_dns(additional_records, mode="NS")
+
+		# Each domain is listed under every domain it's a subdomain of.
+		self.subdomains = {}
+		for domain in domain_properties:
+			for parent in get_parent_domains(domain):
+				self.subdomains.setdefault(parent, []).append(domain)
+
+		# Each custom record is listed under its own domain and every domain
+		# above it, in the short form of filter_custom_records.
+		self.custom_records = {}
+		for qname, rtype, value, ttl in additional_records:
+			if qname == "_secondary_nameserver":
+				continue
+			self.custom_records.setdefault(qname, []).append(
+				(None, rtype, value, ttl))
+			for parent in get_parent_domains(qname):
+				self.custom_records.setdefault(parent, []).append(
+					(qname[0:len(qname) - len("." + parent)], rtype, value, ttl))
+
+		self.ssl_certificates = None
+		self.dkim_record = None
+		self.mta_sts_policy_id = None
+
+	def get_ssl_certificates(self):
+		if self.ssl_certificates is None:
+			self.ssl_certificates = get_ssl_certificates(self.env)
+		return self.ssl_certificates
+
+	def get_dkim_record(self):
+		# The DKIM TXT record as generated by OpenDKIM.
+		if self.dkim_record is None:
+			opendkim_record_file = os.path.join(self.env['STORAGE_ROOT'],
+												'mail/dkim/mail.txt')
+			with open(opendkim_record_file) as orf:
+				m = re.match(r'(\S+)\s+IN\s+TXT\s+\( ((?:"[^"]+"\s+)+)\)',
+							orf.read(), re.S)
+				self.dkim_record = "".join(re.findall(r'"([^"]+)"', m.group(2)))
+		return self.dkim_record
+
+	def get_mta_sts_policy_id(self):
+		# Compute an up-to-32-character hash of the policy file. We'll take a SHA-1 hash of the policy
+		# file (20 bytes) and encode it as base-64 (28 bytes, using alphanumeric alternate characters
+		# instead of '+' and '/' which are not allowed in an MTA-STS policy id) but then just take its
+		# first 20 characters, which is more than sufficient to change whenever the policy file changes
+		# (and ensures any '=' padding at the end of the base64 encoding is dropped).
+		if self.mta_sts_policy_id is None:
+			with open("/var/lib/mailinabox/mta-sts.txt", "rb") as f:
+				self.mta_sts_policy_id = base64.b64encode(
+					hashlib.sha1(f.read()).digest(),
+					altchars=b"AA").decode("ascii")[0:20]
+		return self.mta_sts_policy_id
+
+
+class RecordIndex:
+	# The values of the records of a zone by (qname, rtype), so that has_rec
+	# doesn't look through all of them. It only knows about the records up to
+	# the last update().
+
+	def __init__(self, records):
+		self.records = records
+		self.count = 0
+		self.values = {}
+		self.update()
+
+	def update(self):
+		for qname, rtype, value, explanation, ttl in self.records[self.count:]:
+			self.values.setdefault((qname, rtype), []).append(value)
+		self.count = len(self.records)
+
+	def has(self, qname, rtype, prefix=None):
+		values = self.values.get((qname, rtype))
+		if not values:
+			return False
+		return prefix is None or any(
+			value.startswith(prefix) for value in values)
+
+
 def build_zone(domain,
 			domain_properties,
 			additional_records,
 			env,
-			is_zone=True):
+			is_zone=True,
+			index=None):
 	records = []
 
-	# Are there any other authorized servers for this domain?
-	settings = load_settings(env)
-	spf_extra = None
-	relay_on = settings.get("SMTP_RELAY_ENABLED", False)
-	if relay_on:
-		spf_extra = ""
-		# Convert settings to spf elements
-		for r in settings.get("SMTP_RELAY_AUTHORIZED_SERVERS", []):
-			sr = ""
-			if r[0:4] == "spf:":
-				sr = f"include:{r[4:]}"
-			elif "/" in r:
-				net = ipaddress.ip_network(r)
-				if isinstance(net, ipaddress.IPv4Network):
-					sr = "ip4:" + net.compressed
-				elif isinstance(net, ipaddress.IPv6Network):
-					sr = "ip6:" + net.compressed
-			elif not (re.fullmatch(r"[0-9\.\:]+", r) is None):
-				addr = ipaddress.ip_address(r)
-				if isinstance(addr, ipaddress.IPv4Address):
-					sr = "ip4:" + addr.compressed
-				elif isinstance(addr, ipaddress.IPv6Address):
-					sr = "ip6:" + addr.compressed
-			elif idna.encode(r):
-				sr = "a:" + idna.encode(r).decode()
-			else:
-				raise ValueError(
-					f"Unexpected entry on authorized servers: {r}")
-			spf_extra += f"{sr} "
-		if spf_extra.strip() == "":
-			spf_extra = None
+	if index is None:
+		index = ZoneIndex(domain_properties, additional_records, env)
+	settings = index.settings
+	relay_on = index.relay_on
+	spf_extra = index.spf_extra
 
 	# For top-level zones, define the authoritative name servers.
 	#
@@ -253,7 +429,7 @@ def build_zone(domain,
 
 		# NS record to ns2.PRIMARY_HOSTNAME or whatever the user overrides.
 		# User may provide one or more additional nameservers
-		secondary_ns_list = get_secondary_dns(additional_records, mode="NS") \
+		secondary_ns_list = index.secondary_ns \
 						or ["ns2." + env["PRIMARY_HOSTNAME"]]
 		for secondary_ns in secondary_ns_list:
 			records.append((None, "NS", secondary_ns + '.', False, None))
@@ -291,14 +467,14 @@ def build_zone(domain,
 	# Add DNS records for any subdomains of this domain. We should not have a zone for
 	# both a domain and one of its subdomains.
 	if is_zone:  # don't recurse when we're just loading data for a subdomain
-		subdomains = [d for d in domain_properties if d.endswith("." + domain)]
-		for subdomain in subdomains:
+		for subdomain in index.subdomains.get(domain, []):
 			subdomain_qname = subdomain[0:-len("." + domain)]
 			subzone = build_zone(subdomain,
 								domain_properties,
 								additional_records,
 								env,
-								is_zone=False)
+								is_zone=False,
+								index=index)
 			for child_qname, child_rtype, child_value, child_explanation, child_ttl in subzone:
 				if child_qname == None:
 					child_qname = subdomain_qname
@@ -307,19 +483,17 @@ def build_zone(domain,
 				records.append((child_qname, child_rtype, child_value,
 								child_explanation, child_ttl))
 
-	has_rec_base = list(records)  # clone current state
+	has_rec_base = RecordIndex(records)  # current state
+	has_rec_follows = False
 
 	def has_rec(qname, rtype, prefix=None):
-		for rec in has_rec_base:
-			if rec[0] == qname and rec[1] == rtype and (
-				prefix is None or rec[2].startswith(prefix)):
-				return True
-		return False
+		if has_rec_follows:
+			has_rec_base.update()
+		return has_rec_base.has(qname, rtype, prefix)
 
 	# The user may set other records that don't conflict with our settings.
 	# Don't put any TXT records above this line, or it'll prevent any custom TXT records.
-	for qname, rtype, value, ttl in filter_custom_records(
-		domain, additional_records):
+	for qname, rtype, value, ttl in index.custom_records.get(domain, []):
 		# Don't allow custom records for record types that override anything above.
 		# But allow multiple custom records for the same rtype --- see how has_rec_base is used.
 		if has_rec(qname, rtype):
@@ -339,9 +513,9 @@ def build_zone(domain,
 	# Add A/AAAA defaults if not overridden by the user's custom settings (and not otherwise configured).
 	# Any CNAME or A record on the qname overrides A and AAAA. But when we set the default A record,
 	# we should not cause the default AAAA record to be skipped because it thinks a custom A record
-	# was set. So set has_rec_base to a clone of the current set of DNS settings, and don't update
+	# was set. So bring has_rec_base up to the current set of DNS settings, and don't update
 	# during this process.
-	has_rec_base = list(records)
+	has_rec_base.update()
 	a_expl = "Required. May have a different value. Sets the IP address that %s resolves to for web hosting and other services besides mail. The A record must be present but its value does not affect mail delivery." % domain
 	if domain_properties[domain]["auto"]:
 		if domain.startswith("ns1.") or domain.startswith("ns2."):
@@ -374,7 +548,7 @@ def build_zone(domain,
 			records.append((qname, rtype, value, explanation, None))
 
 	# Don't pin the list of records that has_rec checks against anymore.
-	has_rec_base = records
+	has_rec_follows = True
 
 	if domain_properties[domain]["mail"]:
 		# The MX record says where email for the domain should be delivered: Here!
@@ -416,19 +590,12 @@ def build_zone(domain,
 
 		# Append the DKIM TXT record to the zone as generated by OpenDKIM.
 		# Skip if the user has set a DKIM record already.
-		opendkim_record_file = os.path.join(env['STORAGE_ROOT'],
-											'mail/dkim/mail.txt')
-		with open(opendkim_record_file) as orf:
-			m = re.match(r'(\S+)\s+IN\s+TXT\s+\( ((?:"[^"]+"\s+)+)\)',
-						orf.read(), re.S)
-			val = "".join(re.findall(r'"([^"]+)"', m.group(2)))
-			rname = f"{settings.get('local_dkim_selector', 'mail')}._domainkey"
-
-			if not has_rec(rname, "TXT", prefix="v=DKIM1; "):
-				records.append((
-					rname, "TXT", val,
-					"Recommended. Provides a way for recipients to verify that this machine sent @%s mail."
-					% domain, None))
+		rname = f"{settings.get('local_dkim_selector', 'mail')}._domainkey"
+		if not has_rec(rname, "TXT", prefix="v=DKIM1; "):
+			records.append((
+				rname, "TXT", index.get_dkim_record(),
+				"Recommended. Provides a way for recipients to verify that this machine sent @%s mail."
+				% domain, None))
 
 		# Append the DKIM TXT record relative to the SMTP relay, if applicable.
 		# Skip if manually set by the user.
@@ -493,18 +660,10 @@ def build_zone(domain,
 	mta_sts_records = []
 	if domain_properties[domain]["mail"] \
 				and domain_properties[env["PRIMARY_HOSTNAME"]]["certificate-is-valid"] \
-				and is_domain_cert_signed_and_valid("mta-sts." + domain, env):
-		# Compute an up-to-32-character hash of the policy file. We'll take a SHA-1 hash of the policy
-		# file (20 bytes) and encode it as base-64 (28 bytes, using alphanumeric alternate characters
-		# instead of '+' and '/' which are not allowed in an MTA-STS policy id) but then just take its
-		# first 20 characters, which is more than sufficient to change whenever the policy file changes
-		# (and ensures any '=' padding at the end of the base64 encoding is dropped).
-		with open("/var/lib/mailinabox/mta-sts.txt", "rb") as f:
-			mta_sts_policy_id = base64.b64encode(
-				hashlib.sha1(f.read()).digest(),
-				altchars=b"AA").decode("ascii")[0:20]
+				and is_domain_cert_signed_and_valid("mta-sts." + domain, env,
+													index.get_ssl_certificates()):
 		mta_sts_records.extend([(
-			"_mta-sts", "TXT", "v=STSv1; id=" + mta_sts_policy_id,
+			"_mta-sts", "TXT", "v=STSv1; id=" + index.get_mta_sts_policy_id(),
 			"Optional. Part of the MTA-STS policy for incoming mail. If set, a MTA-STS policy must also be published."
 		)])
 
@@ -554,40 +713,6 @@ def build_zone(domain,
 					"Recommended. Prevents use of this domain name for incoming mail.",
 					None))
 
-	# Add no-mail-here records for any qname that has an A or AAAA record
-	# but no MX record. This would include domain itself if domain is a
-	# non-mail domain and also may include qnames from custom DNS records.
-	# Do this once at the end of generating a zone.
-	if is_zone:
-		qnames_with_a = set(qname for (qname, rtype, value, explanation,
-									ttl) in records
-							if rtype in ("A", "AAAA"))
-		qnames_with_mx = set(qname for (qname, rtype, value, explanation,
-										ttl) in records if rtype == "MX")
-		for qname in qnames_with_a - qnames_with_mx:
-			# Mark this domain as not sending mail with hard-fail SPF and DMARC records.
-			d = (qname + "." if qname else "") + domain
-			if not has_rec(qname, "TXT", prefix="v=spf1 "):
-				records.append((
-					qname, "TXT", 'v=spf1 -all',
-					"Recommended. Prevents use of this domain name for outbound mail by specifying that no servers are valid sources for mail from @%s. If you do send email from this domain name you should either override this record such that the SPF rule does allow the originating server, or, take the recommended approach and have the box handle mail for this domain (simply add any receiving alias at this domain name to make this machine treat the domain name as one of its mail domains)."
-					% d, None))
-			if not has_rec("_dmarc" + ("." + qname if qname else ""),
-						"TXT",
-						prefix="v=DMARC1; "):
-				records.append((
-					"_dmarc" + ("." + qname if qname else ""), "TXT",
-					'v=DMARC1; p=reject',
-					"Recommended. Prevents use of this domain name for outbound mail by specifying that the SPF rule should be honoured for mail from @%s."
-					% d, None))
-
-			# And with a null MX record (https://explained-from-first-principles.com/email/#null-mx-record)
-			if not has_rec(qname, "MX"):
-				records.append((
-					qname, "MX", '0 .',
-					"Recommended. Prevents use of this domain name for incoming mail.",
-					None))
-
 	# Sort the records. The None records *must* go first in the nsd zone file. Otherwise it doesn't matter.
 	records.sort(key=lambda rec: list(
 		reversed(rec[0].split(".")) if rec[0] is not None else ""))
@@ -595,8 +720,10 @@ def build_zone(domain,
 	return records
 
 
-def is_domain_cert_signed_and_valid(domain, env):
-	cert = get_ssl_certificates(env).get(domain)
+def is_domain_cert_signed_and_valid(domain, env, ssl_certificates=None):
+	if ssl_certificates is None:
+		ssl_certificates = get_ssl_certificates(env)
+	cert = ssl_certificates.get(domain)
 	if not cert:
 		return False  # no certificate provisioned
 	cert_status = check_certificate(domain, cert['certificate'],
@@ -607,6 +734,22 @@ def is_domain_cert_signed_and_valid(domain, env):
 ########################################################################
 
 
+# The TLSA and SSHFP records, with the version of the files they were made from
+record_cache = {}
+
+
+def get_files_version(paths):
+	# Something that changes when any of the files changes.
+	version = []
+	for path in paths:
+		try:
+			st = os.stat(path)
+			version.append((path, st.st_ino, st.st_mtime_ns, st.st_size))
+		except FileNotFoundError:
+			version.append((path, None))
+	return version
+
+
 def build_tlsa_record(env):
 	# A DANE TLSA record in DNS specifies that connections on a port
 	# must use TLS and the certificate must match a particular criteria.
@@ -631,6 +774,12 @@ def build_tlsa_record(env):
 	from cryptography.hazmat.primitives.serialization import Encoding, PublicFormat
 
 	fn = os.path.join(env["STORAGE_ROOT"], "ssl", "ssl_certificate.pem")
+
+	# Don't read the certificate again unless it changed.
+	version = get_files_version([fn])
+	if "TLSA" in record_cache and record_cache["TLSA"][0] == version:
+		return record_cache["TLSA"][1]
+
 	cert = load_pem(load_cert_chain(fn)[0])
 
 	subject_public_key = cert.public_key().public_bytes(
@@ -643,7 +792,8 @@ def build_tlsa_record(env):
 	# 3: Match the (leaf) certificate. (No CA, no trust path needed.)
 	# 1: Match its subject public key.
 	# 1: Use SHA256.
-	return "3 1 1 " + pk_hash
+	record_cache["TLSA"] = (version, "3 1 1 " + pk_hash)
+	return record_cache["TLSA"][1]
 
 
 def build_sshfp_records():
@@ -671,6 +821,11 @@ def build_sshfp_records():
 	# to the zone file (that trigger bumping the serial number). However,
 	# if SSH has been configured to listen on a nonstandard port, we must
 	# specify that port to sshkeyscan.
+	#
+	# Don't run ssh-keyscan again unless sshd's configuration or keys changed.
+	version = get_files_version(["/etc/ssh/sshd_config"] + sorted(glob.glob("/etc/ssh/ssh_host_*_key.pub")))
+	if "SSHFP" in record_cache and record_cache["SSHFP"][0] == version:
+		return record_cache["SSHFP"][1]
 
 	port = 22
 
@@ -695,25 +850,58 @@ def build_sshfp_records():
 	])
 	keys = sorted(keys.split("\n"))
 
+	records = []
 	for key in keys:
 		if key.strip() == "" or key[0] == "#":
 			continue
 		try:
 			host, keytype, pubkey = key.split(" ")
-			yield "%d %d ( %s )" % (
+			records.append("%d %d ( %s )" % (
 				algorithm_number[keytype],
 				2,  # specifies we are using SHA-256 on next line
 				hashlib.sha256(base64.b64decode(pubkey)).hexdigest().upper(),
-			)
+			))
 		except:
 			# Lots of things can go wrong. Don't let it disturb the DNS
 			# zone.
 			pass
+	record_cache["SSHFP"] = (version, records)
+	return records
 
 
 ########################################################################
 
 
+# A record in a zone: its fully qualified name, type, TTL and value
+ZoneRecord = namedtuple("ZoneRecord", ["qname", "rtype", "ttl", "rdata"])
+
+
+def get_zone_records(domain, records):
+	# Returns the records from build_zone as ZoneRecords, in a canonical order
+	# (by name, then type, then value) that doesn't depend on how they were built.
+	return sorted(
+		ZoneRecord(subdomain + "." + domain if subdomain else domain, querytype,
+				ttl if ttl is not None else DEFAULT_TTL, value)
+		for subdomain, querytype, value, explanation, ttl in records)
+
+
+def read_zone_metadata(zonefile):
+	# Next to each zone file we keep what we know about the zone in JSON: the hash
+	# of its contents, its serial number, its records, what changed the last time
+	# it was written and when its signatures expire. Returns {} if there's none.
+	try:
+		with open(zonefile + ".meta") as f:
+			return json.load(f)
+	except (OSError, ValueError):
+		return {}
+
+
+def write_zone_metadata(zonefile, metadata):
+	with open(zonefile + ".meta.tmp", "w") as f:
+		json.dump(metadata, f, indent=2)
+	os.replace(zonefile + ".meta.tmp", zonefile + ".meta")
+
+
 def write_nsd_zone(domain, zonefile, records, env, force):
 	# On the $ORIGIN line, there's typically a ';' comment at the end explaining
 	# what the $ORIGIN line does. Any further data after the domain confuses
@@ -729,7 +917,7 @@ def write_nsd_zone(domain, zonefile, records, env, force):
 	# the keys change we force a re-generation of the zone which triggers
 	# re-signing it.
 
-	zone = """
+	header = """
 $ORIGIN {domain}.
 $TTL {ttl}          ; default time to live
 
@@ -743,17 +931,63 @@ $TTL {ttl}          ; default time to live
 """
 
 	# Replace replacement strings.
-	zone = zone.format(domain=domain,
+	header = header.format(domain=domain,
 					primary_domain=env["PRIMARY_HOSTNAME"],
 					ttl=DEFAULT_TTL)
+	keys_hash = hash_dnssec_keys(domain, env)
+
+	# Whether the zone changed is a matter of comparing the hash of what goes
+	# into it with the one of when it was last written.
+	zone_records = get_zone_records(domain, records)
+	zone_hash = hashlib.sha256(json.dumps([header, keys_hash, zone_records]).encode("utf8")).hexdigest()
+	metadata = read_zone_metadata(zonefile)
+
+	# DNSSEC requires re-signing a zone periodically. That requires
+	# bumping the serial number even if no other records have changed.
+	# sign_zone notes when the signatures it makes expire. If it hasn't
+	# (the zone was never signed, or signing it failed) or we are close
+	# to the expiration time of the signatures, we'll force a bump of the
+	# serial number so we can re-sign it.
+	force_bump = False
+	expiration_time = metadata.get("signature_expires")
+	if expiration_time is None or not os.path.exists(zonefile + ".signed"):
+		force_bump = True
+	else:
+		expiration_time = datetime.datetime.strptime(
+			expiration_time, "%Y%m%d%H%M%S")
+		if expiration_time - datetime.datetime.now() < datetime.timedelta(
+			days=3):
+			# We're within three days of the expiration, so bump serial & resign.
+			force_bump = True
+
+	# If the zone is the same as when it was last written, there is no
+	# need to update the file. Unless we're forcing a bump.
+	if metadata.get("hash") == zone_hash and os.path.exists(zonefile) and not force_bump and not force:
+		return False
+
+	# Set the serial number. If the existing serial is not less than a
+	# serial number based on the current date plus 00, increment it.
+	# Otherwise, the serial number is less than our desired new serial
+	# number so we'll use the desired new number.
+	serial = datetime.datetime.now().strftime("%Y%m%d00")
+	existing_serial = metadata.get("serial")
+	if existing_serial is None and os.path.exists(zonefile):
+		# A zone file written before we kept metadata.
+		with open(zonefile) as f:
+			m = re.search(r"(\d+)\s*;\s*serial number", f.read())
+			if m:
+				existing_serial = m.group(1)
+	if existing_serial is not None and existing_serial >= serial:
+		serial = str(int(existing_serial) + 1)
 
 	# Add records.
+	zone = [header.replace("__SERIAL__", serial)]
 	for subdomain, querytype, value, explanation, ttl in records:
 		if subdomain:
-			zone += subdomain
+			zone.append(subdomain)
 		if ttl is not None:
-			zone += "\t" + str(ttl)
-		zone += "\tIN\t" + querytype + "\t"
+			zone.append("\t" + str(ttl))
+		zone.append("\tIN\t" + querytype + "\t")
 		if querytype == "TXT":
 			# Divide into 255-byte max substrings.
 			v2 = ""
@@ -765,98 +999,71 @@ $TTL {ttl}          ; default time to live
 				s = '"' + s + '"'  # wrap in quotes
 				v2 += s + " "
 			value = v2
-		zone += value + "\n"
+		zone.append(value + "\n")
 
 	# Append a stable hash of DNSSEC signing keys in a comment.
-	zone += "\n; DNSSEC signing keys hash: {}\n".format(
-		hash_dnssec_keys(domain, env))
-
-	# DNSSEC requires re-signing a zone periodically. That requires
-	# bumping the serial number even if no other records have changed.
-	# We don't see the DNSSEC records yet, so we have to figure out
-	# if a re-signing is necessary so we can prematurely bump the
-	# serial number.
-	force_bump = False
-	if not os.path.exists(zonefile + ".signed"):
-		# No signed file yet. Shouldn't normally happen unless a box
-		# is going from not using DNSSEC to using DNSSEC.
-		force_bump = True
-	else:
-		# We've signed the domain. Check if we are close to the expiration
-		# time of the signature. If so, we'll force a bump of the serial
-		# number so we can re-sign it.
-		with open(zonefile + ".signed") as f:
-			signed_zone = f.read()
-		expiration_times = re.findall(
-			r"\sRRSIG\s+SOA\s+\d+\s+\d+\s\d+\s+(\d{14})", signed_zone)
-		if len(expiration_times) == 0:
-			# weird
-			force_bump = True
-		else:
-			# All of the times should be the same, but if not choose the soonest.
-			expiration_time = min(expiration_times)
-			expiration_time = datetime.datetime.strptime(
-				expiration_time, "%Y%m%d%H%M%S")
-			if expiration_time - datetime.datetime.now() < datetime.timedelta(
-				days=3):
-				# We're within three days of the expiration, so bump serial & resign.
-				force_bump = True
-
-	# Set the serial number.
-	serial = datetime.datetime.now().strftime("%Y%m%d00")
-	if os.path.exists(zonefile):
-		# If the zone already exists, is different, and has a later serial number,
-		# increment the number.
-		with open(zonefile) as f:
-			existing_zone = f.read()
-			m = re.search(r"(\d+)\s*;\s*serial number", existing_zone)
-			if m:
-				# Clear out the serial number in the existing zone file for the
-				# purposes of seeing if anything *else* in the zone has changed.
-				existing_serial = m.group(1)
-				existing_zone = existing_zone.replace(
-					m.group(0), "__SERIAL__     ; serial number")
-
-				# If the existing zone is the same as the new zone (modulo the serial number),
-				# there is no need to update the file. Unless we're forcing a bump.
-				if zone == existing_zone and not force_bump and not force:
-					return False
-
-				# If the existing serial is not less than a serial number
-				# based on the current date plus 00, increment it. Otherwise,
-				# the serial number is less than our desired new serial number
-				# so we'll use the desired new number.
-				if existing_serial >= serial:
-					serial = str(int(existing_serial) + 1)
-
-	zone = zone.replace("__SERIAL__", serial)
+	zone.append("\n; DNSSEC signing keys hash: {}\n".format(keys_hash))
 
 	# Write the zone file.
 	with open(zonefile, "w") as f:
-		f.write(zone)
+		f.write("".join(zone))
+
+	# Note what changed. The zone is to be signed now, until then it has no
+	# signatures that we know of.
+	old_records = set(ZoneRecord(*record) for record in metadata.get("records", []))
+	write_zone_metadata(zonefile, {
+		"hash": zone_hash,
+		"serial": serial,
+		"records": zone_records,
+		"changes": {
+			"updated": datetime.datetime.now().isoformat(timespec="seconds"),
+			"serial": serial,
+			"previous_serial": existing_serial,
+			"added": [record for record in zone_records if record not in old_records],
+			"removed": sorted(old_records - set(zone_records)),
+		},
+		"signature_expires": None,
+	})
 
 	return True  # file is updated
 
 
 def get_dns_zonefile(zone, env):
-	for domain, fn in get_dns_zones(env):
-		if zone == domain:
-			break
-	else:
-		raise ValueError(
-			"%s is not a domain name that corresponds to a zone." % zone)
-
-	nsd_zonefile = "/etc/nsd/zones/" + fn
+	nsd_zonefile = os.path.join(NSD_ZONES_DIR, get_zonefile_name(zone, env))
 	with open(nsd_zonefile, "r") as f:
 		return f.read()
 
 
+def get_zonefile_name(zone, env):
+	for domain, fn in get_dns_zones(env):
+		if zone == domain:
+			return fn
+	raise ValueError(
+		"%s is not a domain name that corresponds to a zone." % zone)
+
+
+def get_dns_zone_changes(zone, env):
+	# Returns what changed in the zone the last time it was written, record
+	# by record, and when its signatures expire.
+	metadata = read_zone_metadata(os.path.join(NSD_ZONES_DIR, get_zonefile_name(zone, env)))
+	changes = metadata.get("changes", {})
+	return {
+		"zone": zone,
+		"serial": metadata.get("serial"),
+		"signature_expires": metadata.get("signature_expires"),
+		"updated": changes.get("updated"),
+		"previous_serial": changes.get("previous_serial"),
+		"added": [ZoneRecord(*record)._asdict() for record in changes.get("added", [])],
+		"removed": [ZoneRecord(*record)._asdict() for record in changes.get("removed", [])],
+	}
+
+
 ########################################################################
 
 
 def write_nsd_conf(zonefiles, additional_records, env):
 	# Write the list of zones to a configuration file.
-	nsd_conf_file = "/etc/nsd/nsd.conf.d/zones.conf"
+	nsd_conf_file = NSD_CONF_FILE
 	nsdconf = ""
 
 	# Append the zones.
@@ -891,86 +1098,166 @@ zone:
 ########################################################################
 
 
-def find_dnssec_signing_keys(domain, env):
-	# For key that we generated (one per algorithm)...
-	d = os.path.join(env['STORAGE_ROOT'], 'dns/dnssec')
-	keyconfs = [f for f in os.listdir(d) if f.endswith(".conf")]
-	for keyconf in keyconfs:
-		# Load the file holding the KSK and ZSK key filenames.
-		keyconf_fn = os.path.join(d, keyconf)
-		keyinfo = load_env_vars_from_file(keyconf_fn)
-
-		# Skip this key if the conf file has a setting named DOMAINS,
-		# holding a comma-separated list of domain names, and if this
-		# domain is not in the list. This allows easily disabling a
-		# key by setting "DOMAINS=" or "DOMAINS=none", other than
-		# deleting the key's .conf file, which might result in the key
-		# being regenerated next upgrade. Keys should be disabled if
-		# they are not needed to reduce the DNSSEC query response size.
-		if "DOMAINS" in keyinfo and domain not in [
-			dd.strip() for dd in keyinfo["DOMAINS"].split(",")
-		]:
-			continue
+class DnssecKeystore:
+	# The DNSSEC keys generated during setup (in STORAGE_ROOT/dns/dnssec), read
+	# and hashed once rather than for each zone. The keys are for the domain
+	# _domain_, so for signing a zone they are patched with its domain name.
+	# The patched keys are kept in a directory that only we (root) can read, in
+	# memory (/dev/shm) if possible, and reused until the keys change. Get it
+	# with get_dnssec_keystore.
+
+	def __init__(self, directory, version):
+		self.directory = directory
+		self.version = version
+
+		# For key that we generated (one per algorithm)...
+		self.keys = []  # (DOMAINS setting or None, keytype, key filename)
+		self.keydata = {}  # key filename + extension => contents
+		for keyconf in sorted(f for f in os.listdir(directory) if f.endswith(".conf")):
+			# Load the file holding the KSK and ZSK key filenames.
+			keyinfo = load_env_vars_from_file(os.path.join(directory, keyconf))
+
+			# The conf file may have a setting named DOMAINS, holding a
+			# comma-separated list of domain names that the key is used for.
+			# This allows easily disabling a key by setting "DOMAINS=" or
+			# "DOMAINS=none", other than deleting the key's .conf file, which
+			# might result in the key being regenerated next upgrade. Keys should
+			# be disabled if they are not needed to reduce the DNSSEC query
+			# response size.
+			domains = None
+			if "DOMAINS" in keyinfo:
+				domains = set(dd.strip() for dd in keyinfo["DOMAINS"].split(","))
+
+			for keytype in ("KSK", "ZSK"):
+				keyfn = keyinfo[keytype]
+				self.keys.append((domains, keytype, keyfn))
+				for ext in (".private", ".key"):
+					with open(os.path.join(directory, keyfn + ext), "r") as fr:
+						self.keydata[keyfn + ext] = fr.read()
+
+		self.hashes = {}  # set of key filenames => hash
+		self.patched_dir = None
+		self.patched = {}  # domain => patched key filename bases
+		self.lock = threading.Lock()
+
+	def signing_keys(self, domain):
+		# Returns the (keytype, key filename) of the keys to sign a domain with.
+		return [(keytype, keyfn) for domains, keytype, keyfn in self.keys
+				if domains is None or domain in domains]
+
+	def hash(self, domain):
+		# Create a stable (by sorting the items) hash of all of the private keys
+		# that will be used to sign this domain.
+		keys = tuple(sorted(self.signing_keys(domain)))
+		if keys not in self.hashes:
+			keydata = []
+			for keytype, keyfn in keys:
+				keydata.append(keytype)
+				keydata.append(keyfn)
+				keydata.append(self.keydata[keyfn + ".private"])
+			self.hashes[keys] = hashlib.sha1("".join(keydata).encode("utf8")).hexdigest()
+		return self.hashes[keys]
+
+	def patched_keys(self, domain):
+		# Returns the filenames (without extension) of the keys patched for
+		# domain, writing them the first time. ldns-signzone takes these.
+		with self.lock:
+			if self.patched_dir is not None and not os.path.isdir(self.patched_dir):
+				# The directory was removed, e.g. by a cleanup of /dev/shm.
+				self.patched_dir = None
+				self.patched = {}
+			if domain not in self.patched:
+				if self.patched_dir is None:
+					# mkdtemp creates a directory only we can read.
+					self.patched_dir = tempfile.mkdtemp(
+						prefix="mailinabox-dnssec-",
+						dir="/dev/shm" if os.path.isdir("/dev/shm") else None)
+				patched = []
+				for keytype, keyfn in self.signing_keys(domain):
+					newkeyfn = os.path.join(self.patched_dir, keyfn.replace("_domain_", domain))
+					for ext in (".private", ".key"):
+						with os.fdopen(os.open(newkeyfn + ext, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "w") as fw:
+							fw.write(self.keydata[keyfn + ext].replace("_domain_", domain))
+					patched.append(newkeyfn)
+				self.patched[domain] = patched
+			return self.patched[domain]
+
+	def ksk_key_data(self, domain):
+		# Returns the contents of the .key files of the key-signing keys for domain.
+		return [self.keydata[keyfn + ".key"].replace("_domain_", domain)
+				for keytype, keyfn in self.signing_keys(domain) if keytype == "KSK"]
+
+	def close(self):
+		# Removes the patched keys.
+		with self.lock:
+			if self.patched_dir is not None:
+				shutil.rmtree(self.patched_dir, ignore_errors=True)
+				self.patched_dir = None
+				self.patched = {}
+
+
+# The DnssecKeystore, by the directory of the keys
+dnssec_keystores = {}
+dnssec_keystores_lock = threading.Lock()
+
+
+def get_dnssec_keystore(env):
+	# Returns the DnssecKeystore, which is only read again once a key file changed.
+	directory = os.path.join(env['STORAGE_ROOT'], 'dns/dnssec')
+	with os.scandir(directory) as entries:
+		version = sorted((entry.name, entry.stat().st_mtime_ns, entry.stat().st_size) for entry in entries)
+	with dnssec_keystores_lock:
+		keystore = dnssec_keystores.get(directory)
+		if keystore is None or keystore.version != version:
+			if keystore is not None:
+				keystore.close()
+			keystore = dnssec_keystores[directory] = DnssecKeystore(directory, version)
+	return keystore
+
+
+@atexit.register
+def close_dnssec_keystores():
+	for keystore in dnssec_keystores.values():
+		keystore.close()
+
 
-		for keytype in ("KSK", "ZSK"):
-			yield keytype, keyinfo[keytype]
+def find_dnssec_signing_keys(domain, env):
+	return get_dnssec_keystore(env).signing_keys(domain)
 
 
 def hash_dnssec_keys(domain, env):
-	# Create a stable (by sorting the items) hash of all of the private keys
-	# that will be used to sign this domain.
-	keydata = []
-	for keytype, keyfn in sorted(find_dnssec_signing_keys(domain, env)):
-		oldkeyfn = os.path.join(env['STORAGE_ROOT'], 'dns/dnssec',
-								keyfn + ".private")
-		keydata.append(keytype)
-		keydata.append(keyfn)
-		with open(oldkeyfn, "r") as fr:
-			keydata.append(fr.read())
-	keydata = "".join(keydata).encode("utf8")
-	return hashlib.sha1(keydata).hexdigest()
-
-
-def sign_zone(domain, zonefile, env):
+	return get_dnssec_keystore(env).hash(domain)
+
+
+def sign_zones(zones, env):
+	# Signs the zones, given as (domain, zonefile) tuples, a few at a time. A zone
+	# is signed on its own, so they don't have to wait for each other. Returns
+	# how long it took to sign each zone, as (domain, seconds) tuples.
+	keystore = get_dnssec_keystore(env)
+
+	def sign(zone):
+		start = time.perf_counter()
+		sign_zone(zone[0], zone[1], env, keystore)
+		return (zone[0], time.perf_counter() - start)
+
+	if len(zones) <= 1:
+		return [sign(zone) for zone in zones]
+	with ThreadPool(min(SIGNING_WORKERS, len(zones))) as pool:
+		return pool.map(sign, zones)
+
+
+def sign_zone(domain, zonefile, env, keystore=None):
 	# Sign the zone with all of the keys that were generated during
 	# setup so that the user can choose which to use in their DS record at
 	# their registrar, and also to support migration to newer algorithms.
 
 	# In order to use the key files generated at setup which are for
 	# the domain _domain_, we have to re-write the files and place
-	# the actual domain name in it, so that ldns-signzone works.
-	#
-	# Patch each key, storing the patched version in /tmp for now.
-	# Each key has a .key and .private file. Collect a list of filenames
-	# for all of the keys (and separately just the key-signing keys).
-	all_keys = []
-	ksk_keys = []
-	for keytype, keyfn in find_dnssec_signing_keys(domain, env):
-		newkeyfn = '/tmp/' + keyfn.replace("_domain_", domain)
-
-		for ext in (".private", ".key"):
-			# Copy the .key and .private files to /tmp to patch them up.
-			#
-			# Use os.umask and open().write() to securely create a copy that only
-			# we (root) can read.
-			oldkeyfn = os.path.join(env['STORAGE_ROOT'], 'dns/dnssec',
-									keyfn + ext)
-			with open(oldkeyfn, "r") as fr:
-				keydata = fr.read()
-			keydata = keydata.replace("_domain_", domain)
-			# ensure written file is not world-readable
-			prev_umask = os.umask(0o77)
-			try:
-				with open(newkeyfn + ext, "w") as fw:
-					fw.write(keydata)
-			finally:
-				# other files we write should be world-readable
-				os.umask(prev_umask)
-
-		# Put the patched key filename base (without extension) into the list of keys we'll sign with.
-		all_keys.append(newkeyfn)
-		if keytype == "KSK":
-			ksk_keys.append(newkeyfn)
+	# the actual domain name in it, so that ldns-signzone works. The
+	# keystore does that once for each domain.
+	if keystore is None:
+		keystore = get_dnssec_keystore(env)
+	all_keys = keystore.patched_keys(domain)
 
 	# Do the signing.
 	expiry_date = (datetime.datetime.now() +
@@ -978,7 +1265,7 @@ def sign_zone(domain, zonefile, env):
 	shell(
 		'check_call',
 		[
-			"/usr/bin/ldns-signzone",
+			LDNS_SIGNZONE,
 			# expire the zone after 30 days
 			"-e",
 			expiry_date,
@@ -987,11 +1274,16 @@ def sign_zone(domain, zonefile, env):
 			"-n",
 
 			# zonefile to sign
-			"/etc/nsd/zones/" + zonefile,
+			os.path.join(NSD_ZONES_DIR, zonefile),
 		]
 		# keys to sign with (order doesn't matter -- it'll figure it out)
 		+ all_keys)
 
+	# Note when the signatures expire, for write_nsd_zone.
+	metadata = read_zone_metadata(os.path.join(NSD_ZONES_DIR, zonefile))
+	metadata["signature_expires"] = expiry_date + "000000"
+	write_zone_metadata(os.path.join(NSD_ZONES_DIR, zonefile), metadata)
+
 	# Create a DS record based on the patched-up key files. The DS record is specific to the
 	# zone being signed, so we can't use the .ds files generated when we created the keys.
 	# The DS record points to the KSK only. Write this next to the zone file so we can
@@ -1001,23 +1293,39 @@ def sign_zone(domain, zonefile, env):
 	# be used, so we'll pre-generate all for each key. One DS record per line. Only one
 	# needs to actually be deployed at the registrar. We'll select the preferred one
 	# in the status checks.
-	with open("/etc/nsd/zones/" + zonefile + ".ds", "w") as f:
-		for key in ksk_keys:
-			for digest_type in ('1', '2', '4'):
-				rr_ds = shell(
-					'check_output',
-					[
-						"/usr/bin/ldns-key2ds",
-						"-n",  # output to stdout
-						"-" + digest_type,  # 1=SHA1, 2=SHA256, 4=SHA384
-						key + ".key"
-					])
+	with open(os.path.join(NSD_ZONES_DIR, zonefile + ".ds"), "w") as f:
+		for keydata in keystore.ksk_key_data(domain):
+			for rr_ds in make_ds_records(domain, keydata):
 				f.write(rr_ds)
 
-	# Remove the temporary patched key files.
-	for fn in all_keys:
-		os.unlink(fn + ".private")
-		os.unlink(fn + ".key")
+
+def make_ds_records(domain, keydata):
+	# Returns the DS records for the DNSKEY record in a .key file, with a SHA-1,
+	# a SHA-256 and a SHA-384 digest (RFC 4034 section 5), written the same
+	# way as by `ldns-key2ds -n`, which we used to run for each of them.
+	for line in keydata.splitlines():
+		fields = line.split(";", 1)[0].split()
+		if "DNSKEY" in fields:
+			break
+	else:
+		raise ValueError("There is no DNSKEY record in the key file.")
+	i = fields.index("DNSKEY")
+	ttl = next((int(f) for f in fields[1:i] if f.isdigit()), 3600)
+	algorithm = int(fields[i + 3])
+	rdata = struct.pack("!HBB", int(fields[i + 1]), int(fields[i + 2]), algorithm) \
+		+ base64.b64decode("".join(fields[i + 4:]))
+
+	# The key tag (RFC 4034 appendix B).
+	keytag = sum(b << 8 if j % 2 == 0 else b for j, b in enumerate(rdata))
+	keytag = (keytag + (keytag >> 16)) & 0xFFFF
+
+	# The digest is over the owner name in wire format, and the DNSKEY RDATA.
+	owner = b"".join(
+		bytes([len(label)]) + label for label in domain.lower().encode("ascii").split(b".") if label
+	) + b"\0"
+	for digest_type, digest in ((1, hashlib.sha1), (2, hashlib.sha256), (4, hashlib.sha384)):
+		yield "%s.\t%d\tIN\tDS\t%d %d %d %s\n" % (
+			domain, ttl, keytag, algorithm, digest_type, digest(owner + rdata).hexdigest())
 
 
 ########################################################################
@@ -0,0 +1,142 @@
+#!/usr/local/lib/mailinabox/env/bin/python
+#
+# Asks Dovecot to recalculate users' quotas, e.g. after their quota was
+# changed. This goes through the doveadm HTTP API that setup/mail-dovecot.sh
+# enables on localhost, many users per request over one connection, rather
+# than by running `doveadm quota recalc` for each user. Where the API isn't
+# set up (yet), doveadm is run for each user as before.
+#
+# recalc_later returns right away and leaves the work to a background
+# thread, which takes all of the users that were queued up in the meantime.
+# Users whose quota couldn't be recalculated are logged.
+
+import base64
+import http.client
+import json
+import logging
+import subprocess
+import threading
+from urllib.parse import urlsplit
+
+API_URL = "http://127.0.0.1:10030/doveadm/v1"
+API_KEY_FILE = "/var/lib/mailinabox/doveadm-api.key"
+TIMEOUT = 60
+
+# How many users to recalculate the quota of per request
+BATCH_SIZE = 100
+
+# The users waiting for the background thread, which wakes up on changed
+changed = threading.Condition()
+pending = []
+worker = None
+
+# The connection to the API, reused between requests
+connection = None
+
+log = logging.getLogger(__name__)
+
+
+class DoveadmError(Exception):
+	pass
+
+
+def get_api_key():
+	try:
+		with open(API_KEY_FILE) as f:
+			return f.read().strip()
+	except OSError:
+		return None
+
+
+def call(commands, api_key):
+	# Runs doveadm commands, given as (command, parameters) tuples, in one request.
+	# Returns the responses, in order: (True, result) if the command succeeded,
+	# otherwise (False, error).
+	global connection
+	url = urlsplit(API_URL)
+	body = json.dumps([[command, parameters, str(i)]
+					for i, (command, parameters) in enumerate(commands)])
+	headers = {
+		"Content-Type": "application/json",
+		"Authorization": "X-Dovecot-API " + base64.b64encode(api_key.encode("utf8")).decode("ascii"),
+	}
+
+	# A connection that was kept open may have been closed by Dovecot since, so
+	# try again on a new connection once.
+	for attempt in range(2):
+		if connection is None:
+			connection = http.client.HTTPConnection(url.hostname, url.port, timeout=TIMEOUT)
+		try:
+			connection.request("POST", url.path, body, headers)
+			response = connection.getresponse()
+			data = response.read()
+			break
+		except (OSError, http.client.HTTPException):
+			connection.close()
+			connection = None
+			if attempt == 1:
+				raise
+	if response.status != 200:
+		raise DoveadmError("doveadm HTTP API returned %d %s" % (response.status, response.reason))
+
+	results = [None] * len(commands)
+	for kind, result, tag in json.loads(data):
+		results[int(tag)] = (kind == "doveadmResponse", result)
+	return results
+
+
+def recalc(emails):
+	# Recalculates the quotas of the users right away. Returns the users for
+	# which that failed, with the error, and logs them.
+	failed = recalc_users(emails)
+	for email, error in failed.items():
+		log.error("Recalculating the quota of %s failed with exit code %s", email,
+			error.get("exitCode", "unknown"))
+	return failed
+
+
+def recalc_users(emails):
+	failed = {}
+	api_key = get_api_key()
+	if api_key is not None:
+		try:
+			for i in range(0, len(emails), BATCH_SIZE):
+				batch = emails[i:i + BATCH_SIZE]
+				for email, (ok, result) in zip(batch, call([("quotaRecalc", {"user": email}) for email in batch], api_key)):
+					if not ok:
+						failed[email] = result
+			return failed
+		except (OSError, http.client.HTTPException, ValueError, DoveadmError):
+			# Fall back to running doveadm for the users that are left.
+			emails = emails[i:]
+
+	for email in emails:
+		# force dovecot to recalculate the quota info for the user.
+		code = subprocess.call(["doveadm", "quota", "recalc", "-u", email])
+		if code != 0:
+			failed[email] = {"exitCode": code}
+	return failed
+
+
+def recalc_later(emails):
+	# Recalculates the quotas of the users in the background.
+	global worker
+	with changed:
+		if worker is None or not worker.is_alive():
+			worker = threading.Thread(target=run_recalc, name="quota-recalc", daemon=True)
+			worker.start()
+		pending.extend(emails)
+		changed.notify()
+
+
+def run_recalc():
+	while True:
+		with changed:
+			while not pending:
+				changed.wait()
+			emails = list(dict.fromkeys(pending))  # unique, in order
+			pending.clear()
+		try:
+			recalc(emails)
+		except Exception:
+			log.exception("Recalculating the quotas of %s failed", ", ".join(emails))
@@ -1,13 +1,19 @@
 #!/usr/local/lib/mailinabox/env/bin/python
 import argparse
 import datetime
+import fcntl
+import functools
 import gzip
+import json
+import multiprocessing
 import os.path
 import re
-import shutil
-import tempfile
+import sqlite3
+import sys
 import textwrap
-from collections import defaultdict, OrderedDict
+import zlib
+from array import array
+from collections import defaultdict, deque, namedtuple, OrderedDict
 
 import dateutil.parser
 import time
@@ -58,25 +64,75 @@ SCAN_DOVECOT_LOGIN = True  # Dovecot Logins
 SCAN_GREY = False  # Greylisted email
 SCAN_BLOCKED = False  # Rejected email
 
+# Scan the most recent lines first and stop once START_DATE is passed
+NEWEST_FIRST = False
+
+# Number of the most recent blocked and greylisted emails kept per user. Older ones are only counted.
+KEEP = 100
+
+# Number of the most frequently blocked senders and greylisted hosts counted exactly
+TOP_SIZE = 100
+
+# Regular expressions used to parse the log lines, compiled once
+
+# Syslog prefix: date, host, service and the rest of the line
+LOG_LINE_RE = re.compile(r"(\w+[\s]+\d+ \d+:\d+:\d+) ([\w]+ )?([\w\-/]+)[^:]*: (.*)")
+
+POSTGREY_RE = re.compile(
+	r"action=(greylist|pass), reason=(.*?), (?:delay=\d+, )?client_name=(.*), "
+	r"client_address=(.*), sender=(.*), recipient=(.*)")
+SMTPD_REJECT_RE = re.compile(r"NOQUEUE: reject: RCPT from .*?: (.*?); from=<(.*?)> to=<(.*?)>")
+ZEN_SPAMHAUS_RE = re.compile(r"Client host \[(.*?)\] blocked using zen.spamhaus.org; (.*)")
+DBL_SPAMHAUS_RE = re.compile(r"Sender address \[.*@(.*)\] blocked using dbl.spamhaus.org; (.*)")
+DOVECOT_LOGIN_RE = re.compile(r"Info: Login: user=<(.*?)>, method=PLAIN, rip=(.*?),")
+LMTP_RE = re.compile(r"([A-Z0-9]+): to=<(\S+)>, .* Saved")
+SUBMISSION_RE = re.compile(
+	r"([A-Z0-9]+): client=(\S+), sasl_method=(PLAIN|LOGIN), sasl_username=(\S+)(?<!,)")
+
+# Services whose lines hold nothing of interest
+IGNORED_SERVICES = frozenset(
+	("postfix/qmgr", "postfix/pickup", "postfix/cleanup", "postfix/scache", "spampd",
+	"postfix/anvil", "postfix/master", "opendkim", "postfix/tlsmgr", "anvil"))
+
+# Report from the persistent index (see update_index) instead of scanning the log files
+USE_INDEX = False
+
+# Number of processes to scan the log files with, and the smallest part of a file a process is
+# given to scan (see scan_files_parallel)
+JOBS = 1
+MIN_SHARD_SIZE = 1 << 20
+
+# What a scan looks for, and in which time span. The collectors carry their scan's settings (see
+# new_collector), so that callers other than the command line, like the management daemon, don't
+# have to change the globals above.
+ScanSettings = namedtuple("ScanSettings", ("start", "end", "now", "filters", "sent", "received",
+	"logins", "grey", "blocked", "newest_first", "keep"))
+
+
+def default_settings():
+	""" The scan settings of the globals above, as set from the command line """
+	return ScanSettings(start=START_DATE, end=END_DATE, now=NOW, filters=FILTERS, sent=SCAN_OUT,
+		received=SCAN_IN, logins=SCAN_DOVECOT_LOGIN, grey=SCAN_GREY, blocked=SCAN_BLOCKED,
+		newest_first=NEWEST_FIRST, keep=KEEP)
+
 
 def scan_files(collector):
 	""" Scan files until they run out or the earliest date is reached """
 
 	stop_scan = False
+	start = collector["settings"].start.timestamp()
 
 	for fn in LOG_FILES:
 
-		tmp_file = None
-
 		if not os.path.exists(fn):
 			continue
-		elif fn[-3:] == '.gz':
-			tmp_file = tempfile.NamedTemporaryFile()
-			shutil.copyfileobj(gzip.open(fn), tmp_file)
+		elif os.path.getmtime(fn) < start:
+			# The file was last written to before the start of the time span,
+			# so none of its lines can be in range. Don't bother opening it.
+			continue
 
 		if VERBOSE:
 			print("Processing file", fn, "...")
-		fn = tmp_file.name if tmp_file else fn
 
 		for line in readline(fn):
 			if scan_mail_log_line(line.strip(), collector) is False:
@@ -87,17 +143,347 @@ def scan_files(collector):
 				stop_scan = False
 
 
-def scan_mail_log(env):
-	""" Scan the system's mail log files and collect interesting data
+def scan_files_reverse(collector):
+	""" Scan files newest line first until they run out or the earliest date is reached
 
-	This function scans the 2 most recent mail log files in /var/log/.
+	Uncompressed files are read backwards from their end, so for short time spans only the tail of
+	the current log file is ever read. Compressed files can't be read backwards, so those are still
+	scanned in full, but older files aren't opened once a line before the start of the time span has
+	been seen.
+	"""
 
-	Args:
-		env (dict): Dictionary containing MiaB settings
+	stop_scan = False
+	start = collector["settings"].start.timestamp()
+
+	for fn in reversed(LOG_FILES):
+
+		if not os.path.exists(fn):
+			continue
+		elif os.path.getmtime(fn) < start:
+			# This file, and all of the older ones, were last written to before the start of the
+			# time span.
+			return
+
+		if VERBOSE:
+			print("Processing file", fn, "...")
+
+		if fn[-3:] == '.gz':
+			reached_start = False
+			for line in readline(fn):
+				if scan_mail_log_line(line.strip(), collector) is None:
+					reached_start = True
+			if reached_start:
+				return
+			continue
 
+		for line in readline_reverse(fn):
+			if scan_mail_log_line(line.strip(), collector) is None:
+				if stop_scan:
+					return
+				stop_scan = True
+			else:
+				stop_scan = False
+
+
+def scan_files_parallel(collector):
+	""" Scan files in JOBS parallel processes
+
+	The files are split into shards of about the same size on line boundaries, compressed files by
+	their uncompressed size. Each shard is scanned into its own collector and the partial collectors
+	are merged in chronological order, so the result is the same as a serial scan. Like the serial
+	scan, a shard stops at the end of the time span, and the shards after it aren't merged.
+	"""
+
+	shards = []
+	start = collector["settings"].start.timestamp()
+
+	for fn in LOG_FILES:
+		if not os.path.exists(fn) or os.path.getmtime(fn) < start:
+			continue
+		shards.extend((fn, start, end) for start, end in split_file(fn, JOBS))
+
+	scan = functools.partial(scan_shard, settings=collector["settings"],
+		known_addresses=collector["known_addresses"])
+	with multiprocessing.Pool(JOBS) as pool:
+		for part, reached_end in pool.imap(scan, shards):
+			merge_collectors(collector, part)
+			if reached_end:
+				# Leaving the block terminates the shards that are still being scanned
+				break
+
+
+def split_file(filename, parts):
+	""" Split a file in up to the given number of (start, end) byte ranges
+
+	The ranges are of the uncompressed file, and the last one runs to the end of the file. The
+	lines are assigned to the ranges by scan_shard.
+	"""
+	if filename[-3:] == '.gz':
+		# A gzip file ends with its uncompressed size (modulo 4 GB)
+		with open(filename, 'rb') as file:
+			file.seek(-4, os.SEEK_END)
+			size = int.from_bytes(file.read(4), 'little')
+	else:
+		size = os.path.getsize(filename)
+	chunk = max(size // parts + 1, MIN_SHARD_SIZE)
+	boundaries = list(range(0, size, chunk)) or [0]
+	return list(zip(boundaries, boundaries[1:] + [None]))
+
+
+def scan_shard(shard, settings, known_addresses=None):
+	""" Scan the lines of a shard (see scan_files_parallel) into a new collector
+
+	A shard gets the lines that start within its byte range. Returns the collector and whether the
+	scan stopped at the end of the time span.
 	"""
+	filename, start, end = shard
+	collector = new_collector(settings)
+	collector["known_addresses"] = known_addresses
+	stop_scan = False
+	with open_log(filename) as file:
+		if start > 0:
+			# The line that runs into the range belongs to the shard before
+			file.seek(start - 1)
+			file.readline()
+		position = file.tell()
+		for line in file:
+			if end is not None and position >= end:
+				break
+			position += len(line)
+			if scan_mail_log_line(line.decode(errors='replace').strip(), collector) is False:
+				if stop_scan:
+					return collector, True
+				stop_scan = True
+			else:
+				stop_scan = False
+	return collector, False
+
+
+def merge_collectors(collector, part):
+	""" Merge the collector of a later part of the log into the collector of an earlier part """
+
+	collector["scan_count"] += part["scan_count"]
+	collector["parse_count"] += part["parse_count"]
+	collector["other-services"] |= part["other-services"]
+
+	for kind in ("sent_mail", "received_mail", "logins"):
+		for user, part_data in part[kind].items():
+			if user in collector[kind]:
+				collector[kind][user].merge(part_data)
+			else:
+				collector[kind][user] = part_data
+
+	for user, part_rep in part["postgrey"].items():
+		rep = collector["postgrey"].setdefault(user, OrderedDict())
+		for key, (first_date, delivered_date) in part_rep.items():
+			# The later part wins, as if its lines were scanned after the earlier part's
+			if key in rep:
+				first_date = first_date or rep[key][0]
+				delivered_date = delivered_date or rep[key][1]
+			keep_greylisted(rep, key, (first_date, delivered_date), collector["settings"])
+
+	for user, part_data in part["rejected"].items():
+		if user not in collector["rejected"]:
+			collector["rejected"][user] = part_data
+			continue
+		data = collector["rejected"][user]
+		data["count"] += part_data["count"]
+		data["blocked"].extend(part_data["blocked"])
+		update_timespan(data, part_data["earliest"])
+		update_timespan(data, part_data["latest"])
+
+	collector["greylisted_hosts"].merge(part["greylisted_hosts"])
+	collector["blocked_senders"].merge(part["blocked_senders"])
+
 
-	collector = {
+# Records of the collected data
+#
+# There is one record per user and kind of activity, so they are kept compact for boxes with
+# thousands of users: times are epoch seconds instead of datetime objects, the activity by hour of
+# the day is an array of 24 counters instead of a dict, and protocol names and hosts are interned.
+
+
+class Record:
+	""" Base class of the records, which compare by value """
+	__slots__ = ()
+
+	def values(self):
+		return [
+			getattr(self, name) for cls in type(self).__mro__
+			for name in getattr(cls, "__slots__", ())
+		]
+
+	def __eq__(self, other):
+		return type(self) is type(other) and self.values() == other.values()
+
+
+class Activity(Record):
+	""" How often and when a user did something, e.g. receive email """
+	__slots__ = ("count", "earliest", "latest", "by_hour")
+
+	def __init__(self):
+		self.count = 0
+		self.earliest = None
+		self.latest = None
+		self.by_hour = array('I', [0]) * 24
+
+	def add(self, timestamp, hour, count=1):
+		self.count += count
+		self.by_hour[hour] += count
+		self.widen(timestamp, timestamp)
+
+	def widen(self, earliest, latest):
+		# Lines aren't necessarily scanned in chronological order (see scan_files_reverse), so the
+		# first time seen isn't assumed to be the earliest.
+		if self.earliest is None or earliest < self.earliest:
+			self.earliest = earliest
+		if self.latest is None or latest > self.latest:
+			self.latest = latest
+
+	def merge(self, other):
+		self.count += other.count
+		for h in range(24):
+			self.by_hour[h] += other.by_hour[h]
+		self.widen(other.earliest, other.latest)
+
+
+class SentMail(Activity):
+	""" The email sent by a user, and the hosts it was sent from """
+	__slots__ = ("hosts", )
+
+	def __init__(self):
+		super().__init__()
+		self.hosts = set()
+
+	def merge(self, other):
+		super().merge(other)
+		self.hosts |= other.hosts
+
+
+class Logins(Record):
+	""" A user's logins by protocol, and by protocol and host """
+	__slots__ = ("by_protocol", "by_protocol_and_host")
+
+	def __init__(self):
+		self.by_protocol = {}
+		self.by_protocol_and_host = {}
+
+	@property
+	def earliest(self):
+		return min(a.earliest for a in self.by_protocol.values())
+
+	@property
+	def latest(self):
+		return max(a.latest for a in self.by_protocol.values())
+
+	def protocol(self, protocol_name):
+		return self.by_protocol.get(protocol_name, NO_ACTIVITY)
+
+	def add(self, protocol_name, host, timestamp, hour, count=1):
+		activity = self.by_protocol.get(protocol_name)
+		if activity is None:
+			activity = self.by_protocol[protocol_name] = Activity()
+		activity.add(timestamp, hour, count)
+		key = (protocol_name, host)
+		self.by_protocol_and_host[key] = self.by_protocol_and_host.get(key, 0) + count
+
+	def merge(self, other):
+		for protocol_name, activity in other.by_protocol.items():
+			if protocol_name in self.by_protocol:
+				self.by_protocol[protocol_name].merge(activity)
+			else:
+				self.by_protocol[protocol_name] = activity
+		for key, count in other.by_protocol_and_host.items():
+			self.by_protocol_and_host[key] = self.by_protocol_and_host.get(key, 0) + count
+
+
+# Stands in for the activity of protocols a user didn't log in with. Never modified.
+NO_ACTIVITY = Activity()
+
+
+class TopCounter(Record):
+	""" Counts the most frequent keys of a stream, e.g. the senders of blocked email, in bounded memory
+
+	All keys are counted approximately in a count-min sketch. The most frequent ones are also kept
+	with a count of their own, which is exact if they were kept since they were first seen and an
+	upper bound otherwise. The keys kept are the first ones seen until there are `size` of them,
+	after which a key replaces the least frequent one once its sketch count is higher.
+	"""
+	__slots__ = ("size", "top", "floor", "sketch")
+
+	WIDTH = 8192
+	DEPTH = 4
+
+	def __init__(self, size=TOP_SIZE):
+		self.size = size
+		self.top = {}  # key -> [count, error]
+		self.floor = 0  # no kept count is lower than this
+		self.sketch = array('I', [0]) * (self.WIDTH * self.DEPTH)
+
+	def cells(self, key):
+		# Python's hash() of strings differs between processes, so the parallel shards (see
+		# scan_files_parallel) couldn't merge their sketches.
+		data = key.encode("utf8", "surrogateescape")
+		h1 = zlib.crc32(data)
+		h2 = zlib.adler32(data) | 1
+		return [row * self.WIDTH + (h1 + row * h2) % self.WIDTH for row in range(self.DEPTH)]
+
+	def estimate(self, key):
+		return min(self.sketch[cell] for cell in self.cells(key))
+
+	def add(self, key, count=1):
+		sketch = self.sketch
+		cells = self.cells(key)
+		for cell in cells:
+			sketch[cell] += count
+		estimate = min(sketch[cell] for cell in cells)
+
+		entry = self.top.get(key)
+		if entry is not None:
+			entry[0] += count
+		elif len(self.top) < self.size:
+			# Nothing was ever dropped, so this is the first time the key is seen
+			self.top[key] = [count, 0]
+		elif estimate > self.floor:
+			least = min(self.top, key=lambda k: self.top[k][0])
+			self.floor = self.top[least][0]
+			if estimate > self.floor:
+				del self.top[least]
+				self.top[key] = [estimate, estimate - count]
+
+	def merge(self, other):
+		counts = {}
+		for key in self.top.keys() | other.top.keys():
+			count = error = 0
+			for part in (self, other):
+				entry = part.top.get(key)
+				if entry is not None:
+					count += entry[0]
+					error += entry[1]
+				elif len(part.top) == part.size:
+					# Otherwise the part never saw the key
+					estimate = part.estimate(key)
+					count += estimate
+					error += estimate
+			counts[key] = [count, error]
+
+		self.top = dict(sorted(counts.items(), key=lambda kv: -kv[1][0])[:self.size])
+		self.floor = 0
+		self.sketch = array('I', map(int.__add__, self.sketch, other.sketch))
+
+	def most_common(self, n):
+		""" The n most frequent keys, as (key, count, whether the count is exact) """
+		return [(key, count, error == 0) for key, (count, error) in sorted(
+			self.top.items(), key=lambda kv: (-kv[1][0], kv[0]))[:n]]
+
+
+def new_collector(settings=None):
+	""" Create an empty collector for the data gathered from the log lines
+
+	The settings (a ScanSettings) default to those of the command line.
+	"""
+	return {
+		"settings": settings or default_settings(),  # What is scanned for, and when
 		"scan_count": 0,  # Number of lines scanned
 		"parse_count":
 		0,  # Number of lines parsed (i.e. that had their contents examined)
@@ -107,239 +493,424 @@ def scan_mail_log(env):
 		"logins": OrderedDict(),  # Data about login activity
 		"postgrey": {},  # Data about greylisting of email addresses
 		"rejected": OrderedDict(),  # Emails that were blocked
+		"greylisted_hosts": TopCounter(),  # The hosts greylisting applied to most
+		"blocked_senders": TopCounter(),  # The senders of the most blocked emails
 		"known_addresses": None,  # Addresses handled by the Miab installation
 		"other-services": set(),
 	}
 
-	try:
-		import mailconfig
-		collector["known_addresses"] = (
-			set(mailconfig.get_mail_users(env))
-			| set(alias[0] for alias in mailconfig.get_mail_aliases(env)))
-	except ImportError:
-		pass
 
-	print("Scanning logs from {:%Y-%m-%d %H:%M:%S} to {:%Y-%m-%d %H:%M:%S}".
-		format(START_DATE, END_DATE))
-
-	# Scan the lines in the log files until the date goes out of range
-	scan_files(collector)
-
-	if not collector["scan_count"]:
-		print("No log lines scanned...")
-		return
+def scan_mail_log(env, settings=None, use_index=None):
+	""" Scan the system's mail log files and collect interesting data
 
-	collector["scan_time"] = time.time() - collector["scan_time"]
+	This function scans the mail log files in /var/log/ between the start and end of the settings.
 
-	print(
-		"{scan_count} Log lines scanned, {parse_count} lines parsed in {scan_time:.2f} "
-		"seconds\n".format(**collector))
-
-	# Print Sent Mail report
-
-	if collector["sent_mail"]:
-		msg = "Sent email"
-		print_header(msg)
-
-		data = OrderedDict(
-			sorted(collector["sent_mail"].items(), key=email_sort))
-
-		print_user_table(
-			data.keys(),
-			data=[
-				("sent", [u["sent_count"] for u in data.values()]),
-				("hosts", [len(u["hosts"]) for u in data.values()]),
-			],
-			sub_data=[
-				("sending hosts", [u["hosts"] for u in data.values()]),
-			],
-			activity=[
-				("sent", [u["activity-by-hour"] for u in data.values()]),
-			],
-			earliest=[u["earliest"] for u in data.values()],
-			latest=[u["latest"] for u in data.values()],
-		)
-
-		accum = defaultdict(int)
-		data = collector["sent_mail"].values()
+	Args:
+		env (dict): Dictionary containing MiaB settings
+		settings (ScanSettings): What to scan for, defaults to the command line's settings
+		use_index (bool): Whether to report from the index, defaults to USE_INDEX
 
-		for h in range(24):
-			accum[h] = sum(d["activity-by-hour"][h] for d in data)
+	Returns:
+		Report: The collected data
 
-		print_time_table(["sent"], [accum])
+	"""
 
-	# Print Received Mail report
+	if use_index is None:
+		use_index = USE_INDEX
 
-	if collector["received_mail"]:
-		msg = "Received email"
-		print_header(msg)
+	collector = new_collector(settings)
+	collector["known_addresses"] = load_known_addresses(env)
 
-		data = OrderedDict(
-			sorted(collector["received_mail"].items(), key=email_sort))
+	if use_index:
+		# Bring the index up to date and read the time span from it
+		collector["scan_count"] = update_index(env)
+		collector["parse_count"] = load_index(env, collector)
+	else:
+		# Scan the lines in the log files until the date goes out of range
+		if collector["settings"].newest_first:
+			scan_files_reverse(collector)
+		elif JOBS > 1:
+			scan_files_parallel(collector)
+		else:
+			scan_files(collector)
 
-		print_user_table(
-			data.keys(),
-			data=[
-				("received", [u["received_count"] for u in data.values()]),
-			],
-			activity=[
-				("sent", [u["activity-by-hour"] for u in data.values()]),
-			],
-			earliest=[u["earliest"] for u in data.values()],
-			latest=[u["latest"] for u in data.values()],
-		)
+	collector["scan_time"] = time.time() - collector["scan_time"]
 
-		accum = defaultdict(int)
-		for h in range(24):
-			accum[h] = sum(d["activity-by-hour"][h] for d in data.values())
+	return Report(collector, indexed=use_index)
 
-		print_time_table(["received"], [accum])
 
-	# Print login report
+def load_known_addresses(env):
+	""" The addresses handled by the box, or None if they can't be looked up """
+	try:
+		import mailconfig
+		return (set(mailconfig.get_mail_users(env))
+			| set(alias[0] for alias in mailconfig.get_mail_aliases(env)))
+	except ImportError:
+		return None
 
-	if collector["logins"]:
-		msg = "User logins per hour"
-		print_header(msg)
 
-		data = OrderedDict(sorted(collector["logins"].items(), key=email_sort))
+def report_for(env, timespan):
+	""" Report all data in one of the TIME_DELTAS up to now
 
-		# Get a list of all of the protocols seen in the logs in reverse count order.
-		all_protocols = defaultdict(int)
-		for u in data.values():
-			for protocol_name, count in u["totals_by_protocol"].items():
-				all_protocols[protocol_name] += count
-		all_protocols = [
-			k for k, v in sorted(all_protocols.items(), key=lambda kv: -kv[1])
-		]
+	Used by the management daemon, which has no command line to configure the scan with. Time spans
+	of less than a day are scanned backwards from the end of the current log file, which is quick
+	and exact to the second. Longer ones are read from the index, which only has to read the lines
+	logged since it was last updated.
+	"""
+	now = datetime.datetime.now()
+	if timespan == "today":
+		# The time delta of 'today' was fixed when the module was loaded
+		start = now.replace(hour=0, minute=0, second=0, microsecond=0)
+	else:
+		start = now - TIME_DELTAS[timespan]
+	use_index = now - start >= datetime.timedelta(days=1)
+
+	settings = ScanSettings(start=start, end=now, now=now, filters=None, sent=True, received=True,
+		logins=True, grey=True, blocked=True, newest_first=not use_index, keep=KEEP)
+	return scan_mail_log(env, settings, use_index=use_index)
+
+
+class Report:
+	""" The data collected from the mail log files, to print as tables or serialize as JSON """
+
+	def __init__(self, collector, indexed=False):
+		self.collector = collector
+		self.indexed = indexed
+		self.start = collector["settings"].start
+		self.end = collector["settings"].end
+		self.sorted = {}
+
+	def by_user(self, kind):
+		""" The (user, data) pairs of a kind of data, sorted by domain and name
+
+		They are only sorted once per report, whether it's printed, serialized or both.
+		"""
+		if kind not in self.sorted:
+			self.sorted[kind] = sorted(self.collector[kind].items(), key=email_sort)
+		return self.sorted[kind]
+
+	def as_dict(self):
+		""" The report as a dict of JSON-serializable values, with dates in ISO 8601 format """
+		collector = self.collector
+
+		def iso(date):
+			if isinstance(date, int):
+				date = from_timestamp(date)
+			return date.isoformat() if date else None
+
+		return {
+			"start": iso(self.start),
+			"end": iso(self.end),
+			"indexed": self.indexed,
+			"scanned": collector["scan_count"],
+			"parsed": collector["parse_count"],
+			"scan_time": round(collector["scan_time"], 3),
+			"sent_mail": {
+				user: {
+					"sent": u.count,
+					"hosts": sorted(u.hosts),
+					"activity_by_hour": list(u.by_hour),
+					"earliest": iso(u.earliest),
+					"latest": iso(u.latest),
+				} for user, u in self.by_user("sent_mail")
+			},
+			"received_mail": {
+				user: {
+					"received": u.count,
+					"activity_by_hour": list(u.by_hour),
+					"earliest": iso(u.earliest),
+					"latest": iso(u.latest),
+				} for user, u in self.by_user("received_mail")
+			},
+			"logins": {
+				user: {
+					"protocols": {
+						protocol_name: {
+							"logins": activity.count,
+							"activity_by_hour": list(activity.by_hour),
+						} for protocol_name, activity in sorted(u.by_protocol.items())
+					},
+					"hosts": [{
+						"protocol": protocol_name,
+						"host": host,
+						"logins": count,
+					} for (protocol_name, host), count in sorted(u.by_protocol_and_host.items())],
+					"earliest": iso(u.earliest),
+					"latest": iso(u.latest),
+				} for user, u in self.by_user("logins")
+			},
+			"greylisted": {
+				user: [{
+					"host": client,
+					"sender": sender,
+					"received": iso(first_date),
+					"delivered": iso(delivered_date),
+				} for (client, sender), (first_date, delivered_date) in rep.items() if first_date]
+				for user, rep in self.by_user("postgrey")
+			},
+			"blocked": {
+				user: {
+					"blocked": u["count"],
+					"recent": [{
+						"date": iso(date),
+						"sender": sender,
+						"message": message,
+					} for date, sender, message in sorted(u["blocked"])],
+					"earliest": iso(u["earliest"]),
+					"latest": iso(u["latest"]),
+				} for user, u in self.by_user("rejected")
+			},
+			"greylisted_hosts": [{
+				"host": host,
+				"count": count,
+				"exact": exact,
+			} for host, count, exact in collector["greylisted_hosts"].most_common(TOP_SIZE)],
+			"blocked_senders": [{
+				"sender": sender,
+				"count": count,
+				"exact": exact,
+			} for sender, count, exact in collector["blocked_senders"].most_common(TOP_SIZE)],
+		}
 
-		print_user_table(
-			data.keys(),
-			data=[
-				(
-					protocol_name,
-					[
-						round(
-							u["totals_by_protocol"][protocol_name] /
-							(u["latest"] - u["earliest"]).total_seconds() *
-							60 * 60, 1) if
-						(u["latest"] - u["earliest"]).total_seconds() > 0 else
-						0  # prevent division by zero
-						for u in data.values()
-					]) for protocol_name in all_protocols
-			],
-			sub_data=[("Protocol and Source", [[
-				"{} {}: {} times".format(protocol_name, host, count)
-				for (protocol_name, host), count in sorted(
-					u["totals_by_protocol_and_host"].items(),
-					key=lambda kv: -kv[1])
-			] for u in data.values()])],
-			activity=[
-				(protocol_name,
-				[u["activity-by-hour"][protocol_name] for u in data.values()])
+	def to_json(self):
+		return json.dumps(self.as_dict(), indent=2, sort_keys=True) + "\n"
+
+	def to_ndjson(self):
+		""" One JSON object per line: the report's totals, then a line per user and section """
+		report = self.as_dict()
+		lines = [{
+			"type": "report",
+			**{key: report[key] for key in ("start", "end", "indexed", "scanned", "parsed",
+				"scan_time")}
+		}]
+		for section in ("sent_mail", "received_mail", "logins", "blocked"):
+			for user, data in report[section].items():
+				lines.append({"type": section, "user": user, **data})
+		for user, entries in report["greylisted"].items():
+			for entry in entries:
+				lines.append({"type": "greylisted", "user": user, **entry})
+		for section in ("greylisted_hosts", "blocked_senders"):
+			for entry in report[section]:
+				lines.append({"type": section, **entry})
+		return "".join(json.dumps(line, sort_keys=True) + "\n" for line in lines)
+
+	def print_tables(self):
+		collector = self.collector
+
+		if self.indexed:
+			if not collector["parse_count"]:
+				print("No log lines indexed...")
+				return
+
+			print(
+				"{scan_count} Log lines indexed, {parse_count} index entries read in "
+				"{scan_time:.2f} seconds\n".format(**collector))
+		else:
+			if not collector["scan_count"]:
+				print("No log lines scanned...")
+				return
+
+			print(
+				"{scan_count} Log lines scanned, {parse_count} lines parsed in {scan_time:.2f} "
+				"seconds\n".format(**collector))
+
+		# Print Sent Mail report
+
+		if collector["sent_mail"]:
+			msg = "Sent email"
+			print_header(msg)
+
+			users, data = zip(*self.by_user("sent_mail"))
+			activity = [u.by_hour for u in data]
+
+			print_user_table(
+				users,
+				data=[
+					("sent", [u.count for u in data]),
+					("hosts", [len(u.hosts) for u in data]),
+				],
+				sub_data=[
+					("sending hosts", [u.hosts for u in data]),
+				],
+				activity=[
+					("sent", activity),
+				],
+				earliest=[from_timestamp(u.earliest) for u in data],
+				latest=[from_timestamp(u.latest) for u in data],
+			)
+
+			print_time_table(["sent"], [hourly_totals(activity)])
+
+		# Print Received Mail report
+
+		if collector["received_mail"]:
+			msg = "Received email"
+			print_header(msg)
+
+			users, data = zip(*self.by_user("received_mail"))
+			activity = [u.by_hour for u in data]
+
+			print_user_table(
+				users,
+				data=[
+					("received", [u.count for u in data]),
+				],
+				activity=[
+					("sent", activity),
+				],
+				earliest=[from_timestamp(u.earliest) for u in data],
+				latest=[from_timestamp(u.latest) for u in data],
+			)
+
+			print_time_table(["received"], [hourly_totals(activity)])
+
+		# Print login report
+
+		if collector["logins"]:
+			msg = "User logins per hour"
+			print_header(msg)
+
+			users, data = zip(*self.by_user("logins"))
+
+			# Get a list of all of the protocols seen in the logs in reverse count order.
+			all_protocols = defaultdict(int)
+			for u in data:
+				for protocol_name, activity in u.by_protocol.items():
+					all_protocols[protocol_name] += activity.count
+			all_protocols = sorted(all_protocols, key=lambda p: -all_protocols[p])
+
+			# The users' activity by protocol, and the times of their first and last logins
+			activity = {
+				protocol_name: [u.protocol(protocol_name) for u in data]
 				for protocol_name in all_protocols
-			],
-			earliest=[u["earliest"] for u in data.values()],
-			latest=[u["latest"] for u in data.values()],
-			numstr=lambda n: str(round(n, 1)),
-		)
-
-		accum = {
-			protocol_name: defaultdict(int)
-			for protocol_name in all_protocols
-		}
-		for h in range(24):
-			for protocol_name in all_protocols:
-				accum[protocol_name][h] = sum(
-					d["activity-by-hour"][protocol_name][h]
-					for d in data.values())
-
-		print_time_table(
-			all_protocols,
-			[accum[protocol_name] for protocol_name in all_protocols])
-
-	if collector["postgrey"]:
-		msg = "Greylisted Email {:%Y-%m-%d %H:%M:%S} and {:%Y-%m-%d %H:%M:%S}"
-		print_header(msg.format(START_DATE, END_DATE))
-
-		print(textwrap.fill(
-			"The following mail was greylisted, meaning the emails were temporarily rejected. "
-			"Legitimate senders must try again after three minutes.",
-			width=80,
-			initial_indent=" ",
-			subsequent_indent=" "),
-			end='\n\n')
-
-		data = OrderedDict(
-			sorted(collector["postgrey"].items(), key=email_sort))
-		users = []
-		received = []
-		senders = []
-		sender_clients = []
-		delivered_dates = []
-
-		for recipient in data:
-			sorted_recipients = sorted(data[recipient].items(),
-									key=lambda kv: kv[1][0] or kv[1][1])
-			for (client_address,
-				sender), (first_date, delivered_date) in sorted_recipients:
-				if first_date:
-					users.append(recipient)
-					received.append(first_date)
-					senders.append(sender)
-					delivered_dates.append(delivered_date)
-					sender_clients.append(client_address)
-
-		print_user_table(
-			users,
-			data=[("received", received), ("sender", senders),
-				("delivered",
-				[str(d) or "no retry yet" for d in delivered_dates]),
-				("sending host", sender_clients)],
-			delimit=True,
-		)
-
-	if collector["rejected"]:
-		msg = "Blocked Email {:%Y-%m-%d %H:%M:%S} and {:%Y-%m-%d %H:%M:%S}"
-		print_header(msg.format(START_DATE, END_DATE))
-
-		data = OrderedDict(
-			sorted(collector["rejected"].items(), key=email_sort))
-
-		rejects = []
+			}
+			earliest = [u.earliest for u in data]
+			latest = [u.latest for u in data]
+
+			print_user_table(
+				users,
+				data=[
+					(
+						protocol_name,
+						[
+							round(a.count / (l - e) * 60 * 60, 1) if l - e > 0 else
+							0  # prevent division by zero
+							for a, e, l in zip(activity[protocol_name], earliest, latest)
+						]) for protocol_name in all_protocols
+				],
+				sub_data=[("Protocol and Source", [[
+					"{} {}: {} times".format(protocol_name, host, count)
+					for (protocol_name, host), count in sorted(
+						u.by_protocol_and_host.items(),
+						key=lambda kv: -kv[1])
+				] for u in data])] if VERBOSE else None,
+				activity=[
+					(protocol_name, [a.by_hour for a in activity[protocol_name]])
+					for protocol_name in all_protocols
+				],
+				earliest=[from_timestamp(e) for e in earliest],
+				latest=[from_timestamp(l) for l in latest],
+				numstr=lambda n: str(round(n, 1)),
+			)
+
+			print_time_table(all_protocols, [
+				hourly_totals(a.by_hour for a in activity[protocol_name])
+				for protocol_name in all_protocols
+			])
+
+		if collector["postgrey"]:
+			msg = "Greylisted Email {:%Y-%m-%d %H:%M:%S} and {:%Y-%m-%d %H:%M:%S}"
+			print_header(msg.format(self.start, self.end))
+
+			print(textwrap.fill(
+				"The following mail was greylisted, meaning the emails were temporarily rejected. "
+				"Legitimate senders must try again after three minutes. At most the {} most recent "
+				"emails are shown per user.".format(self.collector["settings"].keep),
+				width=80,
+				initial_indent=" ",
+				subsequent_indent=" "),
+				end='\n\n')
+
+			data = OrderedDict(self.by_user("postgrey"))
+			users = []
+			received = []
+			senders = []
+			sender_clients = []
+			delivered_dates = []
+
+			for recipient in data:
+				sorted_recipients = sorted(data[recipient].items(),
+										key=lambda kv: kv[1][0] or kv[1][1])
+				for (client_address,
+					sender), (first_date, delivered_date) in sorted_recipients:
+					if first_date:
+						users.append(recipient)
+						received.append(first_date)
+						senders.append(sender)
+						delivered_dates.append(delivered_date)
+						sender_clients.append(client_address)
+
+			print_user_table(
+				users,
+				data=[("received", received), ("sender", senders),
+					("delivered",
+					[str(d) or "no retry yet" for d in delivered_dates]),
+					("sending host", sender_clients)],
+				delimit=True,
+			)
+
+			print_header("Most Greylisted Hosts")
+			print_top(collector["greylisted_hosts"])
+
+		if collector["rejected"]:
+			msg = "Blocked Email {:%Y-%m-%d %H:%M:%S} and {:%Y-%m-%d %H:%M:%S}"
+			print_header(msg.format(self.start, self.end))
+
+			data = OrderedDict(self.by_user("rejected"))
+
+			rejects = []
 
-		if VERBOSE:
-			for user_data in data.values():
-				user_rejects = []
-				for date, sender, message in user_data["blocked"]:
-					if len(sender) > 64:
-						sender = sender[:32] + "…" + sender[-32:]
-					user_rejects.append("%s - %s " % (date, sender))
-					user_rejects.append("  %s" % message)
-				rejects.append(user_rejects)
-
-		print_user_table(
-			data.keys(),
-			data=[
-				("blocked", [len(u["blocked"]) for u in data.values()]),
-			],
-			sub_data=[
-				("blocked emails", rejects),
-			],
-			earliest=[u["earliest"] for u in data.values()],
-			latest=[u["latest"] for u in data.values()],
-		)
-
-	if collector["other-services"] and VERBOSE and False:
-		print_header("Other services")
-		print("The following unkown services were found in the log file.")
-		print(" ", *sorted(list(collector["other-services"])), sep='\n│ ')
+			if VERBOSE:
+				for user_data in data.values():
+					user_rejects = []
+					if user_data["count"] > len(user_data["blocked"]):
+						user_rejects.append("(the {} most recent)".format(len(user_data["blocked"])))
+					for date, sender, message in sorted(user_data["blocked"]):
+						if len(sender) > 64:
+							sender = sender[:32] + "…" + sender[-32:]
+						user_rejects.append("%s - %s " % (date, sender))
+						user_rejects.append("  %s" % message)
+					rejects.append(user_rejects)
+
+			print_user_table(
+				data.keys(),
+				data=[
+					("blocked", [u["count"] for u in data.values()]),
+				],
+				sub_data=[
+					("blocked emails", rejects),
+				],
+				earliest=[u["earliest"] for u in data.values()],
+				latest=[u["latest"] for u in data.values()],
+			)
+
+			print_header("Most Blocked Senders")
+			print_top(collector["blocked_senders"])
+
+		if collector["other-services"] and VERBOSE and False:
+			print_header("Other services")
+			print("The following unkown services were found in the log file.")
+			print(" ", *sorted(list(collector["other-services"])), sep='\n│ ')
 
 
 def scan_mail_log_line(line, collector):
-	""" Scan a log line and extract interesting data """
+	""" Scan a log line and extract interesting data
 
-	m = re.match(r"(\w+[\s]+\d+ \d+:\d+:\d+) ([\w]+ )?([\w\-/]+)[^:]*: (.*)",
-				line)
+	Returns False if the line is past the end of the time span, None if it is before its start and
+	True otherwise.
+	"""
+
+	m = LOG_LINE_RE.match(line)
 
 	if not m:
 		return True
@@ -347,51 +918,26 @@ def scan_mail_log_line(line, collector):
 	date, system, service, log = m.groups()
 	collector["scan_count"] += 1
 
-	# print()
-	# print("date:", date)
-	# print("host:", system)
-	# print("service:", service)
-	# print("log:", log)
-
-	# Replaced the dateutil parser for a less clever way of parser that is roughly 4 times faster.
-	# date = dateutil.parser.parse(date)
-
-	# strptime fails on Feb 29 with ValueError: day is out of range for month if correct year is not provided.
-	# See https://bugs.python.org/issue26460
-	date = datetime.datetime.strptime(
-		str(NOW.year) + ' ' + date, '%Y %b %d %H:%M:%S')
-	# if log date in future, step back a year
-	if date > NOW:
-		date = date.replace(year=NOW.year - 1)
-	#print("date:", date)
+	settings = collector["settings"]
+	date = parse_log_date(date, settings.now)
 
 	# Check if the found date is within the time span we are scanning
-	if date > END_DATE:
+	if date > settings.end:
 		# Don't process, and halt
 		return False
-	elif date < START_DATE:
+	elif date < settings.start:
 		# Don't process, but continue
-		return True
+		return None
 
-	if service == "postfix/submission/smtpd":
-		if SCAN_OUT:
-			scan_postfix_submission_line(date, log, collector)
-	elif service == "postfix/lmtp":
-		if SCAN_IN:
-			scan_postfix_lmtp_line(date, log, collector)
+	handler = SERVICE_HANDLERS.get(service)
+	if handler is not None:
+		enabled, scan_line = handler
+		if enabled(settings):
+			scan_line(date, log, collector)
 	elif service.endswith("-login"):
-		if SCAN_DOVECOT_LOGIN:
+		if settings.logins:
 			scan_dovecot_login_line(date, log, collector, service[:4])
-	elif service == "postgrey":
-		if SCAN_GREY:
-			scan_postgrey_line(date, log, collector)
-	elif service == "postfix/smtpd":
-		if SCAN_BLOCKED:
-			scan_postfix_smtpd_line(date, log, collector)
-	elif service in ("postfix/qmgr", "postfix/pickup", "postfix/cleanup",
-					"postfix/scache", "spampd", "postfix/anvil",
-					"postfix/master", "opendkim", "postfix/lmtp",
-					"postfix/tlsmgr", "anvil"):
+	elif service in IGNORED_SERVICES:
 		# nothing to look at
 		return True
 	else:
@@ -402,18 +948,40 @@ def scan_mail_log_line(line, collector):
 	return True
 
 
+@functools.lru_cache(maxsize=16384)
+def parse_log_hour(year, hour):
+	""" Parse the "Mmm dd hh" part of a syslog time stamp, for the given year """
+
+	# strptime fails on Feb 29 with ValueError: day is out of range for month if correct year is not provided.
+	# See https://bugs.python.org/issue26460
+	return datetime.datetime.strptime(str(year) + ' ' + hour, '%Y %b %d %H')
+
+
+def parse_log_date(date, now):
+	""" Parse a syslog time stamp, e.g. "Jan  5 13:02:59"
+
+	Syslog time stamps don't have a year, so the year of now is assumed unless that puts the date
+	after now. strptime is slow, so it is only called once per clock hour (see parse_log_hour). The
+	minutes and seconds are always two digits.
+	"""
+	date = parse_log_hour(now.year, date[:-6]).replace(minute=int(date[-5:-3]),
+														second=int(date[-2:]))
+	# if log date in future, step back a year
+	if date > now:
+		date = date.replace(year=now.year - 1)
+	return date
+
+
 def scan_postgrey_line(date, log, collector):
 	""" Scan a postgrey log line and extract interesting data """
 
-	m = re.match(
-		"action=(greylist|pass), reason=(.*?), (?:delay=\d+, )?client_name=(.*), "
-		"client_address=(.*), sender=(.*), recipient=(.*)", log)
+	m = POSTGREY_RE.match(log)
 
 	if m:
 
 		action, reason, client_name, client_address, sender, user = m.groups()
 
-		if user_match(user):
+		if user_match(user, collector["settings"].filters):
 
 			# Might be useful to group services that use a lot of mail different servers on sub
 			# domains like <sub>1.domein.com
@@ -426,12 +994,26 @@ def scan_postgrey_line(date, log, collector):
 			key = (client_address if client_name == 'unknown' else client_name,
 				sender)
 
-			rep = collector["postgrey"].setdefault(user, {})
+			rep = collector["postgrey"].setdefault(user, OrderedDict())
 
 			if action == "greylist" and reason == "new":
-				rep[key] = (date, rep[key][1] if key in rep else None)
+				keep_greylisted(rep, key, (date, rep[key][1] if key in rep else None),
+					collector["settings"])
+				collector["greylisted_hosts"].add(key[0])
 			elif action == "pass":
-				rep[key] = (rep[key][0] if key in rep else None, date)
+				keep_greylisted(rep, key, (rep[key][0] if key in rep else None, date),
+					collector["settings"])
+
+
+def keep_greylisted(rep, key, dates, settings):
+	""" Keep the dates of a greylisted email, dropping the oldest email beyond the most recent ones """
+	if key not in rep and len(rep) >= settings.keep and settings.newest_first:
+		# Scanning backwards, everything from now on is older than what is kept
+		return
+	rep[key] = dates
+	rep.move_to_end(key)
+	if len(rep) > settings.keep:
+		rep.popitem(last=False)
 
 
 def scan_postfix_smtpd_line(date, log, collector):
@@ -439,8 +1021,7 @@ def scan_postfix_smtpd_line(date, log, collector):
 
 	# Check if the incoming mail was rejected
 
-	m = re.match(
-		"NOQUEUE: reject: RCPT from .*?: (.*?); from=<(.*?)> to=<(.*?)>", log)
+	m = SMTPD_REJECT_RE.match(log)
 
 	if m:
 		message, sender, user = m.groups()
@@ -450,32 +1031,32 @@ def scan_postfix_smtpd_line(date, log, collector):
 			return
 
 		# only log mail to known recipients
-		if user_match(user):
+		if user_match(user, collector["settings"].filters):
 			if collector["known_addresses"] is None or user in collector[
 				"known_addresses"]:
+				settings = collector["settings"]
 				data = collector["rejected"].get(user, {
-					"blocked": [],
+					"count": 0,
+					"blocked": deque(maxlen=settings.keep),
 					"earliest": None,
 					"latest": None,
 				})
 				# simplify this one
-				m = re.search(
-					r"Client host \[(.*?)\] blocked using zen.spamhaus.org; (.*)",
-					message)
+				m = ZEN_SPAMHAUS_RE.search(message)
 				if m:
 					message = "ip blocked: " + m.group(2)
 				else:
 					# simplify this one too
-					m = re.search(
-						r"Sender address \[.*@(.*)\] blocked using dbl.spamhaus.org; (.*)",
-						message)
+					m = DBL_SPAMHAUS_RE.search(message)
 					if m:
 						message = "domain blocked: " + m.group(2)
 
-				if data["earliest"] is None:
-					data["earliest"] = date
-				data["latest"] = date
-				data["blocked"].append((date, sender, message))
+				update_timespan(data, date)
+				data["count"] += 1
+				# Scanning backwards, everything from now on is older than what is kept
+				if not (settings.newest_first and len(data["blocked"]) == settings.keep):
+					data["blocked"].append((date, sender, message))
+				collector["blocked_senders"].add(sender)
 
 				collector["rejected"][user] = data
 
@@ -483,38 +1064,35 @@ def scan_postfix_smtpd_line(date, log, collector):
 def scan_dovecot_login_line(date, log, collector, protocol_name):
 	""" Scan a dovecot login log line and extract interesting data """
 
-	m = re.match("Info: Login: user=<(.*?)>, method=PLAIN, rip=(.*?),", log)
+	m = DOVECOT_LOGIN_RE.match(log)
 
 	if m:
 		# TODO: CHECK DIT
 		user, host = m.groups()
 
-		if user_match(user):
+		if user_match(user, collector["settings"].filters):
 			add_login(user, date, protocol_name, host, collector)
 
 
-def add_login(user, date, protocol_name, host, collector):
-	# Get the user data, or create it if the user is new
-	data = collector["logins"].get(
-		user, {
-			"earliest": None,
-			"latest": None,
-			"totals_by_protocol": defaultdict(int),
-			"totals_by_protocol_and_host": defaultdict(int),
-			"activity-by-hour": defaultdict(lambda: defaultdict(int)),
-		})
-
-	if data["earliest"] is None:
+def update_timespan(data, date):
+	""" Widen the earliest/latest dates of a user's data to include the given date
+
+	Lines aren't necessarily scanned in chronological order (see scan_files_reverse), so the first
+	date seen isn't assumed to be the earliest. Records do the same in Activity.widen.
+	"""
+	if data["earliest"] is None or date < data["earliest"]:
 		data["earliest"] = date
-	data["latest"] = date
+	if data["latest"] is None or date > data["latest"]:
+		data["latest"] = date
 
-	data["totals_by_protocol"][protocol_name] += 1
-	data["totals_by_protocol_and_host"][(protocol_name, host)] += 1
 
-	if host not in ("127.0.0.1", "::1") or True:
-		data["activity-by-hour"][protocol_name][date.hour] += 1
+def add_login(user, date, protocol_name, host, collector):
+	# Get the user data, or create it if the user is new
+	data = collector["logins"].get(user)
+	if data is None:
+		data = collector["logins"][user] = Logins()
 
-	collector["logins"][user] = data
+	data.add(sys.intern(protocol_name), sys.intern(host), int(date.timestamp()), date.hour)
 
 
 def scan_postfix_lmtp_line(date, log, collector):
@@ -525,29 +1103,18 @@ def scan_postfix_lmtp_line(date, log, collector):
 
 	"""
 
-	m = re.match("([A-Z0-9]+): to=<(\S+)>, .* Saved", log)
+	m = LMTP_RE.match(log)
 
 	if m:
 		_, user = m.groups()
 
-		if user_match(user):
+		if user_match(user, collector["settings"].filters):
 			# Get the user data, or create it if the user is new
-			data = collector["received_mail"].get(
-				user, {
-					"received_count": 0,
-					"earliest": None,
-					"latest": None,
-					"activity-by-hour": defaultdict(int),
-				})
-
-			data["received_count"] += 1
-			data["activity-by-hour"][date.hour] += 1
+			data = collector["received_mail"].get(user)
+			if data is None:
+				data = collector["received_mail"][user] = Activity()
 
-			if data["earliest"] is None:
-				data["earliest"] = date
-			data["latest"] = date
-
-			collector["received_mail"][user] = data
+			data.add(int(date.timestamp()), date.hour)
 
 
 def scan_postfix_submission_line(date, log, collector):
@@ -561,55 +1128,490 @@ def scan_postfix_submission_line(date, log, collector):
 	# Match both the 'plain' and 'login' sasl methods, since both authentication methods are
 	# allowed by Dovecot. Exclude trailing comma after the username when additional fields
 	# follow after.
-	m = re.match(
-		"([A-Z0-9]+): client=(\S+), sasl_method=(PLAIN|LOGIN), sasl_username=(\S+)(?<!,)",
-		log)
+	m = SUBMISSION_RE.match(log)
 
 	if m:
 		_, client, method, user = m.groups()
 
-		if user_match(user):
+		if user_match(user, collector["settings"].filters):
 			# Get the user data, or create it if the user is new
-			data = collector["sent_mail"].get(
-				user, {
-					"sent_count": 0,
-					"hosts": set(),
-					"earliest": None,
-					"latest": None,
-					"activity-by-hour": defaultdict(int),
-				})
+			data = collector["sent_mail"].get(user)
+			if data is None:
+				data = collector["sent_mail"][user] = SentMail()
 
-			data["sent_count"] += 1
-			data["hosts"].add(client)
-			data["activity-by-hour"][date.hour] += 1
-
-			if data["earliest"] is None:
-				data["earliest"] = date
-			data["latest"] = date
-
-			collector["sent_mail"][user] = data
+			data.add(int(date.timestamp()), date.hour)
+			data.hosts.add(sys.intern(client))
 
 			# Also log this as a login.
 			add_login(user, date, "smtp", client, collector)
 
 
+# The services whose lines are scanned, mapped to a function telling whether the scan settings
+# enable them and the function that scans their lines. Dovecot's *-login services are handled
+# separately.
+SERVICE_HANDLERS = {
+	"postfix/submission/smtpd": (lambda settings: settings.sent, scan_postfix_submission_line),
+	"postfix/lmtp": (lambda settings: settings.received, scan_postfix_lmtp_line),
+	"postgrey": (lambda settings: settings.grey, scan_postgrey_line),
+	"postfix/smtpd": (lambda settings: settings.blocked, scan_postfix_smtpd_line),
+}
+
+
+# Persistent index
+#
+# The index is a SQLite database holding the data the collector gathers, aggregated per user and
+# per hour, plus how far each log file has been read. Each run only reads the lines that were
+# appended since the last run, and reports for any time span are a query over the hourly buckets.
+# The resolution of those reports is therefore one hour.
+#
+# Log files are identified by their inode, which survives logrotate renaming mail.log to
+# mail.log.1. Compressing mail.log.1 to mail.log.2.gz creates a new inode, so files are also
+# matched on their first line, which survives compression.
+#
+# Only one update of the index runs at a time, in any thread or process (e.g. the management
+# daemon's /system/mail-stats and mail_log.py -i), since updates read on from the same offsets.
+
+
+def get_index_path(env):
+	return os.path.join(env["STORAGE_ROOT"], "mail/mail_log.sqlite")
+
+
+def open_index(env):
+	conn = sqlite3.connect(get_index_path(env))
+	conn.execute("CREATE TABLE IF NOT EXISTS files (inode INTEGER PRIMARY KEY, head TEXT, "
+		"offset INTEGER NOT NULL)")
+	conn.execute("CREATE TABLE IF NOT EXISTS buckets (kind TEXT NOT NULL, user TEXT NOT NULL, "
+		"hour INTEGER NOT NULL, key TEXT NOT NULL, count INTEGER NOT NULL, earliest INTEGER, "
+		"latest INTEGER, PRIMARY KEY (kind, user, hour, key))")
+	return conn
+
+
+def open_log(filename):
+	""" Open a log file for reading bytes, decompressing it on the fly if needed """
+	if filename.endswith('.gz'):
+		return gzip.open(filename)
+	return open(filename, 'rb')
+
+
+def update_index(env):
+	""" Add the lines appended to the log files since the last run to the index
+
+	Returns the number of lines that were added.
+	"""
+	# Everything within the retention period gets indexed, oldest line first, whatever the command
+	# line asked for. The filters are applied when reading the index.
+	now = datetime.datetime.now()
+	settings = ScanSettings(start=now - TIME_DELTAS["all"], end=now, now=now, filters=None,
+		sent=True, received=True, logins=True, grey=True, blocked=True, newest_first=False,
+		keep=KEEP)
+
+	# The lock is taken on a file of its own, so that it's released when the file is closed (flock
+	# locks belong to the open file), and SQLite's own locks on the index aren't affected.
+	lock = open(get_index_path(env) + ".lock", "a")
+	fcntl.flock(lock, fcntl.LOCK_EX)
+	conn = open_index(env)
+	seen_inodes = []
+	line_count = 0
+
+	try:
+		for fn in LOG_FILES:
+			if not os.path.exists(fn):
+				continue
+
+			inode = os.stat(fn).st_ino
+			with open_log(fn) as f:
+				head = f.readline().decode(errors='replace')
+
+			# Find where we left off, by inode first and then by content.
+			row = conn.execute("SELECT inode, head, offset FROM files WHERE inode=?",
+				(inode, )).fetchone()
+			if row is None or row[1] != head:
+				row = conn.execute("SELECT inode, head, offset FROM files WHERE head=?",
+					(head, )).fetchone()
+			offset = row[2] if row is not None else 0
+			if row is not None and row[0] != inode:
+				conn.execute("DELETE FROM files WHERE inode=?", (row[0], ))
+			seen_inodes.append(inode)
+
+			if VERBOSE:
+				print("Indexing file", fn, "from offset", offset, "...")
+
+			line_count += index_file(conn, fn, inode, head, offset, settings)
+
+		# Forget about files that have been rotated away and data past the retention period.
+		conn.execute("DELETE FROM files WHERE inode NOT IN (%s)" % ",".join("?" * len(seen_inodes)),
+			seen_inodes)
+		conn.execute("DELETE FROM buckets WHERE hour < ?", (int(settings.start.timestamp()), ))
+		conn.commit()
+	finally:
+		conn.close()
+		lock.close()
+
+	return line_count
+
+
+def index_file(conn, fn, inode, head, offset, settings):
+	""" Index the lines of a log file starting at the given byte offset """
+	line_count = 0
+
+	# Lines are collected one clock hour at a time. Syslog lines start with a "Mmm dd hh:" time
+	# stamp, so the hour changes when that prefix does. Each hour is written to the index in its
+	# own transaction, together with the offset the next run has to start from.
+	collector = new_collector(settings)
+	hour = None
+
+	with open_log(fn) as f:
+		f.seek(offset)
+		for line in f:
+			if not line.endswith(b"\n"):
+				# The line is still being written. Leave it for the next run.
+				break
+
+			if line[:9] != hour:
+				save_index_hour(conn, collector, inode, head, offset)
+				collector = new_collector(settings)
+				hour = line[:9]
+
+			scan_mail_log_line(line.decode(errors='replace').strip(), collector)
+			offset += len(line)
+			line_count += 1
+
+	save_index_hour(conn, collector, inode, head, offset)
+	return line_count
+
+
+def save_index_hour(conn, collector, inode, head, offset):
+	""" Add the data collected from one clock hour of log lines to the index """
+	rows = []
+
+	def add(kind, user, key, count, earliest, latest):
+		# The hour starts at the earliest time, or the latest if there is no earliest. Hours are
+		# local clock hours, like the hours of the day of the activity read back in load_index,
+		# which aren't whole hours since the epoch in time zones with a half hour offset.
+		hour = datetime.datetime.fromtimestamp(earliest if earliest is not None else latest)
+		hour = int(hour.replace(minute=0, second=0).timestamp())
+		rows.append((kind, user, hour, key, count, earliest, latest))
+
+	def timestamp(date):
+		return int(date.timestamp()) if date else None
+
+	for user, data in collector["sent_mail"].items():
+		add("sent", user, "", data.count, data.earliest, data.latest)
+		for host in data.hosts:
+			add("sent-host", user, host, 0, data.earliest, data.latest)
+	for user, data in collector["received_mail"].items():
+		add("received", user, "", data.count, data.earliest, data.latest)
+	for user, data in collector["logins"].items():
+		for (protocol_name, host), count in data.by_protocol_and_host.items():
+			activity = data.by_protocol[protocol_name]
+			add("login", user, protocol_name + "\t" + host, count, activity.earliest,
+				activity.latest)
+	for user, data in collector["postgrey"].items():
+		for (client, sender), (first_date, delivered_date) in data.items():
+			add("greylist", user, client + "\t" + sender, 1, timestamp(first_date),
+				timestamp(delivered_date))
+	for user, data in collector["rejected"].items():
+		for date, sender, message in data["blocked"]:
+			add("rejected", user, sender + "\t" + message, 1, timestamp(date), timestamp(date))
+		if data["count"] > len(data["blocked"]):
+			# Blocked emails beyond the most recent ones are only counted
+			add("rejected", user, "", data["count"] - len(data["blocked"]),
+				timestamp(data["earliest"]), timestamp(data["latest"]))
+
+	conn.executemany(
+		"INSERT INTO buckets (kind, user, hour, key, count, earliest, latest) "
+		"VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT (kind, user, hour, key) DO UPDATE SET "
+		"count = count + excluded.count, "
+		"earliest = min(coalesce(earliest, excluded.earliest), coalesce(excluded.earliest, earliest)), "
+		"latest = max(coalesce(latest, excluded.latest), coalesce(excluded.latest, latest))", rows)
+	conn.execute("INSERT OR REPLACE INTO files (inode, head, offset) VALUES (?, ?, ?)",
+		(inode, head, offset))
+	conn.commit()
+
+
+def load_index(env, collector):
+	""" Fill the collector with the indexed data of the hours of the time span of its settings
+
+	Returns the number of index entries that were read.
+	"""
+	settings = collector["settings"]
+	# The hours are read oldest first
+	keep_settings = settings._replace(newest_first=False)
+	conn = open_index(env)
+	rows = conn.execute(
+		"SELECT kind, user, hour, key, count, earliest, latest FROM buckets "
+		"WHERE hour >= ? AND hour <= ? ORDER BY hour",
+		(int(settings.start.replace(minute=0, second=0, microsecond=0).timestamp()),
+		int(settings.end.timestamp()))).fetchall()
+	conn.close()
+
+	for kind, user, hour, key, count, earliest, latest in rows:
+		if not user_match(user, settings.filters):
+			continue
+
+		hour_of_day = datetime.datetime.fromtimestamp(hour).hour
+
+		if kind in ("sent", "sent-host") and settings.sent:
+			data = collector["sent_mail"].get(user)
+			if data is None:
+				data = collector["sent_mail"][user] = SentMail()
+			if kind == "sent":
+				data.add(earliest, hour_of_day, count)
+				data.widen(earliest, latest)
+			else:
+				data.hosts.add(key)
+
+		elif kind == "received" and settings.received:
+			data = collector["received_mail"].get(user)
+			if data is None:
+				data = collector["received_mail"][user] = Activity()
+			data.add(earliest, hour_of_day, count)
+			data.widen(earliest, latest)
+
+		elif kind == "login":
+			protocol_name, host = key.split("\t", 1)
+			# SMTP logins are recorded as part of the sent mail.
+			if not (settings.sent if protocol_name == "smtp" else settings.logins):
+				continue
+			data = collector["logins"].get(user)
+			if data is None:
+				data = collector["logins"][user] = Logins()
+			data.add(sys.intern(protocol_name), sys.intern(host), earliest, hour_of_day, count)
+			data.by_protocol[protocol_name].widen(earliest, latest)
+
+		else:
+			earliest = from_timestamp(earliest)
+			latest = from_timestamp(latest)
+
+		if kind == "greylist" and settings.grey:
+			rep = collector["postgrey"].setdefault(user, OrderedDict())
+			key = tuple(key.split("\t", 1))
+			first_date, delivered_date = rep.get(key, (None, None))
+			if earliest is not None and (first_date is None or earliest < first_date):
+				first_date = earliest
+				collector["greylisted_hosts"].add(key[0])
+			if latest is not None and (delivered_date is None or latest > delivered_date):
+				delivered_date = latest
+			keep_greylisted(rep, key, (first_date, delivered_date), keep_settings)
+
+		elif kind == "rejected" and settings.blocked:
+			if collector["known_addresses"] is not None and user not in collector[
+				"known_addresses"]:
+				continue
+			data = collector["rejected"].setdefault(user, {
+				"count": 0,
+				"blocked": deque(maxlen=settings.keep),
+				"earliest": None,
+				"latest": None,
+			})
+			data["count"] += count
+			if key:
+				# One entry for the emails of the hour from the same sender with the same message
+				sender, message = key.split("\t", 1)
+				data["blocked"].append((latest, sender, message))
+				collector["blocked_senders"].add(sender, count)
+			update_timespan(data, earliest)
+			update_timespan(data, latest)
+
+	return len(rows)
+
+
+# Live tail (see --follow)
+
+# The rolling windows are counted in buckets of this many seconds
+FOLLOW_BUCKET = 10
+
+# The rolling windows, as (label, seconds)
+FOLLOW_WINDOWS = (("1m", 60), ("5m", 5 * 60), ("1h", 60 * 60))
+
+
+class RollingCounts:
+	""" Counts of a user's activity over the last hour, in a ring buffer of FOLLOW_BUCKET buckets
+
+	Buckets are numbered by their start time in epoch seconds divided by FOLLOW_BUCKET.
+	"""
+	__slots__ = ("buckets", "current")
+
+	SIZE = FOLLOW_WINDOWS[-1][1] // FOLLOW_BUCKET
+
+	def __init__(self, bucket):
+		self.buckets = array('I', [0]) * self.SIZE
+		self.current = bucket
+
+	def advance(self, bucket):
+		# Empty the buckets that were left behind in the ring since the current one
+		for b in range(max(self.current + 1, bucket - self.SIZE + 1), bucket + 1):
+			self.buckets[b % self.SIZE] = 0
+		self.current = max(self.current, bucket)
+
+	def add(self, bucket, count):
+		self.advance(bucket)
+		self.buckets[bucket % self.SIZE] += count
+
+	def total(self, seconds):
+		return sum(self.buckets[b % self.SIZE]
+			for b in range(self.current - seconds // FOLLOW_BUCKET + 1, self.current + 1))
+
+
+def follow_mail_log(env, ndjson=False):
+	""" Scan the lines written to the current mail log file as they come
+
+	The lines are scanned like scan_mail_log does. Every FOLLOW_BUCKET seconds, what each user did
+	since the last time is added to rolling windows of the last minute, 5 minutes and hour, and
+	printed along with the windows' totals. This doesn't return.
+	"""
+	# Only the lines written from now on are scanned
+	settings = default_settings()._replace(start=datetime.datetime.now(), end=datetime.datetime.max)
+	known_addresses = load_known_addresses(env)
+
+	windows = {}  # (user, kind) -> RollingCounts
+	collector = None
+	next_update = 0
+
+	for line in tail(LOG_FILES[-1]):
+		now = time.time()
+		if now >= next_update:
+			if collector is not None:
+				update_windows(windows, collector, int(now) // FOLLOW_BUCKET, ndjson)
+			# Log time stamps later than now are taken to be from the year before
+			settings = settings._replace(now=datetime.datetime.now() + datetime.timedelta(days=1))
+			collector = new_collector(settings)
+			collector["known_addresses"] = known_addresses
+			next_update = now + FOLLOW_BUCKET
+
+		if line is None:
+			# Wait for more lines to be written
+			time.sleep(min(1, max(0, next_update - now)))
+		else:
+			scan_mail_log_line(line.strip(), collector)
+
+
+def update_windows(windows, collector, bucket, ndjson):
+	""" Add the counts of a collector to the rolling windows, and print those that changed """
+
+	counts = []
+	for user, data in collector["sent_mail"].items():
+		counts.append((user, "sent", data.count))
+	for user, data in collector["received_mail"].items():
+		counts.append((user, "received", data.count))
+	for user, data in collector["logins"].items():
+		counts.append((user, "logins", sum(a.count for a in data.by_protocol.values())))
+	for user, data in collector["rejected"].items():
+		counts.append((user, "blocked", data["count"]))
+
+	date = datetime.datetime.fromtimestamp(bucket * FOLLOW_BUCKET)
+	for user, kind, count in sorted(counts, key=lambda c: (email_sort(c), c[1])):
+		window = windows.get((user, kind))
+		if window is None:
+			window = windows[(user, kind)] = RollingCounts(bucket)
+		window.add(bucket, count)
+
+		totals = [(label, window.total(seconds)) for label, seconds in FOLLOW_WINDOWS]
+		if ndjson:
+			print(json.dumps({
+				"time": date.isoformat(),
+				"user": user,
+				"kind": kind,
+				"count": count,
+				**dict(totals)
+			}, sort_keys=True))
+		else:
+			print("{:%Y-%m-%d %H:%M:%S} {:<32} {:<8} {:>+6}   {}".format(
+				date, user, kind, count,
+				"   ".join("{}: {:>6}".format(label, total) for label, total in totals)))
+
+	# Forget the users that have been idle for longer than the windows
+	for key in [key for key, window in windows.items() if bucket - window.current >= window.SIZE]:
+		del windows[key]
+
+	sys.stdout.flush()
+
+
 # Utility functions
 
 
 def readline(filename):
 	""" A generator that returns the lines of a file
+
+	Rotated logs are gzip compressed. Those are decompressed on the fly while reading, so no
+	uncompressed copy is ever written to disk.
 	"""
-	with open(filename, errors='replace') as file:
-		while True:
-			line = file.readline()
-			if not line:
-				break
-			yield line
+	if filename.endswith('.gz'):
+		file = gzip.open(filename, 'rt', errors='replace')
+	else:
+		file = open(filename, errors='replace')
+
+	with file:
+		yield from file
+
+
+def tail(filename):
+	""" A generator that returns the lines written to a file from now on
+
+	None is returned whenever the end of the file is reached, so the caller can wait. The file is
+	reopened when it is rotated or truncated.
+	"""
+	file = None
+	inode = None
+	while True:
+		if file is None:
+			try:
+				file = open(filename, 'rb')
+			except FileNotFoundError:
+				# Between the rotation of the file and the creation of a new one
+				yield None
+				continue
+			if inode is None:
+				file.seek(0, os.SEEK_END)
+			inode = os.fstat(file.fileno()).st_ino
+
+		line = file.readline()
+		if line.endswith(b"\n"):
+			yield line.decode("utf8", errors="replace")
+			continue
+
+		# A partly written line is read again once complete
+		file.seek(-len(line), os.SEEK_CUR)
+		try:
+			stat = os.stat(filename)
+			rotated = stat.st_ino != inode or stat.st_size < file.tell()
+		except FileNotFoundError:
+			rotated = True
+		if rotated:
+			# Whatever was left in the old file was read, so carry on with the new one
+			file.close()
+			file = None
+		yield None
 
 
-def user_match(user):
+def readline_reverse(filename, block_size=64 * 1024):
+	""" A generator that returns the lines of a file, starting with the last one
+
+	The file is read backwards in blocks, so only as much of it as is consumed is read from disk.
+	"""
+	with open(filename, 'rb') as file:
+		position = file.seek(0, os.SEEK_END)
+		remainder = b''
+		while position > 0:
+			size = min(block_size, position)
+			position -= size
+			file.seek(position)
+			lines = (file.read(size) + remainder).split(b'\n')
+			# The first line may continue in the previous block
+			remainder = lines.pop(0)
+			for line in reversed(lines):
+				yield line.decode(errors='replace')
+		yield remainder.decode(errors='replace')
+
+
+def from_timestamp(timestamp):
+	""" Turn epoch seconds (as kept in records) back into a datetime """
+	return datetime.datetime.fromtimestamp(timestamp) if timestamp is not None else None
+
+
+def user_match(user, filters):
 	""" Check if the given user matches any of the filters """
-	return FILTERS is None or any(u in user for u in FILTERS)
+	return filters is None or any(u in user for u in filters)
 
 
 def email_sort(email):
@@ -630,6 +1632,15 @@ def valid_date(string):
 # Print functions
 
 
+def hourly_totals(activity):
+	""" Sum the activity by hour of the day of many users, given as sequences of 24 counts
+
+	The counts are summed hour by hour, as the columns of a users × 24 matrix.
+	"""
+	totals = [sum(hour) for hour in zip(*activity)]
+	return totals or [0] * 24
+
+
 def print_time_table(labels, data, do_print=True):
 	labels.insert(0, "hour")
 	data.insert(0, [str(h) for h in range(24)])
@@ -673,7 +1684,7 @@ def print_user_table(users,
 	vert_pos = 0
 
 	do_accum = all(isinstance(n, (int, float)) for _, d in data for n in d)
-	data_accum = len(data) * ([0] if do_accum else [" "])
+	data_accum = [sum(d) for _, d in data] if do_accum else len(data) * [" "]
 
 	last_user = None
 
@@ -700,9 +1711,6 @@ def print_user_table(users,
 			col_widths[col] = max(col_widths[col], len(col_str))
 			line += col_str
 
-			if do_accum:
-				data_accum[col] += d[row]
-
 		try:
 			if None not in [latest, earliest]:
 				vert_pos = len(line)
@@ -807,6 +1815,18 @@ def print_user_table(users,
 	print("\n".join(lines))
 
 
+def print_top(counter, n=10):
+	""" Print the most frequent keys of a TopCounter """
+	top = counter.most_common(n)
+	print_user_table(
+		[key for key, _, _ in top],
+		data=[
+			("accuracy", ["exact" if exact else "at most" for _, _, exact in top]),
+			("count", [count for _, count, _ in top]),
+		],
+	)
+
+
 def print_header(msg):
 	print('\n' + msg)
 	print("═" * len(msg), '\n')
@@ -886,41 +1906,111 @@ if __name__ == "__main__":
 						"--verbose",
 						help="Output extra data where available.",
 						action="store_true")
+	parser.add_argument(
+		"-i",
+		"--index",
+		help="Update the persistent index of the log files and report from it "
+		"instead of scanning the log files in full. The index has a resolution "
+		"of one hour.",
+		action="store_true")
+	parser.add_argument(
+		"-j",
+		"--jobs",
+		type=int,
+		default=1,
+		metavar='<number>',
+		help="Number of processes to scan the log files with, up to the number "
+		"of CPUs. Defaults to 1.")
+	parser.add_argument(
+		"-n",
+		"--newest-first",
+		help="Scan the log files backwards, starting with the most recent "
+		"line. Much faster for short time spans.",
+		action="store_true")
+	parser.add_argument(
+		"-k",
+		"--keep",
+		type=int,
+		default=KEEP,
+		metavar='<number>',
+		help="Number of the most recent blocked and greylisted emails to keep "
+		"per user, older ones are only counted. Defaults to {}.".format(KEEP))
+	parser.add_argument(
+		"-f",
+		"--format",
+		choices=("table", "json", "ndjson"),
+		default="table",
+		help="Print the report as tables, as JSON or as JSON with one object per "
+		"line. Defaults to table.")
+	parser.add_argument(
+		"-F",
+		"--follow",
+		help="Scan the lines written to the current log file as they come, and "
+		"print what each user did every {} seconds along with their totals over "
+		"the last minute, 5 minutes and hour. Prints JSON with one object per line "
+		"unless the format is table.".format(FOLLOW_BUCKET),
+		action="store_true")
 
 	args = parser.parse_args()
 
+	# Keep the standard output to the report itself if it's machine-readable
+	note = functools.partial(print, file=sys.stdout if args.format == "table" else sys.stderr)
+
 	if args.enddate is not None:
 		END_DATE = args.enddate
 		if args.timespan == 'today':
 			args.timespan = 'day'
-		print("Setting end date to {}".format(END_DATE))
+		note("Setting end date to {}".format(END_DATE))
 
 	START_DATE = END_DATE - TIME_DELTAS[args.timespan]
 
 	VERBOSE = args.verbose
+	NEWEST_FIRST = args.newest_first
+	USE_INDEX = args.index
+	# More processes than CPUs only add the overhead of merging their parts
+	JOBS = max(1, min(args.jobs, len(os.sched_getaffinity(0))))
+	KEEP = max(1, args.keep)
 
 	if args.received or args.sent or args.logins or args.grey or args.blocked:
 		SCAN_IN = args.received
 		if not SCAN_IN:
-			print("Ignoring received emails")
+			note("Ignoring received emails")
 
 		SCAN_OUT = args.sent
 		if not SCAN_OUT:
-			print("Ignoring sent emails")
+			note("Ignoring sent emails")
 
 		SCAN_DOVECOT_LOGIN = args.logins
 		if not SCAN_DOVECOT_LOGIN:
-			print("Ignoring logins")
+			note("Ignoring logins")
 
 		SCAN_GREY = args.grey
 		if SCAN_GREY:
-			print("Showing greylisted emails")
+			note("Showing greylisted emails")
 
 		SCAN_BLOCKED = args.blocked
 		if SCAN_BLOCKED:
-			print("Showing blocked emails")
+			note("Showing blocked emails")
 
 	if args.users is not None:
 		FILTERS = args.users.strip().split(',')
 
-	scan_mail_log(env_vars)
+	if args.follow:
+		note("Following {}...".format(LOG_FILES[-1]))
+		try:
+			follow_mail_log(env_vars, ndjson=args.format != "table")
+		except KeyboardInterrupt:
+			pass
+		sys.exit(0)
+
+	note("Scanning logs from {:%Y-%m-%d %H:%M:%S} to {:%Y-%m-%d %H:%M:%S}".format(
+		START_DATE, END_DATE))
+
+	report = scan_mail_log(env_vars)
+
+	if args.format == "json":
+		sys.stdout.write(report.to_json())
+	elif args.format == "ndjson":
+		sys.stdout.write(report.to_ndjson())
+	else:
+		report.print_tables()
@@ -9,11 +9,16 @@
 # Python 3 in setup/questions.sh to validate the email
 # address entered by the user.
 
-import subprocess
 import shutil
 import os
 import sqlite3
+import time
 import re
+import heapq
+import bisect
+import database
+import passwords
+from alias_graph import AliasGraph
 import utils
 from email_validator import validate_email as validate_email_, EmailNotValidError
 import idna
@@ -102,20 +107,102 @@ def is_dcv_address(email):
 	return False
 
 
-def open_database(env, with_connection=False):
-	conn = sqlite3.connect(env["STORAGE_ROOT"] + "/mail/users.sqlite")
-	if not with_connection:
-		return conn.cursor()
-	else:
-		return conn, conn.cursor()
+class Directory:
+	# A snapshot of the users, aliases and no-reply addresses in the users database, and of
+	# the mail domains derived from them. Read it with get_directory, which only reads the
+	# database again once it changed. Treat it as read-only, it's shared.
+
+	def __init__(self, env):
+		self.env = env
+
+		# Read everything at once, with SQLite cutting out the domain of each address.
+		c = database.cursor(env)
+		c.execute("""
+			SELECT 'user', email, substr(email, instr(email, '@') + 1), privileges, quota FROM users
+			UNION ALL SELECT 'alias', source, substr(source, instr(source, '@') + 1), destination, permitted_senders FROM aliases
+			UNION ALL SELECT 'auto_alias', source, substr(source, instr(source, '@') + 1), destination, permitted_senders FROM auto_aliases
+			UNION ALL SELECT 'noreply', email, substr(email, instr(email, '@') + 1), NULL, NULL FROM noreply
+		""")
+
+		self.user_rows = []  # (email, privileges, quota)
+		self.privileges = {}
+		self.alias_rows = {}  # address => (address, forwards-tos, permitted-senders, auto)
+		self.noreply = set()
+		self.addresses = set()
+		self.user_domains = set()
+		self.alias_domains = []  # (address, domain) of the aliases that aren't automatic
+		self.domains = set()
+		for table, address, domain, value1, value2 in c.fetchall():
+			self.addresses.add(address)
+			if table == "user":
+				self.user_rows.append((address, value1, value2))
+				self.privileges[address] = parse_privs(value1)
+				self.user_domains.add(domain)
+				self.domains.add(domain)
+			elif table == "noreply":
+				self.noreply.add(address)
+				self.domains.add(domain)
+			elif table == "alias":
+				self.alias_rows[address] = (address, value1, value2, 0)
+				self.alias_domains.append((address, domain))
+				self.domains.add(domain)
+			elif address not in self.alias_rows:
+				# Aliases take precedence over automatic aliases for the same address.
+				self.alias_rows[address] = (address, value1, value2, 1)
+
+		# Catch-alls and domain aliases (@domain.tld)
+		self.catchalls = set(address for address in self.addresses
+			if address.split("@")[0].strip() == "")
+
+		# Sorted on first use, see users and aliases
+		self.sorted_users = None
+		self.sorted_aliases = None
+
+		# Built on first use, see get_alias_graph
+		self.alias_graph = None
+
+	@property
+	def users(self):
+		if self.sorted_users is None:
+			self.sorted_users = utils.sort_email_addresses(
+				[row[0] for row in self.user_rows], self.env)
+		return self.sorted_users
+
+	@property
+	def aliases(self):
+		# put in a canonical order: sort by domain, then by email address lexicographically
+		if self.sorted_aliases is None:
+			self.sorted_aliases = [
+				self.alias_rows[address]
+				for address in utils.sort_email_addresses(self.alias_rows.keys(), self.env)
+			]
+		return self.sorted_aliases
+
+
+# The last Directory read, and the database change counter it was read at. The
+# counter is the same in every thread, so they all share the snapshot.
+directory_cache = {}
+
+
+def get_directory(env):
+	version = database.change_counter(env)
+	cached = directory_cache.get(env["STORAGE_ROOT"])
+	if cached is None or cached[0] != version:
+		cached = directory_cache[env["STORAGE_ROOT"]] = (version, Directory(env))
+	return cached[1]
+
+
+def get_alias_graph(env):
+	# Returns an AliasGraph of the users and aliases, which resolves addresses.
+	directory = get_directory(env)
+	if directory.alias_graph is None:
+		directory.alias_graph = AliasGraph(directory.privileges.keys(), directory.alias_rows.values())
+	return directory.alias_graph
 
 
 def get_mail_users(env):
 	# Returns a flat, sorted list of all user accounts.
-	c = open_database(env)
-	c.execute('SELECT email FROM users')
-	users = [row[0] for row in c.fetchall()]
-	return utils.sort_email_addresses(users, env)
+	return list(get_directory(env).users)
 
 
 def sizeof_fmt(num):
@@ -150,36 +237,141 @@ def get_mail_users_ex(env, with_archived=False):
 	#   ...
 	# ]
 
-	# Get users and their privileges.
+	accounts, _ = get_mail_users_page(env, with_archived=with_archived)
+	return sort_mail_users_by_domain(get_mail_users_by_domain(accounts, env), env)
+
+
+def sort_mail_users_by_domain(domains, env):
+	# Sort domains.
+	domains = {domain["domain"]: domain for domain in domains}
+	domains = [
+		domains[domain] for domain in utils.sort_domains(domains.keys(), env)
+	]
+
+	# Sort users within each domain first by status then lexicographically by email address.
+	for domain in domains:
+		domain["users"].sort(
+			key=lambda user: (user["status"] != "active", user["email"]))
+
+	return domains
+
+
+def address_filter(column, domain=None, prefix=None, after=None):
+	# Returns an SQL condition, and its parameters, for the addresses in column
+	# that are in a domain (IDNA-encoded), start with prefix and come after the
+	# address after when ordered by domain and then address. The domain is cut
+	# out of the address the same way in the ORDER BY of the queries below.
+	conditions = []
+	params = []
+	if domain is not None:
+		conditions.append("substr({0}, instr({0}, '@') + 1) = ?".format(column))
+		params.append(domain)
+	if prefix:
+		# GLOB, unlike LIKE, is case-sensitive like the UNIQUE index on the column,
+		# so SQLite can use the index for it.
+		conditions.append("{0} GLOB ?".format(column))
+		params.append(re.sub(r"([*?[])", r"[\1]", prefix) + "*")
+	if after is not None:
+		# The first condition lets SQLite seek to the address in the index on
+		# (domain, address) that setup/mail-users.sh creates.
+		after_domain = after[after.find("@") + 1:]
+		conditions.append("substr({0}, instr({0}, '@') + 1) >= ?".format(column))
+		conditions.append("(substr({0}, instr({0}, '@') + 1), {0}) > (?, ?)".format(column))
+		params += [after_domain, after_domain, after]
+	return " AND ".join(conditions) or "1", params
+
+
+def get_mail_users_page(env, domain=None, prefix=None, after=None, limit=None, with_archived=False):
+	# Returns up to limit user accounts ordered by domain and then email address,
+	# optionally filtered with address_filter, and whether there are more. The
+	# accounts are tuples of (email, privileges, quota), or (email, None, None)
+	# for archived accounts.
+	where, params = address_filter("email", domain, prefix, after)
+	c = database.cursor(env)
+	c.execute(
+		"SELECT substr(email, instr(email, '@') + 1) AS domain, email, privileges, quota FROM users WHERE "
+		+ where + " ORDER BY domain, email LIMIT ?",
+		params + [limit + 1 if limit is not None else -1])
+	accounts = c.fetchall()
+
+	if where == "1" and limit is None and len(mailbox_usage_cache) > len(accounts):
+		# Forget the usage of mailboxes that are no longer a user's.
+		dirsize_files = set(get_dirsize_file(email, env) for _, email, _, _ in accounts)
+		for dirsize_file in mailbox_usage_cache.keys() - dirsize_files:
+			del mailbox_usage_cache[dirsize_file]
+
+	if with_archived:
+		# Archived accounts are mailboxes without a user, merged in in the same order.
+		archived = get_archived_accounts(env)
+		if after is not None:
+			archived = archived[bisect.bisect_right(archived, (after[after.find("@") + 1:], after)):]
+		archived = [
+			(mailbox_domain, email, None, None) for mailbox_domain, email in archived
+			if (domain is None or mailbox_domain == domain) and (not prefix or email.startswith(prefix))
+		]
+		accounts = list(heapq.merge(accounts, archived))
+
+	more = limit is not None and len(accounts) > limit
+	return [account[1:] for account in accounts[:limit]], more
+
+
+# The archived accounts, and the users and mailbox directories they were found with
+archived_accounts_cache = {}
+
+
+def get_archived_accounts(env):
+	# Returns a sorted list of the (domain, email) of the mailboxes that aren't a
+	# user's. They are only looked for again once the users or the mailboxes changed.
+	directory = get_directory(env)
+	root = os.path.join(env['STORAGE_ROOT'], 'mail/mailboxes')
+	mailboxes = [
+		(domain, list_directory(os.path.join(root, domain)))
+		for domain in list_directory(root, dirs_only=True)
+	]
+	cached = archived_accounts_cache.get(root)
+	if cached is None or cached[0] is not directory or cached[1] != mailboxes:
+		archived = sorted(
+			(domain, user + "@" + domain)
+			for domain, users in mailboxes for user in users
+			if user + "@" + domain not in directory.privileges)
+		cached = archived_accounts_cache[root] = (directory, mailboxes, archived)
+	return cached[2]
+
+
+def get_dirsize_file(email, env):
+	(user, domain) = email.split('@')
+	return '%s/mail/mailboxes/%s/%s/maildirsize' % (env['STORAGE_ROOT'], domain, user)
+
+
+def get_mail_users_by_domain(accounts, env):
+	# Returns the accounts from get_mail_users_page the way get_mail_users_ex
+	# does, grouped by domain in the order they come in.
 	users = []
-	active_accounts = set()
-	c = open_database(env)
-	c.execute('SELECT email, privileges, quota FROM users')
-	for email, privileges, quota in c.fetchall():
-		active_accounts.add(email)
+	for email, privileges, quota in accounts:
+		if privileges is None:
+			(user, domain) = email.split('@')
+			users.append({
+				"email": email,
+				"privileges": [],
+				"status": "inactive",
+				"mailbox": os.path.join(env['STORAGE_ROOT'], 'mail/mailboxes', domain, user),
+				"box_count": '?',
+				"box_size": '?',
+				"box_quota": '?',
+				"percent": '?',
+			})
+			continue
 
-		(user, domain) = email.split('@')
-		box_size = 0
-		box_count = 0
-		box_quota = 0
 		percent = ''
-		try:
-			dirsize_file = os.path.join(
-				env['STORAGE_ROOT'],
-				'mail/mailboxes/%s/%s/maildirsize' % (domain, user))
-			with open(dirsize_file, 'r') as f:
-				box_quota = int(f.readline().split('S')[0])
-				for line in f.readlines():
-					(size, count) = line.split(' ')
-					box_size += int(size)
-					box_count += int(count)
-
+		usage = get_mailbox_usage(get_dirsize_file(email, env))
+		if usage is not None:
+			(box_quota, box_size, box_count) = usage
 			try:
 				percent = (box_size / box_quota) * 100
 			except:
 				percent = 'Error'
 
-		except:
+		else:
 			box_size = '?'
 			box_count = '?'
 			box_quota = '?'
@@ -188,7 +380,7 @@ def get_mail_users_ex(env, with_archived=False):
 		if quota == '0':
 			percent = ''
 
-		user = {
+		users.append({
 			"email": email,
 			"privileges": parse_privs(privileges),
 			"quota": quota,
@@ -198,76 +390,104 @@ def get_mail_users_ex(env, with_archived=False):
 			'%3.0f%%' % percent if type(percent) != str else percent,
 			"box_count": box_count,
 			"status": "active",
-		}
-		users.append(user)
+		})
 
-	# Add in archived accounts.
-	if with_archived:
-		root = os.path.join(env['STORAGE_ROOT'], 'mail/mailboxes')
-		for domain in os.listdir(root):
-			if os.path.isdir(os.path.join(root, domain)):
-				for user in os.listdir(os.path.join(root, domain)):
-					email = user + "@" + domain
-					mbox = os.path.join(root, domain, user)
-					if email in active_accounts:
-						continue
-					user = {
-						"email": email,
-						"privileges": [],
-						"status": "inactive",
-						"mailbox": mbox,
-						"box_count": '?',
-						"box_size": '?',
-						"box_quota": '?',
-						"percent": '?',
-					}
-					users.append(user)
-
-	# Group by domain.
+	return group_by_domain(users, "email", "users")
+
+
+def group_by_domain(items, address_key, list_key):
+	# Groups dicts by the domain of their address, keeping their order. Each
+	# domain name only needs to be turned back to Unicode once.
 	domains = {}
-	for user in users:
-		domain = get_domain(user["email"])
+	for item in items:
+		domain = get_domain(item[address_key], as_unicode=False)
 		if domain not in domains:
-			domains[domain] = {"domain": domain, "users": []}
-		domains[domain]["users"].append(user)
+			domains[domain] = {"domain": get_domain(item[address_key]), list_key: []}
+		domains[domain][list_key].append(item)
+	return list(domains.values())
 
-	# Sort domains.
-	domains = [
-		domains[domain] for domain in utils.sort_domains(domains.keys(), env)
-	]
 
-	# Sort users within each domain first by status then lexicographically by email address.
-	for domain in domains:
-		domain["users"].sort(
-			key=lambda user: (user["status"] != "active", user["email"]))
+# Parsed maildirsize files by path, with the generation (see
+# get_mailbox_usage_generation) and the (mtime, size) of the file when it was read
+mailbox_usage_cache = {}
 
-	return domains
+# How many seconds the usage of a mailbox is kept before the file is read again
+MAILBOX_USAGE_MAX_AGE = 60
+
+
+def get_mailbox_usage_generation():
+	# Returns a value that changes whenever the usage of the mailboxes may be read
+	# again, so that what is made from it can be cached until then without looking
+	# at any of the mailboxes.
+	return int(time.time() // MAILBOX_USAGE_MAX_AGE)
+
+
+def get_mailbox_usage(dirsize_file):
+	# Returns the (quota, size, message count) in a mailbox's maildirsize file,
+	# or None if it can't be read. A file is only looked at again in the next
+	# generation, and only parsed again once it changed.
+	generation = get_mailbox_usage_generation()
+	cached = mailbox_usage_cache.get(dirsize_file)
+	if cached is not None and cached[0] == generation:
+		return cached[2]
+
+	try:
+		stat = os.stat(dirsize_file)
+	except OSError:
+		mailbox_usage_cache.pop(dirsize_file, None)
+		return None
+
+	version = (stat.st_mtime_ns, stat.st_size)
+	if cached is not None and cached[1] == version:
+		mailbox_usage_cache[dirsize_file] = (generation, version, cached[2])
+		return cached[2]
+
+	try:
+		box_size = 0
+		box_count = 0
+		with open(dirsize_file, 'r') as f:
+			box_quota = int(f.readline().split('S')[0])
+			for line in f.readlines():
+				(size, count) = line.split(' ')
+				box_size += int(size)
+				box_count += int(count)
+		usage = (box_quota, box_size, box_count)
+	except (OSError, ValueError):
+		usage = None
+
+	mailbox_usage_cache[dirsize_file] = (generation, version, usage)
+	return usage
+
+
+# Directory listings by path, with the mtime of the directory when it was listed
+directory_listing_cache = {}
+
+
+def list_directory(path, dirs_only=False):
+	# Returns the names in a directory (only of its subdirectories if dirs_only is
+	# True). A directory is only listed again once an entry was added or removed.
+	mtime = os.stat(path).st_mtime_ns
+	key = (path, dirs_only)
+	cached = directory_listing_cache.get(key)
+	if cached is None or cached[0] != mtime:
+		with os.scandir(path) as entries:
+			names = [
+				entry.name for entry in entries
+				if not dirs_only or entry.is_dir()
+			]
+		cached = directory_listing_cache[key] = (mtime, names)
+	return cached[1]
 
 
 def get_admins(env):
 	# Returns a set of users with admin privileges.
-	users = set()
-	for domain in get_mail_users_ex(env):
-		for user in domain["users"]:
-			if "admin" in user["privileges"]:
-				users.add(user["email"])
-	return users
+	return set(email for email, privileges in get_directory(env).privileges.items()
+		if "admin" in privileges)
 
 
 def get_mail_aliases(env):
 	# Returns a sorted list of tuples of (address, forward-tos, permitted-senders, auto).
-	c = open_database(env)
-	c.execute(
-		'SELECT source, destination, permitted_senders, 0 as auto FROM aliases UNION SELECT source, destination, permitted_senders, 1 as auto FROM auto_aliases'
-	)
-	aliases = {row[0]: row for row in c.fetchall()}  # make dict
-
-	# put in a canonical order: sort by domain, then by email address lexicographically
-	aliases = [
-		aliases[address]
-		for address in utils.sort_email_addresses(aliases.keys(), env)
-	]
-	return aliases
+	return list(get_directory(env).aliases)
 
 
 def get_mail_aliases_ex(env):
@@ -291,22 +511,49 @@ def get_mail_aliases_ex(env):
 	#   ...
 	# ]
 
-	domains = {}
-	for address, forwards_to, permitted_senders, auto in get_mail_aliases(env):
-		# skip auto domain maps since these are not informative in the control panel's aliases list
-		if auto and address.startswith("@"):
-			continue
+	aliases, _ = get_mail_aliases_page(env)
+	return sort_mail_aliases_by_domain(get_mail_aliases_by_domain(aliases), env)
 
-		# get alias info
-		domain = get_domain(address)
 
-		# add to list
-		if not domain in domains:
-			domains[domain] = {
-				"domain": domain,
-				"aliases": [],
-			}
-		domains[domain]["aliases"].append({
+def sort_mail_aliases_by_domain(domains, env):
+	# Sort domains.
+	domains = {domain["domain"]: domain for domain in domains}
+	domains = [
+		domains[domain] for domain in utils.sort_domains(domains.keys(), env)
+	]
+
+	# Sort aliases within each domain first by required-ness then lexicographically by address.
+	for domain in domains:
+		domain["aliases"].sort(
+			key=lambda alias: (alias["auto"], alias["address"]))
+	return domains
+
+
+def get_mail_aliases_page(env, domain=None, prefix=None, after=None, limit=None):
+	# Returns up to limit aliases ordered by domain and then address, optionally
+	# filtered with address_filter, and whether there are more. The aliases are
+	# tuples of (address, forward-tos, permitted-senders, auto). Automatic domain
+	# aliases are left out since these are not informative in the control panel's
+	# aliases list, as are automatic aliases that an alias takes precedence over.
+	where, params = address_filter("source", domain, prefix, after)
+	c = database.cursor(env)
+	c.execute(
+		"""SELECT substr(source, instr(source, '@') + 1) AS domain, source, destination, permitted_senders, auto FROM (
+			SELECT source, destination, permitted_senders, 0 AS auto FROM aliases
+			UNION ALL SELECT source, destination, permitted_senders, 1 FROM auto_aliases
+			WHERE source NOT LIKE '@%' AND source NOT IN (SELECT source FROM aliases)
+		) WHERE """ + where + " ORDER BY domain, source LIMIT ?",
+		params + [limit + 1 if limit is not None else -1])
+	aliases = c.fetchall()
+	more = limit is not None and len(aliases) > limit
+	return [alias[1:] for alias in aliases[:limit]], more
+
+
+def get_mail_aliases_by_domain(aliases):
+	# Returns the aliases from get_mail_aliases_page the way get_mail_aliases_ex
+	# does, grouped by domain in the order they come in.
+	return group_by_domain([
+		{
 			"address":
 			address,
 			"address_display":
@@ -321,27 +568,16 @@ def get_mail_aliases_ex(env):
 			] if permitted_senders is not None else None,
 			"auto":
 			bool(auto),
-		})
-
-	# Sort domains.
-	domains = [
-		domains[domain] for domain in utils.sort_domains(domains.keys(), env)
-	]
-
-	# Sort aliases within each domain first by required-ness then lexicographically by address.
-	for domain in domains:
-		domain["aliases"].sort(
-			key=lambda alias: (alias["auto"], alias["address"]))
-	return domains
+		}
+		for address, forwards_to, permitted_senders, auto in aliases
+	], "address", "aliases")
 
 
 def get_noreply_addresses(env):
 	# Returns a set of noreply addresses:
 	# Noreply addresses are a special type of addresses that are send-only.
 	# Mail sent to these addresses is automatically bounced with a customized message..
-	c = open_database(env)
-	c.execute('SELECT email FROM noreply')
-	return set(row[0] for row in c.fetchall())
+	return set(get_directory(env).noreply)
 
 
 def get_domain(emailaddr, as_unicode=True):
@@ -360,55 +596,48 @@ def get_domain(emailaddr, as_unicode=True):
 
 def get_all_mail_addresses(env, no_catchalls=True):
 	# Gets the email addresses on literally all tables (users, aliases and noreplies)
-	emails = get_mail_users(env)
-	emails.extend([a[0] for a in get_mail_aliases(env)])
-	emails.extend(get_noreply_addresses(env))
+	directory = get_directory(env)
 
 	# Filter out catch-alls
 	if no_catchalls:
-		return set(filter(lambda e: e.split("@")[0].strip != "", emails))
+		return directory.addresses - directory.catchalls
 
-	return set(emails)
+	return set(directory.addresses)
 
 
-def get_mail_domains(env, filter_aliases=lambda alias: True, users_only=False):
+def get_mail_domains(env, filter_aliases=None, users_only=False):
 	# Returns the domain names (IDNA-encoded) of all of the email addresses
 	# configured on the system. If users_only is True, only return domains
 	# with email addresses that correspond to user accounts. Exclude Unicode
 	# forms of domain names listed in the automatic aliases table.
-	domains = []
-	domains.extend(
-		[get_domain(login, as_unicode=False) for login in get_mail_users(env)])
-	if not users_only:
-		domains.extend([
-			get_domain(address, as_unicode=False)
-			for address, _, _, auto in get_mail_aliases(env)
-			if filter_aliases(address) and not auto
-		])
-		domains.extend([
-			get_domain(address, as_unicode=False)
-			for address in get_noreply_addresses(env)
-		])
-	return set(domains)
+	directory = get_directory(env)
+	if users_only:
+		return set(directory.user_domains)
+	if filter_aliases is None:
+		return set(directory.domains)
+	return (directory.user_domains
+		| set(domain for address, domain in directory.alias_domains if filter_aliases(address))
+		| set(get_domain(address, as_unicode=False) for address in directory.noreply))
 
 
-def add_mail_user(email, pw, privs, quota, env):
+def validate_mail_user(email, pw, privs, quota, env, first_account=False):
+	# Validates a new user account. Returns its privileges as a list and its
+	# quota, or raises a ValueError.
+
 	# validate email
 	if email.strip() == "":
-		return ("No email address provided.", 400)
+		raise ValueError("No email address provided.")
 	elif not validate_email(email):
-		return ("Invalid email address.", 400)
+		raise ValueError("Invalid email address.")
 	elif not validate_email(email, mode='user'):
-		return (
-			"User account email addresses may only use the lowercase ASCII letters a-z, the digits 0-9, underscore (_), hyphen (-), and period (.).",
-			400)
-	elif is_dcv_address(email) and len(get_mail_users(env)) > 0:
+		raise ValueError(
+			"User account email addresses may only use the lowercase ASCII letters a-z, the digits 0-9, underscore (_), hyphen (-), and period (.).")
+	elif is_dcv_address(email) and not first_account:
 		# Make domain control validation hijacking a little harder to mess up by preventing the usual
 		# addresses used for DCV from being user accounts. Except let it be the first account because
 		# during box setup the user won't know the rules.
-		return (
-			"You may not make a user account for that address because it is frequently used for domain control validation. Use an alias instead if necessary.",
-			400)
+		raise ValueError(
+			"You may not make a user account for that address because it is frequently used for domain control validation. Use an alias instead if necessary.")
 
 	# validate password
 	validate_password(pw)
@@ -421,37 +650,93 @@ def add_mail_user(email, pw, privs, quota, env):
 		for p in privs:
 			validation = validate_privilege(p)
 			if validation:
-				return validation
+				raise ValueError(validation[0])
 
 	if quota is None:
-		quota = get_default_quota()
+		quota = get_default_quota(env)
+
+	return privs, validate_quota(quota)
+
 
+def add_mail_user(email, pw, privs, quota, env):
 	try:
-		quota = validate_quota(quota)
+		privs, quota = validate_mail_user(email, pw, privs, quota, env,
+			first_account=len(get_mail_users(env)) == 0)
 	except ValueError as e:
 		return (str(e), 400)
 
-	# get the database
-	conn, c = open_database(env, with_connection=True)
-
 	# hash the password
-	pw = hash_password(pw)
-
-	# add the user to the database
-	try:
-		c.execute(
-			"INSERT INTO users (email, password, privileges, quota) VALUES (?, ?, ?, ?)",
-			(email, pw, "\n".join(privs), quota))
-	except sqlite3.IntegrityError:
-		return ("User already exists.", 400)
+	pw = passwords.hash_password(pw)
 
-	# write databasebefore next step
-	conn.commit()
+	# add the user to the database, and write it before the next step
+	with database.transaction(env) as c:
+		try:
+			c.execute(
+				"INSERT INTO users (email, password, privileges, quota) VALUES (?, ?, ?, ?)",
+				(email, pw, "\n".join(privs), quota))
+		except sqlite3.IntegrityError:
+			return ("User already exists.", 400)
 
 	dovecot_quota_recalc(email)
 
 	# Update things in case any new domains are added.
-	return kick(env, "mail user added")
+	return kick(env, "mail user added", [get_domain(email, as_unicode=False)])
+
+
+def add_mail_users(rows, env):
+	# Adds many user accounts at once. rows is a list of dicts with an email,
+	# a password and optionally privileges and a quota, like the arguments of
+	# add_mail_user. The rows that are valid are added in a single transaction
+	# and the system is updated once afterwards. Returns a list with the
+	# result of each row, and the output of kick.
+	results = []
+	users = []
+	emails = set(get_mail_users(env))
+	first_account = len(emails) == 0
+	for row in rows:
+		email = str(row.get("email") or "").strip()
+		pw = str(row.get("password") or "")
+		privs = row.get("privileges")
+		if isinstance(privs, list):
+			privs = "\n".join(privs)
+		quota = row.get("quota")
+		try:
+			if email in emails:
+				raise ValueError("User already exists.")
+			privs, quota = validate_mail_user(email, pw, privs, str(quota) if quota not in (None, "") else None, env,
+				first_account=first_account)
+		except ValueError as e:
+			results.append({"email": email, "result": "error", "message": str(e)})
+			continue
+		emails.add(email)
+		first_account = False
+		result = {"email": email, "result": "added"}
+		results.append(result)
+		users.append((result, email, pw, privs, quota))
+
+	if not users:
+		return results, ""
+
+	hashes = passwords.hash_passwords([pw for _, _, pw, _, _ in users])
+
+	with database.transaction(env) as c:
+		for (result, email, _, privs, quota), pw in zip(users, hashes):
+			try:
+				c.execute(
+					"INSERT INTO users (email, password, privileges, quota) VALUES (?, ?, ?, ?)",
+					(email, pw, "\n".join(privs), quota))
+			except sqlite3.IntegrityError:
+				result.update(result="error", message="User already exists.")
+
+	added = [email for result, email, _, _, _ in users if result["result"] == "added"]
+	dovecot_quota_recalc(*added)
+
+	if not added:
+		return results, ""
+
+	# Update things in case any new domains are added.
+	return results, kick(env, "%d mail users added" % len(added),
+		set(get_domain(email, as_unicode=False) for email in added))
 
 
 def set_mail_password(email, pw, env):
@@ -459,28 +744,18 @@ def set_mail_password(email, pw, env):
 	validate_password(pw)
 
 	# hash the password
-	pw = hash_password(pw)
+	pw = passwords.hash_password(pw)
 
 	# update the database
-	conn, c = open_database(env, with_connection=True)
-	c.execute("UPDATE users SET password=? WHERE email=?", (pw, email))
-	if c.rowcount != 1:
-		return ("That's not a user (%s)." % email, 400)
-	conn.commit()
+	with database.transaction(env) as c:
+		c.execute("UPDATE users SET password=? WHERE email=?", (pw, email))
+		if c.rowcount != 1:
+			return ("That's not a user (%s)." % email, 400)
 	return "OK"
 
 
-def hash_password(pw):
-	# Turn the plain password into a Dovecot-format hashed password, meaning
-	# something like "{SCHEME}hashedpassworddata".
-	# http://wiki2.dovecot.org/Authentication/PasswordSchemes
-	return utils.shell(
-		'check_output',
-		["/usr/bin/doveadm", "pw", "-s", "SHA512-CRYPT", "-p", pw]).strip()
-
-
 def get_mail_quota(email, env):
-	conn, c = open_database(env, with_connection=True)
+	c = database.cursor(env)
 	c.execute("SELECT quota FROM users WHERE email=?", (email, ))
 	rows = c.fetchall()
 	if len(rows) != 1:
@@ -494,26 +769,63 @@ def set_mail_quota(email, quota, env):
 	quota = validate_quota(quota)
 
 	# update the database
-	conn, c = open_database(env, with_connection=True)
-	c.execute("UPDATE users SET quota=? WHERE email=?", (quota, email))
-	if c.rowcount != 1:
-		return ("That's not a user (%s)." % email, 400)
-	conn.commit()
+	with database.transaction(env) as c:
+		c.execute("UPDATE users SET quota=? WHERE email=?", (quota, email))
+		if c.rowcount != 1:
+			return ("That's not a user (%s)." % email, 400)
 
 	dovecot_quota_recalc(email)
 
 	return "OK"
 
 
-def dovecot_quota_recalc(email):
+def set_mail_quotas(rows, env):
+	# Sets the quotas of many users at once. rows is a list of dicts with an
+	# email and a quota. The quotas that are valid are set in a single
+	# transaction and Dovecot recalculates them afterwards in one batch.
+	# Returns a list with the result of each row.
+	results = []
+	updates = []
+	for row in rows:
+		email = str(row.get("email") or "").strip()
+		try:
+			quota = validate_quota(str(row.get("quota") or ""))
+		except ValueError as e:
+			results.append({"email": email, "result": "error", "message": str(e)})
+			continue
+		result = {"email": email, "result": "updated", "quota": quota}
+		results.append(result)
+		updates.append((result, email, quota))
+
+	with database.transaction(env) as c:
+		for result, email, quota in updates:
+			c.execute("UPDATE users SET quota=? WHERE email=?", (quota, email))
+			if c.rowcount != 1:
+				result.update(result="error", message="That's not a user (%s)." % email)
+				del result["quota"]
+
+	dovecot_quota_recalc(*[email for result, email, _ in updates if result["result"] == "updated"])
+
+	return results
+
+
+def dovecot_quota_recalc(*emails):
 	# dovecot processes running for the user will not recognize the new quota setting
 	# a reload is necessary to reread the quota setting, but it will also shut down
 	# running dovecot processes.  Email clients generally log back in when they lose
 	# a connection.
 	# subprocess.call(['doveadm', 'reload'])
 
-	# force dovecot to recalculate the quota info for the user.
-	subprocess.call(["doveadm", "quota", "recalc", "-u", email])
+	# force dovecot to recalculate the quota info for the users. In the management
+	# daemon this happens in the background, see dovecot_quota.py.
+	if not emails:
+		return
+	import dovecot_quota
+	import reconfigure
+	if reconfigure.is_running():
+		dovecot_quota.recalc_later(emails)
+	else:
+		dovecot_quota.recalc(list(emails))
 
 
 def get_default_quota(env):
@@ -541,7 +853,7 @@ def get_mail_password(email, env):
 	# password format, with a prefixed scheme.
 	# http://wiki2.dovecot.org/Authentication/PasswordSchemes
 	# update the database
-	c = open_database(env)
+	c = database.cursor(env)
 	c.execute('SELECT password FROM users WHERE email=?', (email, ))
 	rows = c.fetchall()
 	if len(rows) != 1:
@@ -551,14 +863,13 @@ def get_mail_password(email, env):
 
 def remove_mail_user(email, env):
 	# remove
-	conn, c = open_database(env, with_connection=True)
-	c.execute("DELETE FROM users WHERE email=?", (email, ))
-	if c.rowcount != 1:
-		return ("That's not a user (%s)." % email, 400)
-	conn.commit()
+	with database.transaction(env) as c:
+		c.execute("DELETE FROM users WHERE email=?", (email, ))
+		if c.rowcount != 1:
+			return ("That's not a user (%s)." % email, 400)
 
 	# Update things in case any domains are removed.
-	return kick(env, "mail user removed")
+	return kick(env, "mail user removed", [get_domain(email, as_unicode=False)])
 
 
 def parse_privs(value):
@@ -567,14 +878,12 @@ def parse_privs(value):
 
 def get_mail_user_privileges(email, env, empty_on_error=False):
 	# get privs
-	c = open_database(env)
-	c.execute('SELECT privileges FROM users WHERE email=?', (email, ))
-	rows = c.fetchall()
-	if len(rows) != 1:
+	privileges = get_directory(env).privileges.get(email)
+	if privileges is None:
 		if empty_on_error:
 			return []
 		return ("That's not a user (%s)." % email, 400)
-	return parse_privs(rows[0][0])
+	return list(privileges)
 
 
 def validate_privilege(priv):
@@ -604,22 +913,19 @@ def add_remove_mail_user_privilege(email, priv, action, env):
 		return ("Invalid action.", 400)
 
 	# commit to database
-	conn, c = open_database(env, with_connection=True)
-	c.execute("UPDATE users SET privileges=? WHERE email=?",
-			("\n".join(privs), email))
-	if c.rowcount != 1:
-		return ("Something went wrong.", 400)
-	conn.commit()
+	with database.transaction(env) as c:
+		c.execute("UPDATE users SET privileges=? WHERE email=?",
+				("\n".join(privs), email))
+		if c.rowcount != 1:
+			return ("Something went wrong.", 400)
 
 	return "OK"
 
 
-def add_mail_alias(address,
-				forwards_to,
-				permitted_senders,
-				env,
-				update_if_exists=False,
-				do_kick=True):
+def validate_mail_alias(address, forwards_to, permitted_senders, env):
+	# Validates an alias. Returns its address, forwards_to and permitted_senders
+	# as they are stored in the database, or raises a ValueError.
+
 	# convert Unicode domain to IDNA
 	address = sanitize_idn_email_address(address)
 
@@ -630,9 +936,9 @@ def add_mail_alias(address,
 	# validate address
 	address = address.strip()
 	if address == "":
-		return ("No email address provided.", 400)
+		raise ValueError("No email address provided.")
 	if not validate_email(address, mode='alias'):
-		return ("Invalid email address (%s)." % address, 400)
+		raise ValueError("Invalid email address (%s)." % address)
 
 	# validate forwards_to
 	validated_forwards_to = []
@@ -662,21 +968,19 @@ def add_mail_alias(address,
 				# Strip any +tag from email alias and check privileges
 				privileged_email = re.sub(r"(?=\+)[^@]*(?=@)", '', email)
 				if not validate_email(email):
-					return ("Invalid receiver email address (%s)." % email,
-							400)
+					raise ValueError("Invalid receiver email address (%s)." % email)
 				if is_dcv_source and not is_dcv_address(
 					email) and "admin" not in get_mail_user_privileges(
 						privileged_email, env, empty_on_error=True):
 					# Make domain control validation hijacking a little harder to mess up by
 					# requiring aliases for email addresses typically used in DCV to forward
 					# only to accounts that are administrators on this system.
-					return (
-						"This alias can only have administrators of this system as destinations because the address is frequently used for domain control validation.",
-						400)
+					raise ValueError(
+						"This alias can only have administrators of this system as destinations because the address is frequently used for domain control validation.")
 				validated_forwards_to.append(email)
 
 	# validate permitted_senders
-	valid_logins = get_mail_users(env)
+	valid_logins = get_directory(env).privileges
 	validated_permitted_senders = []
 	permitted_senders = permitted_senders.strip()
 
@@ -688,18 +992,15 @@ def add_mail_alias(address,
 			if login == "":
 				continue
 			if login not in valid_logins:
-				return (
+				raise ValueError(
 					"Invalid permitted sender: %s is not a user on this system."
-					% login, 400)
+					% login)
 			validated_permitted_senders.append(login)
 
 	# Make sure the alias has either a forwards_to or a permitted_sender.
 	if len(validated_forwards_to) + len(validated_permitted_senders) == 0:
-		return (
-			"The alias must either forward to an address or have a permitted sender.",
-			400)
-
-	# save to db
+		raise ValueError(
+			"The alias must either forward to an address or have a permitted sender.")
 
 	forwards_to = ",".join(validated_forwards_to)
 
@@ -708,26 +1009,95 @@ def add_mail_alias(address,
 	else:
 		permitted_senders = ",".join(validated_permitted_senders)
 
-	conn, c = open_database(env, with_connection=True)
+	return address, forwards_to, permitted_senders
+
+
+def add_mail_alias(address,
+				forwards_to,
+				permitted_senders,
+				env,
+				update_if_exists=False,
+				do_kick=True):
 	try:
-		c.execute(
-			"INSERT INTO aliases (source, destination, permitted_senders) VALUES (?, ?, ?)",
-			(address, forwards_to, permitted_senders))
-		return_status = "alias added"
-	except sqlite3.IntegrityError:
-		if not update_if_exists:
-			return ("Alias already exists (%s)." % address, 400)
-		else:
-			c.execute(
-				"UPDATE aliases SET destination = ?, permitted_senders = ? WHERE source = ?",
-				(forwards_to, permitted_senders, address))
-			return_status = "alias updated"
+		address, forwards_to, permitted_senders = validate_mail_alias(
+			address, forwards_to, permitted_senders, env)
+	except ValueError as e:
+		return (str(e), 400)
 
-	conn.commit()
+	# save to db
+	with database.transaction(env) as c:
+		try:
+			c.execute(
+				"INSERT INTO aliases (source, destination, permitted_senders) VALUES (?, ?, ?)",
+				(address, forwards_to, permitted_senders))
+			return_status = "alias added"
+		except sqlite3.IntegrityError:
+			if not update_if_exists:
+				return ("Alias already exists (%s)." % address, 400)
+			else:
+				c.execute(
+					"UPDATE aliases SET destination = ?, permitted_senders = ? WHERE source = ?",
+					(forwards_to, permitted_senders, address))
+				return_status = "alias updated"
 
 	if do_kick:
 		# Update things in case any new domains are added.
-		return kick(env, return_status)
+		return kick(env, return_status, [get_domain(address, as_unicode=False)])
+
+
+def add_mail_aliases(rows, env, update_if_exists=False):
+	# Adds many aliases at once. rows is a list of dicts with an address,
+	# forwards_to and optionally permitted_senders, like the arguments of
+	# add_mail_alias. The rows that are valid are saved in a single
+	# transaction and the system is updated once afterwards. Returns a list
+	# with the result of each row, and the output of kick.
+	results = []
+	rows_by_address = {}
+	for row in rows:
+		address = str(row.get("address") or "")
+		try:
+			address, forwards_to, permitted_senders = validate_mail_alias(
+				address, str(row.get("forwards_to") or ""),
+				str(row.get("permitted_senders") or ""), env)
+		except ValueError as e:
+			results.append({"address": address, "result": "error", "message": str(e)})
+			continue
+		result = {"address": address, "result": "added"}
+		results.append(result)
+		rows_by_address.setdefault(address, []).append((result, forwards_to, permitted_senders))
+
+	# It's unclear which of the rows for the same address is meant, so none of them are saved.
+	aliases = {}
+	for address, address_rows in rows_by_address.items():
+		if len(address_rows) > 1:
+			for result, _, _ in address_rows:
+				result.update(result="error", message="Alias is in more than one row (%s)." % address)
+		else:
+			aliases[address] = address_rows[0]
+
+	with database.transaction(env) as c:
+		for address, (result, forwards_to, permitted_senders) in aliases.items():
+			try:
+				c.execute(
+					"INSERT INTO aliases (source, destination, permitted_senders) VALUES (?, ?, ?)",
+					(address, forwards_to, permitted_senders))
+			except sqlite3.IntegrityError:
+				if not update_if_exists:
+					result.update(result="error", message="Alias already exists (%s)." % address)
+				else:
+					c.execute(
+						"UPDATE aliases SET destination = ?, permitted_senders = ? WHERE source = ?",
+						(forwards_to, permitted_senders, address))
+					result.update(result="updated")
+
+	if not any(result["result"] != "error" for result in results):
+		return results, ""
+
+	# Update things in case any new domains are added.
+	return results, kick(env, "%d mail aliases added or updated" %
+		sum(1 for result in results if result["result"] != "error"),
+		set(get_domain(address, as_unicode=False)
+			for address, (result, _, _) in aliases.items() if result["result"] != "error"))
 
 
 def remove_mail_alias(address, env, do_kick=True):
@@ -735,25 +1105,23 @@ def remove_mail_alias(address, env, do_kick=True):
 	address = sanitize_idn_email_address(address)
 
 	# remove
-	conn, c = open_database(env, with_connection=True)
-	c.execute("DELETE FROM aliases WHERE source=?", (address, ))
-	if c.rowcount != 1:
-		return ("That's not an alias (%s)." % address, 400)
-	conn.commit()
+	with database.transaction(env) as c:
+		c.execute("DELETE FROM aliases WHERE source=?", (address, ))
+		if c.rowcount != 1:
+			return ("That's not an alias (%s)." % address, 400)
 
 	if do_kick:
 		# Update things in case any domains are removed.
-		return kick(env, "alias removed")
+		return kick(env, "alias removed", [get_domain(address, as_unicode=False)])
 
 
 def add_auto_aliases(aliases, env):
-	conn, c = open_database(env, with_connection=True)
-	c.execute("DELETE FROM auto_aliases")
-	for source, destination in aliases.items():
-		c.execute(
-			"INSERT INTO auto_aliases (source, destination) VALUES (?, ?)",
-			(source, destination))
-	conn.commit()
+	with database.transaction(env) as c:
+		c.execute("DELETE FROM auto_aliases")
+		for source, destination in aliases.items():
+			c.execute(
+				"INSERT INTO auto_aliases (source, destination) VALUES (?, ?)",
+				(source, destination))
 
 
 def get_system_administrator(env):
@@ -805,43 +1173,51 @@ def add_noreply_address(env, address, do_kick=True):
 	elif email in get_mail_aliases(env):
 		return ("This address is already an alias.", 400)
 
-	ret = ""
-
-	# Add the address
-	conn, c = open_database(env, with_connection=True)
-	try:
-		c.execute("INSERT INTO noreply (email) VALUES (?)", (email, ))
-		if do_kick:
-			ret = kick(env, "No-reply address (%s) added" % address)
-		else:
-			ret = "No-reply address (%s) added" % address
-	except sqlite3.IntegrityError:
-		return ("This noreply (%s) already exists." % address, 400)
+	# Add the address, and write it before kicking
+	with database.transaction(env) as c:
+		try:
+			c.execute("INSERT INTO noreply (email) VALUES (?)", (email, ))
+		except sqlite3.IntegrityError:
+			return ("This noreply (%s) already exists." % address, 400)
 
-	conn.commit()
-	return ret
+	if do_kick:
+		return kick(env, "No-reply address (%s) added" % address,
+			[get_domain(email, as_unicode=False)])
+	else:
+		return "No-reply address (%s) added" % address
 
 
 def remove_noreply_address(env, address, do_kick=True):
 	email = sanitize_idn_email_address(address)
 
 	# yeet yeet deleet
-	conn, c = open_database(env, with_connection=True)
-	c.execute("DELETE FROM noreply WHERE email=?", (email, ))
-	if c.rowcount != 1:
-		return ("That's not a noreply (%s)." % address, 400)
-	conn.commit()
+	with database.transaction(env) as c:
+		c.execute("DELETE FROM noreply WHERE email=?", (email, ))
+		if c.rowcount != 1:
+			return ("That's not a noreply (%s)." % address, 400)
 
 	if do_kick:
 		# Update things in case any domains are removed.
-		return kick(env, "No-reply address removed")
+		return kick(env, "No-reply address removed",
+			[get_domain(email, as_unicode=False)])
 
 
 def get_required_noreply_addresses(env):
 	return {"noreply-daemon@" + env['PRIMARY_HOSTNAME']}
 
 
-def kick(env, mail_result=None):
+def kick(env, mail_result=None, domains=None):
+	# Updates the system for changed users and aliases. In the management daemon
+	# this happens in the background, see reconfigure.py. domains are the
+	# domains of the addresses that changed, if known, so that only their DNS
+	# zones need to be rebuilt.
+	import reconfigure
+	if reconfigure.is_running():
+		return reconfigure.schedule("kick", mail_result, domains)
+	return run_kick(env, mail_result, domains)
+
+
+def run_kick(env, mail_result=None, domains=None):
 	results = []
 
 	# Include the current operation's result in output.
@@ -892,7 +1268,7 @@ def kick(env, mail_result=None):
 	# Update DNS and nginx in case any domains are added/removed.
 
 	from dns_update import do_dns_update
-	results.append(do_dns_update(env))
+	results.append(do_dns_update(env, domains=domains))
 
 	from web_update import do_web_update
 	results.append(do_web_update(env))
@@ -5,7 +5,7 @@ import os
 import pyotp
 import qrcode
 
-from mailconfig import open_database
+import database
 
 
 def get_user_id(email, c):
@@ -17,7 +17,7 @@ def get_user_id(email, c):
 
 
 def get_mfa_state(email, env):
-	c = open_database(env)
+	c = database.cursor(env)
 	c.execute(
 		'SELECT id, type, secret, mru_token, label FROM mfa WHERE user_id=?',
 		(get_user_id(email, c), ))
@@ -58,30 +58,27 @@ def enable_mfa(email, type, secret, token, label, env):
 	else:
 		raise ValueError("Invalid MFA type.")
 
-	conn, c = open_database(env, with_connection=True)
-	c.execute(
-		'INSERT INTO mfa (user_id, type, secret, label) VALUES (?, ?, ?, ?)',
-		(get_user_id(email, c), type, secret, label))
-	conn.commit()
+	with database.transaction(env) as c:
+		c.execute(
+			'INSERT INTO mfa (user_id, type, secret, label) VALUES (?, ?, ?, ?)',
+			(get_user_id(email, c), type, secret, label))
 
 
 def set_mru_token(email, mfa_id, token, env):
-	conn, c = open_database(env, with_connection=True)
-	c.execute('UPDATE mfa SET mru_token=? WHERE user_id=? AND id=?',
-			(token, get_user_id(email, c), mfa_id))
-	conn.commit()
+	with database.transaction(env) as c:
+		c.execute('UPDATE mfa SET mru_token=? WHERE user_id=? AND id=?',
+				(token, get_user_id(email, c), mfa_id))
 
 
 def disable_mfa(email, mfa_id, env):
-	conn, c = open_database(env, with_connection=True)
-	if mfa_id is None:
-		# Disable all MFA for a user.
-		c.execute('DELETE FROM mfa WHERE user_id=?', (get_user_id(email, c), ))
-	else:
-		# Disable a particular MFA mode for a user.
-		c.execute('DELETE FROM mfa WHERE user_id=? AND id=?',
-				(get_user_id(email, c), mfa_id))
-	conn.commit()
+	with database.transaction(env) as c:
+		if mfa_id is None:
+			# Disable all MFA for a user.
+			c.execute('DELETE FROM mfa WHERE user_id=?', (get_user_id(email, c), ))
+		else:
+			# Disable a particular MFA mode for a user.
+			c.execute('DELETE FROM mfa WHERE user_id=? AND id=?',
+					(get_user_id(email, c), mfa_id))
 	return c.rowcount > 0
 
 
@@ -0,0 +1,194 @@
+#!/usr/local/lib/mailinabox/env/bin/python
+#
+# Hashes and checks passwords in Dovecot's format ("{SCHEME}hashedpassworddata",
+# see http://wiki2.dovecot.org/Authentication/PasswordSchemes) in-process,
+# rather than running doveadm pw for each password, which costs a fork and exec
+# on every login.
+#
+# New passwords are hashed with SHA512-CRYPT like `doveadm pw -s SHA512-CRYPT`
+# does. That uses the system's crypt(3) while Python still has the crypt
+# module, and otherwise the implementation below, which follows
+# https://www.akkadia.org/drepper/SHA-crypt.txt. Passwords hashed with other
+# crypt(3) schemes (e.g. BLF-CRYPT) are checked with crypt(3) as well. Anything
+# else (e.g. ARGON2) is left to doveadm.
+
+import concurrent.futures
+import hashlib
+import hmac
+import json
+import os
+import secrets
+import subprocess
+import sys
+
+import utils
+
+try:
+	import crypt
+except ImportError:
+	# Python 3.13 removed the crypt module.
+	crypt = None
+
+SCHEME = "SHA512-CRYPT"
+
+# The Dovecot schemes that are hashed with crypt(3)
+CRYPT_SCHEMES = ("CRYPT", "DES-CRYPT", "MD5-CRYPT", "BLF-CRYPT", "SHA256-CRYPT", "SHA512-CRYPT")
+
+ROUNDS_DEFAULT = 5000
+ROUNDS_MIN = 1000
+ROUNDS_MAX = 999999999
+SALT_LENGTH = 16
+
+# The alphabet of crypt(3)'s base 64 encoding
+ITOA64 = "./0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz"
+
+# The order in which the bytes of the final digest are encoded, three at a time
+SHA512_ORDER = (
+	(0, 21, 42), (22, 43, 1), (44, 2, 23), (3, 24, 45), (25, 46, 4), (47, 5, 26),
+	(6, 27, 48), (28, 49, 7), (50, 8, 29), (9, 30, 51), (31, 52, 10), (53, 11, 32),
+	(12, 33, 54), (34, 55, 13), (56, 14, 35), (15, 36, 57), (37, 58, 16), (59, 17, 38),
+	(18, 39, 60), (40, 61, 19), (62, 20, 41),
+)
+
+# Which parts go into the digest of each round. The pattern repeats every 42 rounds.
+ROUND_PARTS = tuple((i & 1, i % 3 != 0, i % 7 != 0) for i in range(42))
+
+# Hashing a password takes a while on purpose, so when many are hashed at once
+# (e.g. when adding users in bulk) they are spread over up to this many processes,
+# each given at least POOL_MIN_PASSWORDS to make up for starting Python.
+POOL_SIZE = min(4, os.cpu_count() or 1)
+POOL_MIN_PASSWORDS = 25
+
+
+def repeat(data, length):
+	# data repeated as often as fits in length bytes, and then the first bytes of data
+	return data * (length // len(data)) + data[:length % len(data)]
+
+
+def b64_from_24bit(b2, b1, b0, n):
+	w = (b2 << 16) | (b1 << 8) | b0
+	ret = []
+	for _ in range(n):
+		ret.append(ITOA64[w & 0x3f])
+		w >>= 6
+	return "".join(ret)
+
+
+def sha512_crypt(password, setting):
+	# Hashes a password with SHA-512 crypt. setting is "$6$salt" or "$6$rounds=N$salt",
+	# optionally followed by "$" and an existing hash, like crypt(3) takes it.
+	if not setting.startswith("$6$"):
+		raise ValueError("Not a SHA-512 crypt setting.")
+	parts = setting[3:].split("$")
+	rounds = None
+	if parts[0].startswith("rounds="):
+		try:
+			rounds = min(max(int(parts.pop(0)[7:]), ROUNDS_MIN), ROUNDS_MAX)
+		except ValueError:
+			raise ValueError("Invalid number of rounds.")
+	salt = parts[0][:SALT_LENGTH]
+
+	pw = password.encode("utf8")
+	s = salt.encode("utf8")
+
+	b = hashlib.sha512(pw + s + pw).digest()
+	a = hashlib.sha512(pw + s + repeat(b, len(pw)))
+	i = len(pw)
+	while i:
+		a.update(b if i & 1 else pw)
+		i >>= 1
+	a = a.digest()
+
+	p = repeat(hashlib.sha512(pw * len(pw)).digest(), len(pw)) if pw else b""
+	s = repeat(hashlib.sha512(s * (16 + a[0])).digest(), len(s)) if s else b""
+
+	sha512 = hashlib.sha512
+	c = a
+	for i in range(rounds or ROUNDS_DEFAULT):
+		odd, with_s, with_p = ROUND_PARTS[i % 42]
+		if odd:
+			c = sha512(p + (s if with_s else b"") + (p if with_p else b"") + c).digest()
+		else:
+			c = sha512(c + (s if with_s else b"") + (p if with_p else b"") + p).digest()
+
+	encoded = "".join(b64_from_24bit(c[x], c[y], c[z], 4) for x, y, z in SHA512_ORDER)
+	encoded += b64_from_24bit(0, 0, c[63], 2)
+
+	if rounds is None:
+		return "$6$%s$%s" % (salt, encoded)
+	return "$6$rounds=%d$%s$%s" % (rounds, salt, encoded)
+
+
+def crypt_sha512(password, setting):
+	# Like sha512_crypt, but using crypt(3) if we can, which is faster.
+	if crypt is not None:
+		result = crypt.crypt(password, setting)
+		if result is not None and result.startswith("$6$"):
+			return result
+	return sha512_crypt(password, setting)
+
+
+def hash_password(pw):
+	# Turn the plain password into a Dovecot-format hashed password, meaning
+	# something like "{SCHEME}hashedpassworddata".
+	salt = "".join(secrets.choice(ITOA64) for _ in range(SALT_LENGTH))
+	return "{%s}%s" % (SCHEME, crypt_sha512(pw, "$6$" + salt))
+
+
+def hash_passwords(passwords):
+	# Hashes many passwords, in parallel processes if there are enough of them.
+	# The processes run this file in a new Python rather than being forked by
+	# multiprocessing, since a fork of the management daemon could hang on a
+	# lock that one of its other threads held (e.g. logging's). Threads alone
+	# wouldn't help, since hashing holds the GIL.
+	size = max(-(-len(passwords) // POOL_SIZE), POOL_MIN_PASSWORDS)
+	if len(passwords) <= size:
+		return [hash_password(pw) for pw in passwords]
+
+	def hash_in_process(chunk):
+		# (Importing crypt in __main__ warns that it's deprecated.)
+		return json.loads(subprocess.run([sys.executable, "-W", "ignore::DeprecationWarning", os.path.abspath(__file__)],
+			input=json.dumps(chunk), stdout=subprocess.PIPE, text=True, check=True).stdout)
+
+	chunks = [passwords[i:i + size] for i in range(0, len(passwords), size)]
+	with concurrent.futures.ThreadPoolExecutor(len(chunks)) as pool:
+		return [pw_hash for hashes in pool.map(hash_in_process, chunks) for pw_hash in hashes]
+
+
+def check_password(pw, pw_hash):
+	# Returns whether a plain password matches a Dovecot-format hashed password.
+	scheme, hashed = "CRYPT", pw_hash
+	if pw_hash.startswith("{") and "}" in pw_hash:
+		scheme, hashed = pw_hash[1:].split("}", 1)
+		scheme = scheme.upper()
+
+	if scheme in CRYPT_SCHEMES and hashed.startswith("$6$"):
+		try:
+			return hmac.compare_digest(crypt_sha512(pw, hashed).encode("utf8"), hashed.encode("utf8"))
+		except ValueError:
+			return False
+
+	if scheme in CRYPT_SCHEMES and crypt is not None:
+		result = crypt.crypt(pw, hashed)
+		return result is not None and hmac.compare_digest(result.encode("utf8"), hashed.encode("utf8"))
+
+	# Use 'doveadm pw' to check credentials. doveadm will return
+	# a non-zero exit status if the credentials are no good,
+	# and check_call will raise an exception in that case.
+	try:
+		utils.shell('check_call', [
+			"/usr/bin/doveadm",
+			"pw",
+			"-p",
+			pw,
+			"-t",
+			pw_hash,
+		])
+	except:
+		return False
+	return True
+
+
+if __name__ == "__main__":
+	# Hashes the JSON list of passwords on stdin for hash_passwords.
+	json.dump([hash_password(pw) for pw in json.load(sys.stdin)], sys.stdout)
@@ -0,0 +1,164 @@
+#!/usr/local/lib/mailinabox/env/bin/python
+#
+# Runs kick, do_dns_update and do_web_update in a background thread of the
+# management daemon, so that API calls that change the configuration don't
+# wait for the system to be updated.
+#
+# A change waits DEBOUNCE seconds for more changes (but no longer than
+# MAX_DELAY seconds in total) and then all of the changes that came in are
+# applied by a single job. The jobs can be followed at /system/jobs. If every
+# change said which domains it was about, only the DNS zones of those domains
+# are rebuilt.
+#
+# Outside of the daemon (e.g. `mailconfig.py update`), start() is never called
+# and the system is updated right away, as before.
+
+import itertools
+import threading
+import time
+from collections import OrderedDict
+
+DEBOUNCE = 2
+MAX_DELAY = 30
+
+# How many finished jobs to remember
+KEEP_JOBS = 20
+
+# Held while the system is being updated. Take it to update the system from
+# another thread (e.g. an API call that does so right away).
+lock = threading.RLock()
+
+# Guards the job bookkeeping below, and wakes the worker up
+changed = threading.Condition()
+
+env = None
+worker = None
+job_numbers = itertools.count(1)
+jobs = OrderedDict()
+pending = None
+
+
+class Job:
+	__slots__ = ("id", "tasks", "reasons", "domains", "status", "first_change",
+				"last_change", "started", "finished", "output")
+
+	def __init__(self):
+		self.id = next(job_numbers)
+		self.tasks = set()
+		self.reasons = []
+		self.domains = set()  # or None for all of them
+		self.status = "pending"
+		self.first_change = self.last_change = time.time()
+		self.started = self.finished = None
+		self.output = None
+
+	def due(self):
+		# When the job runs, unless more changes come in
+		return min(self.last_change + DEBOUNCE, self.first_change + MAX_DELAY)
+
+	def as_dict(self):
+		return {
+			"id": self.id,
+			"tasks": sorted(self.tasks),
+			"reasons": self.reasons,
+			"status": self.status,
+			"created": self.first_change,
+			"started": self.started,
+			"finished": self.finished,
+			"output": self.output,
+		}
+
+
+def start(environment):
+	# Updates the system in the background from now on.
+	global env
+	env = environment
+
+
+def is_running():
+	return env is not None
+
+
+def schedule(task, reason=None, domains=None):
+	# Asks the worker to run a task ("kick", "dns" or "web"), together with the
+	# other tasks asked for around the same time. For "kick" and "dns", domains
+	# are the domains that changed, if known. Returns a message for the user.
+	global pending, worker
+	with changed:
+		if worker is None or not worker.is_alive():
+			worker = threading.Thread(target=run_jobs, name="reconfigure", daemon=True)
+			worker.start()
+
+		if pending is None:
+			pending = Job()
+			jobs[pending.id] = pending
+			while len(jobs) > KEEP_JOBS and next(iter(jobs.values())).status in ("done", "failed"):
+				jobs.popitem(last=False)
+		pending.tasks.add(task)
+		if task in ("kick", "dns") and pending.domains is not None:
+			if domains is None:
+				pending.domains = None
+			else:
+				pending.domains.update(domains)
+		if reason is not None:
+			pending.reasons.append(reason)
+		pending.last_change = time.time()
+		changed.notify()
+		job = pending
+
+	return "".join([
+		reason + "\n" if reason else "",
+		"The system configuration will be updated in the background (job %d).\n" % job.id
+	])
+
+
+def get_jobs():
+	with changed:
+		return [job.as_dict() for job in jobs.values()]
+
+
+def get_job(job_id):
+	with changed:
+		job = jobs.get(job_id)
+		return job.as_dict() if job is not None else None
+
+
+def run_jobs():
+	global pending
+	while True:
+		with changed:
+			while pending is None or time.time() < pending.due():
+				changed.wait(None if pending is None else pending.due() - time.time())
+			job = pending
+			pending = None
+			job.status = "running"
+			job.started = time.time()
+
+		try:
+			with lock:
+				output = run_tasks(job.tasks, job.domains)
+			status = "done"
+		except Exception as e:
+			output = str(e)
+			status = "failed"
+
+		with changed:
+			job.output = output
+			job.status = status
+			job.finished = time.time()
+
+
+def run_tasks(tasks, domains=None):
+	if "kick" in tasks:
+		# kick updates DNS and the web configuration too.
+		from mailconfig import run_kick
+		return run_kick(env, domains=domains)
+
+	results = []
+	if "dns" in tasks:
+		from dns_update import do_dns_update
+		results.append(do_dns_update(env, domains=domains))
+	if "web" in tasks:
+		from web_update import do_web_update
+		results.append(do_web_update(env))
+	return "".join(results)
@@ -420,7 +420,9 @@ def provision_certificates(env, limit_domains):
 			ret[-1]["result"] = "error"
 
 	# Run post-install steps.
-	ret.extend(post_install_func(env))
+	ret.extend(post_install_func(env, [
+		domain for request in ret if request["result"] == "installed"
+		for domain in request["domains"]]))
 
 	# Return what happened with each certificate request.
 	return ret
@@ -492,10 +494,11 @@ def install_cert(domain, ssl_cert, ssl_chain, env, raw=False):
 		return cert_status
 
 	# Copy certifiate into ssl directory.
+	cert_domains, cn = get_certificate_domains(load_pem(load_cert_chain(fn)[0]))
 	install_cert_copy_file(fn, env)
 
 	# Run post-install steps.
-	ret = post_install_func(env)
+	ret = post_install_func(env, cert_domains)
 	if raw:
 		return ret
 	return "\n".join(ret)
@@ -524,7 +527,8 @@ def install_cert_copy_file(fn, env):
 	shutil.move(fn, ssl_certificate)
 
 
-def post_install_func(env):
+def post_install_func(env, domains=None):
+	# domains are the domains of the certificates that were installed, if known.
 	ret = []
 
 	# Get the certificate to use for PRIMARY_HOSTNAME.
@@ -560,6 +564,15 @@ def post_install_func(env):
 		# hasn't changed. We don't ever change the private key automatically.
 		# If the user does it, they must manually update DNS.
 
+	# Update DNS for the MTA-STS records of the domains with new certificates.
+	# They depend on the certificate for PRIMARY_HOSTNAME too, so if that is
+	# new, all of the zones are updated. If no certificate was installed, there
+	# is nothing to update.
+	if domains != []:
+		if domains is not None and env['PRIMARY_HOSTNAME'] in domains:
+			domains = None
+		ret.append(update_dns(env, domains))
+
 	# Update the web configuration so nginx picks up the new certificate file.
 	from web_update import do_web_update
 	ret.append(do_web_update(env))
@@ -567,6 +580,32 @@ def post_install_func(env):
 	return ret
 
 
+def update_dns(env, domains):
+	# DNS is only ever updated by the management daemon, so that updates don't
+	# race each other. In the daemon, the update is queued with the other
+	# changes (see reconfigure.py). Elsewhere (e.g. the daily
+	# `ssl_certificates.py -q`), the daemon is asked to update DNS. Either
+	# way only the zones of the domains are rebuilt, unless domains is None.
+	import reconfigure
+	if reconfigure.is_running():
+		return reconfigure.schedule("dns", "New certificates were installed.", domains)
+
+	import base64
+	import urllib.parse
+	import urllib.request
+	try:
+		with open('/var/lib/mailinabox/api.key') as f:
+			key = f.read().strip()
+		request = urllib.request.Request(
+			'http://127.0.0.1:10222/dns/update',
+			urllib.parse.urlencode({} if domains is None else {"domains": ",".join(domains)}).encode("ascii"),
+			headers={"Authorization": "Basic " + base64.b64encode((key + ":").encode("utf8")).decode("ascii")})
+		with urllib.request.urlopen(request) as response:
+			return response.read().decode("utf8")
+	except OSError as e:
+		return "DNS was not updated, run tools/dns_update when the management daemon is running: %s\n" % e
+
+
 # VALIDATION OF CERTIFICATES
 
 
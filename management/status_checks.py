@@ -24,7 +24,7 @@ import postfix_mta_sts_resolver.resolver
 from dns_update import get_dns_zones, build_tlsa_record, get_custom_dns_config, get_secondary_dns, get_custom_dns_records
 from web_update import get_web_domains, get_domains_with_a_records
 from ssl_certificates import get_ssl_certificates, get_domain_ssl_files, check_certificate
-from mailconfig import get_mail_domains, get_mail_aliases
+from mailconfig import get_mail_domains, get_mail_aliases, get_all_mail_addresses
 from pgp import get_daemon_key, get_imported_keys
 
 from utils import shell, sort_domains, load_env_vars_from_file, load_settings
@@ -1199,7 +1199,7 @@ def check_mail_domain(domain, env, output):
 
 	# Check that the postmaster@ email address exists. Not required if the domain has a
 	# catch-all address or domain alias.
-	if "@" + domain not in [address for address, *_ in get_mail_aliases(env)]:
+	if "@" + domain not in get_all_mail_addresses(env, no_catchalls=False):
 		check_alias_exists("Postmaster contact address",
 						"postmaster@" + domain, env, output)
 
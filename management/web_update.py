@@ -18,11 +18,13 @@ def get_web_domains(env,
 					exclude_dns_elsewhere=True):
 	# What domains should we serve HTTP(S) for?
 	domains = set()
+	mail_domains = get_mail_domains(env)
+	mail_user_domains = get_mail_domains(env, users_only=True)
 
 	# Serve web for all mail domains so that we might at least
 	# provide auto-discover of email settings, and also a static website
 	# if the user wants to make one.
-	domains |= get_mail_domains(env)
+	domains |= mail_domains
 
 	if include_www_redirects and include_auto:
 		# Add 'www.' subdomains that we want to provide default redirects
@@ -36,18 +38,18 @@ def get_web_domains(env,
 		# 'autodiscover.' for ActiveSync autodiscovery (Z-Push).
 		domains |= set(
 			'autoconfig.' + maildomain
-			for maildomain in get_mail_domains(env, users_only=True))
+			for maildomain in mail_user_domains)
 		domains |= set(
 			'autodiscover.' + maildomain
-			for maildomain in get_mail_domains(env, users_only=True))
+			for maildomain in mail_user_domains)
 
 		# 'mta-sts.' for MTA-STS support for all domains that have email addresses.
 		domains |= set('mta-sts.' + maildomain
-					for maildomain in get_mail_domains(env))
+					for maildomain in mail_domains)
 
 	# 'openpgpkey.' for WKD support
 	domains |= set('openpgpkey.' + maildomain
-				for maildomain in get_mail_domains(env))
+				for maildomain in mail_domains)
 
 	if exclude_dns_elsewhere:
 		# ...Unless the domain has an A/AAAA record that maps it to a different
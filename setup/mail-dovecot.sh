@@ -151,6 +151,25 @@ protocol imap {
 }
 EOF
 
+# Enable the doveadm HTTP API on localhost, so that the management daemon can
+# run doveadm commands (e.g. recalculating quotas) for many users at once
+# without starting a doveadm process for each. The API key is shared with the
+# management daemon through a file that only root can read.
+if [ ! -f /var/lib/mailinabox/doveadm-api.key ]; then
+	mkdir -p /var/lib/mailinabox
+	tr -cd '[:xdigit:]' < /dev/urandom | head -c 32 > /var/lib/mailinabox/doveadm-api.key
+	chmod 600 /var/lib/mailinabox/doveadm-api.key
+fi
+cat > /etc/dovecot/conf.d/99-local-doveadm.conf << EOF;
+doveadm_api_key = $(cat /var/lib/mailinabox/doveadm-api.key)
+service doveadm {
+  inet_listener http {
+    address = 127.0.0.1
+    port = 10030
+  }
+}
+EOF
+
 # Setting a `postmaster_address` is required or LMTP won't start. An alias
 # will be created automatically by our management daemon.
 management/editconf.py /etc/dovecot/conf.d/15-lda.conf \
@@ -25,6 +25,8 @@ if [ ! -f $db_path ]; then
     echo "CREATE TABLE noreply (id INTEGER PRIMARY KEY AUTOINCREMENT, email TEXT NOT NULL UNIQUE);" | sqlite3 $db_path
 	echo "CREATE TABLE mfa (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER NOT NULL, type TEXT NOT NULL, secret TEXT NOT NULL, mru_token TEXT, label TEXT, FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE);" | sqlite3 $db_path;
 	echo "CREATE TABLE auto_aliases (id INTEGER PRIMARY KEY AUTOINCREMENT, source TEXT NOT NULL UNIQUE, destination TEXT NOT NULL, permitted_senders TEXT);" | sqlite3 $db_path;
+	echo "CREATE INDEX users_domain ON users (substr(email, instr(email, '@') + 1), email);" | sqlite3 $db_path;
+	echo "CREATE INDEX aliases_domain ON aliases (substr(source, instr(source, '@') + 1), source);" | sqlite3 $db_path;
 else
     sql=$(sqlite3 $db_path "SELECT sql FROM sqlite_master WHERE name = 'users'");
     if echo $sql | grep --invert-match quota; then
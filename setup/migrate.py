@@ -196,6 +196,12 @@ def migration_15(env):
 	db = os.path.join(env["STORAGE_ROOT"], 'mail/users.sqlite')
 	shell("check_call", ["sqlite3", db, "CREATE TABLE auto_aliases (id INTEGER PRIMARY KEY AUTOINCREMENT, source TEXT NOT NULL UNIQUE, destination TEXT NOT NULL, permitted_senders TEXT);"])
 
+def migration_16(env):
+	# Index the users and aliases by domain, for listing them a page at a time.
+	db = os.path.join(env["STORAGE_ROOT"], 'mail/users.sqlite')
+	shell("check_call", ["sqlite3", db, "CREATE INDEX IF NOT EXISTS users_domain ON users (substr(email, instr(email, '@') + 1), email);"])
+	shell("check_call", ["sqlite3", db, "CREATE INDEX IF NOT EXISTS aliases_domain ON aliases (substr(source, instr(source, '@') + 1), source);"])
+
 ###########################################################
 
 def get_current_migration():
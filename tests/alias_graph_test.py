@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+# Tests how management/alias_graph.py resolves aliases against the lookup
+# tables setup/mail-users.sh configures Postfix with: the precedence of
+# aliases, users and automatic aliases, +tags, catch-alls and domain aliases,
+# who may send as an address, and forwarding that goes around in a loop.
+#
+# tests/alias_graph_test.py
+
+import sys, os
+
+from checks import check, done
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "management"))
+from alias_graph import AliasGraph
+
+users = ["alice@example.com", "bob@example.com", "carol@example.org"]
+
+# (address, forwards to, permitted senders, auto) as get_mail_aliases returns them.
+aliases = [
+	("info@example.com", "alice@example.com, bob@example.com", None, False),
+	("sales@example.com", "bob@example.com", "alice@example.com", False),
+	("outbound@example.com", "", "alice@example.com", False),
+	("team@example.com", "info@example.com,alice@example.com", None, False),
+	("bob+vip@example.com", "carol@example.org", None, False),
+	# An alias of a user's own address, which keeps a copy in the mailbox
+	("alice@example.com", "alice@example.com,archive@elsewhere.test", None, False),
+	# Automatic aliases lose to aliases and users
+	("postmaster@example.com", "alice@example.com", None, True),
+	("abuse@example.com", "alice@example.com", None, True),
+	("abuse@example.com", "bob@example.com", None, False),
+	("bob@example.com", "alice@example.com", None, True),
+	# A domain alias and a catch-all
+	("@example.net", "@example.com", None, False),
+	("@example.org", "carol@example.org", None, False),
+	# Loops
+	("loop1@example.com", "loop2@example.com", None, False),
+	("loop2@example.com", "loop1@example.com", None, False),
+	("loop3@example.com", "loop1@example.com,bob@example.com", None, False),
+]
+
+graph = AliasGraph(users, aliases)
+
+
+def resolve(address, key):
+	return graph.resolve(address)[key]
+
+
+# virtual-alias-maps.cf: aliases, then users, then automatic aliases
+check("forwards of an alias", resolve("info@example.com", "forwards_to"), ["alice@example.com", "bob@example.com"])
+check("forwards of an alias of a user", resolve("alice@example.com", "forwards_to"), ["alice@example.com", "archive@elsewhere.test"])
+check("receivers of an alias of a user", resolve("alice@example.com", "receivers"), ["alice@example.com", "archive@elsewhere.test"])
+check("forwards of a user with an automatic alias", resolve("bob@example.com", "forwards_to"), ["bob@example.com"])
+check("forwards of an automatic alias", resolve("postmaster@example.com", "forwards_to"), ["alice@example.com"])
+check("forwards of an alias with an automatic alias", resolve("abuse@example.com", "forwards_to"), ["bob@example.com"])
+check("forwards of an alias without forwards", resolve("outbound@example.com", "forwards_to"), [])
+check("receivers of an address elsewhere", resolve("someone@elsewhere.test", "receivers"), ["someone@elsewhere.test"])
+check("mailboxes of an alias of an alias", resolve("team@example.com", "mailboxes"), ["alice@example.com", "bob@example.com"])
+check("loops of an alias of an alias", resolve("team@example.com", "loops"), [])
+
+# +tags are stripped, unless the address with the tag matches itself
+check("forwards of a user with a tag", resolve("alice+news@example.com", "forwards_to"), ["alice@example.com", "archive@elsewhere.test"])
+check("mailboxes of an alias with a tag", resolve("info+list@example.com", "mailboxes"), ["alice@example.com", "bob@example.com"])
+check("forwards of an alias with a tag", resolve("bob+vip@example.com", "forwards_to"), ["carol@example.org"])
+check("forwards of another tag", resolve("bob+other@example.com", "forwards_to"), ["bob@example.com"])
+
+# Catch-alls and domain aliases, which keep the local part
+check("forwards of a user with a catch-all", resolve("carol@example.org", "forwards_to"), ["carol@example.org"])
+check("forwards of a catch-all", resolve("anyone@example.org", "forwards_to"), ["carol@example.org"])
+check("forwards of a domain alias", resolve("info@example.net", "forwards_to"), ["info@example.com"])
+check("mailboxes of a domain alias", resolve("info@example.net", "mailboxes"), ["alice@example.com", "bob@example.com"])
+check("mailboxes of a domain alias with a tag", resolve("bob+x@example.net", "mailboxes"), ["bob@example.com"])
+check("receivers of a domain alias without a match", resolve("nobody@example.net", "receivers"), ["nobody@example.com"])
+check("forwards of an address in no table", resolve("nobody@example.com", "forwards_to"), [])
+
+# sender-login-maps.cf: the permitted senders of an alias, or its forwards, then a user
+check("senders of a user", resolve("bob@example.com", "permitted_senders"), ["bob@example.com"])
+check("senders of an alias", resolve("info@example.com", "permitted_senders"), ["alice@example.com", "bob@example.com"])
+check("senders of an alias with permitted senders", resolve("sales@example.com", "permitted_senders"), ["alice@example.com"])
+check("senders of an alias without forwards", resolve("outbound@example.com", "permitted_senders"), ["alice@example.com"])
+check("senders of an automatic alias", resolve("postmaster@example.com", "permitted_senders"), [])
+check("senders of a user with a tag", resolve("bob+news@example.com", "permitted_senders"), ["bob@example.com"])
+check("senders of a catch-all", resolve("anyone@example.org", "permitted_senders"), ["carol@example.org"])
+
+# Loops are reported where they close, and don't stop the other forwards
+check("receivers of a loop", resolve("loop1@example.com", "receivers"), [])
+check("loops of a loop", resolve("loop1@example.com", "loops"), ["loop1@example.com"])
+check("mailboxes of an alias into a loop", resolve("loop3@example.com", "mailboxes"), ["bob@example.com"])
+check("loops of an alias into a loop", resolve("loop3@example.com", "loops"), ["loop1@example.com"])
+
+done()
@@ -0,0 +1,20 @@
+# The checks of the test scripts in this directory, e.g. tests/dns_zone_test.py.
+# A script checks values with check() as it goes and calls done() at the end,
+# which exits with an error if any of the checks failed.
+
+import sys
+
+failed = False
+
+
+def check(what, value, expected):
+	global failed
+	if value != expected:
+		print("%s is %r, but should be %r." % (what, value, expected))
+		failed = True
+
+
+def done():
+	if failed:
+		sys.exit(1)
+	print("All checks passed.")
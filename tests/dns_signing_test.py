@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+# Tests the DNSSEC signing of management/dns_update.py with a stand-in for
+# ldns-signzone, in a temporary STORAGE_ROOT and zones directory: that zones
+# are signed at the same time with patched keys only we can read, which are
+# kept until the keys change, and the DS records against RFC 4034 and RFC 4509.
+#
+# tests/dns_signing_test.py
+
+import sys, os, tempfile, time, hashlib
+
+from checks import check, done
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "management"))
+import dns_update
+
+# The example key of RFC 4034 section 5.4 and its DS records (SHA-1 there,
+# SHA-256 in RFC 4509 section 2.3), which are for dskey.example.com.
+DNSKEY = "256 3 5 AQOeiiR0GOMYkDshWoSKz9XzfwJr1AYtsmx3TGkJaNXVbfi/2pHm822aJ5iI9BMzNXxeYCmZDRD99WYwYqUSdjMmmAphXdvxegXd/M5+X7OrzKBaMbCVdFLUUh6DhweJBjEVv5f2wwjM9XzcnOf+EPbtG9DMBmADjFDc2w/rljwvFw=="
+DS = [
+	"dskey.example.com.\t3600\tIN\tDS\t60485 5 1 2bb183af5f22588179a53b0a98631fad1a292118\n",
+	"dskey.example.com.\t3600\tIN\tDS\t60485 5 2 d4b7d520e7bb5f0f67674a0cceb1e3e0614b93c4f9e99b8383f6a1e4469da50a\n",
+]
+
+# Takes a while, like signing a large zone would, and writes the permissions
+# of the keys it was given into the signed zone.
+LDNS_SIGNZONE = """#!/bin/sh
+zonefile=$4
+shift 4
+sleep 0.5
+cp "$zonefile" "$zonefile.signed"
+for key in "$@"; do stat -c %a "$key.private" >> "$zonefile.signed"; done
+"""
+
+with tempfile.TemporaryDirectory() as root:
+	storage_root = os.path.join(root, "storage")
+	dnssec_dir = os.path.join(storage_root, "dns", "dnssec")
+	os.makedirs(dnssec_dir)
+	with open(os.path.join(dnssec_dir, "RSASHA1.conf"), "w") as f:
+		f.write("KSK=K_domain_.+005+00001\nZSK=K_domain_.+005+00002\n")
+	for keyfn in ("K_domain_.+005+00001", "K_domain_.+005+00002"):
+		with open(os.path.join(dnssec_dir, keyfn + ".key"), "w") as f:
+			f.write("_domain_.\tIN\tDNSKEY\t" + DNSKEY + " ;{id = 60485 (zsk), size = 512b}\n")
+		with open(os.path.join(dnssec_dir, keyfn + ".private"), "w") as f:
+			f.write("Private-key-format: v1.2\nAlgorithm: 5 (RSASHA1)\n")
+
+	dns_update.NSD_ZONES_DIR = os.path.join(root, "zones")
+	os.mkdir(dns_update.NSD_ZONES_DIR)
+	dns_update.LDNS_SIGNZONE = os.path.join(root, "ldns-signzone")
+	with open(dns_update.LDNS_SIGNZONE, "w") as f:
+		f.write(LDNS_SIGNZONE)
+	os.chmod(dns_update.LDNS_SIGNZONE, 0o755)
+
+	domains = ["dskey.example.com"] + ["example%d.com" % i for i in range(7)]
+	zones = [(domain, domain + ".txt") for domain in domains]
+	for domain, zonefile in zones:
+		with open(os.path.join(dns_update.NSD_ZONES_DIR, zonefile), "w") as f:
+			f.write("$ORIGIN %s.\n" % domain)
+
+	env = {"STORAGE_ROOT": storage_root}
+	dns_update.SIGNING_WORKERS = 4
+	start = time.perf_counter()
+	times = dns_update.sign_zones(zones, env)
+	elapsed = time.perf_counter() - start
+
+	check("zones signed", [domain for domain, seconds in times], domains)
+	check("zones signed at the same time", elapsed < 0.5 * len(zones) / 2, True)
+	for domain, zonefile in zones:
+		with open(os.path.join(dns_update.NSD_ZONES_DIR, zonefile + ".signed")) as f:
+			check("signed zone of " + domain, f.read(), "$ORIGIN %s.\n600\n600\n" % domain)
+
+	# The keys are read once, and patched once for each domain.
+	keystore = dns_update.get_dnssec_keystore(env)
+	check("patched keys", sorted(os.listdir(keystore.patched_dir)), sorted(
+		"K%s.+005+0000%d%s" % (domain, i, ext) for domain in domains for i in (1, 2) for ext in (".key", ".private")))
+	check("patched keys directory mode", oct(os.stat(keystore.patched_dir).st_mode & 0o777), "0o700")
+	check("keystore read again", dns_update.get_dnssec_keystore(env) is keystore, True)
+
+	# The hash in the zone files is the same as before there was a keystore.
+	check("hash_dnssec_keys()", dns_update.hash_dnssec_keys("example0.com", env), hashlib.sha1(
+		("KSKK_domain_.+005+00001Private-key-format: v1.2\nAlgorithm: 5 (RSASHA1)\n"
+		"ZSKK_domain_.+005+00002Private-key-format: v1.2\nAlgorithm: 5 (RSASHA1)\n").encode()).hexdigest())
+
+	# A key that changes makes a new keystore, and the old patched keys go away.
+	patched_dir = keystore.patched_dir
+	with open(os.path.join(dnssec_dir, "RSASHA1.conf"), "a") as f:
+		f.write("DOMAINS=example0.com\n")
+	check("keys after a change", dns_update.find_dnssec_signing_keys("example1.com", env), [])
+	check("old patched keys removed", os.path.exists(patched_dir), False)
+	dns_update.close_dnssec_keystores()
+
+	with open(os.path.join(dns_update.NSD_ZONES_DIR, "dskey.example.com.txt.ds")) as f:
+		check("DS records", f.read().splitlines(True)[:2], DS)
+
+done()
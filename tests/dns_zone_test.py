@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+# Tests how management/dns_update.py decides whether a zone changed, from
+# the metadata kept next to the zone file, in a temporary STORAGE_ROOT (without
+# DNSSEC keys) and zones directory, and which zones changed domains are in.
+#
+# tests/dns_zone_test.py
+
+import sys, os, tempfile, datetime
+
+from checks import check, done
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "management"))
+import dns_update
+
+def sign(zonefile, expires):
+	# What sign_zone leaves behind.
+	open(zonefile + ".signed", "w").close()
+	metadata = dns_update.read_zone_metadata(zonefile)
+	metadata["signature_expires"] = expires.strftime("%Y%m%d%H%M%S")
+	dns_update.write_zone_metadata(zonefile, metadata)
+
+
+with tempfile.TemporaryDirectory() as root:
+	os.makedirs(os.path.join(root, "dns", "dnssec"))
+	env = {"STORAGE_ROOT": root, "PRIMARY_HOSTNAME": "box.example.com"}
+	zonefile = os.path.join(root, "example.com.txt")
+	later = datetime.datetime.now() + datetime.timedelta(days=30)
+	today = datetime.datetime.now().strftime("%Y%m%d")
+
+	records = [
+		(None, "A", "192.0.2.1", "", None),
+		("www", "A", "192.0.2.1", "", None),
+		(None, "TXT", 'v=spf1 mx -all', "", 300),
+	]
+	check("first write", dns_update.write_nsd_zone("example.com", zonefile, records, env, False), True)
+	check("serial", dns_update.read_zone_metadata(zonefile)["serial"], today + "00")
+	check("unsigned zone written again", dns_update.write_nsd_zone("example.com", zonefile, records, env, False), True)
+	sign(zonefile, later)
+
+	# The order the records come in doesn't matter.
+	check("same records", dns_update.write_nsd_zone("example.com", zonefile, list(reversed(records)), env, False), False)
+	check("forced", dns_update.write_nsd_zone("example.com", zonefile, records, env, True), True)
+	sign(zonefile, later)
+
+	# A change, record by record.
+	records[1] = ("www", "A", "192.0.2.2", "", None)
+	check("changed record", dns_update.write_nsd_zone("example.com", zonefile, records, env, False), True)
+	metadata = dns_update.read_zone_metadata(zonefile)
+	check("serial after changes", metadata["serial"], today + "03")
+	check("changes", (metadata["changes"]["added"], metadata["changes"]["removed"]),
+		([["www.example.com", "A", 86400, "192.0.2.2"]], [["www.example.com", "A", 86400, "192.0.2.1"]]))
+	with open(zonefile) as f:
+		zone = f.read()
+	check("zone file serial", (today + "03     ; serial number") in zone, True)
+	check("zone file TXT record", '\t300\tIN\tTXT\t"v=spf1 mx -all" \n' in zone, True)
+	sign(zonefile, later)
+
+	# Signatures that expire soon are renewed.
+	check("signatures valid", dns_update.write_nsd_zone("example.com", zonefile, records, env, False), False)
+	sign(zonefile, datetime.datetime.now() + datetime.timedelta(days=2))
+	check("signatures expiring", dns_update.write_nsd_zone("example.com", zonefile, records, env, False), True)
+	check("changes after renewing signatures", dns_update.read_zone_metadata(zonefile)["changes"]["added"], [])
+
+	# A zone file written before there was metadata keeps counting up its serial.
+	os.unlink(zonefile + ".meta")
+	with open(zonefile, "w") as f:
+		f.write("@ IN SOA ns1.box.example.com. hostmaster.box.example.com. (\n\t\t%s     ; serial number\n" % (today + "41"))
+	check("zone without metadata", dns_update.write_nsd_zone("example.com", zonefile, records, env, False), True)
+	check("serial without metadata", dns_update.read_zone_metadata(zonefile)["serial"], today + "42")
+
+# The zones that changed domains are in.
+zones = [("example.com", "example.com.txt"), ("sub.example.net", "sub.example.net.txt")]
+check("affected zones", dns_update.get_affected_zones(
+	["example.com", "www.example.com", "a.sub.example.net", "example.net", "example.org"], zones),
+	{"example.com", "sub.example.net"})
+
+done()
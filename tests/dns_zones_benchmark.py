@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+# Benchmarks building the DNS records of all zones (build_zone in
+# management/dns_update.py) for many domains with many custom records.
+#
+# tests/dns_zones_benchmark.py [number of domains] [number of custom records]
+#
+# Makes the given number of mail domains (1000 by default), each with a www
+# and an mta-sts subdomain, and spreads the custom records (10000 by default)
+# over them, in a temporary STORAGE_ROOT. Then reports how long working out
+# what the zones share (the ZoneIndex) takes, and building all of the zones
+# with it after that, as build_zones does.
+
+import sys, os, tempfile, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "management"))
+import dns_update
+
+DOMAINS = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+RECORDS = int(sys.argv[2]) if len(sys.argv) > 2 else 10000
+
+with tempfile.TemporaryDirectory() as storage_root:
+	os.makedirs(os.path.join(storage_root, "mail", "dkim"))
+	with open(os.path.join(storage_root, "mail", "dkim", "mail.txt"), "w") as f:
+		f.write('mail._domainkey\tIN\tTXT\t( "v=DKIM1; h=sha256; k=rsa; s=email; " "p=MIIBIjANBgkqhkiG9w0BAQEFAAOCAQ8AMIIBCgKCAQEA" )  ; ----- DKIM key mail for box.example.com\n')
+	env = {
+		"STORAGE_ROOT": storage_root,
+		"PRIMARY_HOSTNAME": "box.example.com",
+		"PUBLIC_IP": "192.0.2.1",
+		"PUBLIC_IPV6": "2001:db8::1",
+	}
+
+	# No certificates, so no MTA-STS records and no TLSA records to look up.
+	dns_update.build_tlsa_record = lambda env: None
+	dns_update.build_sshfp_records = lambda: []
+
+	domains = {env["PRIMARY_HOSTNAME"]: {"user": True, "mail": True, "web": True, "auto": False, "certificate-is-valid": False}}
+	zones = [env["PRIMARY_HOSTNAME"]]
+	for i in range(DOMAINS):
+		domain = "example%d.com" % i
+		zones.append(domain)
+		domains[domain] = {"user": True, "mail": True, "web": True, "auto": False}
+		for subdomain in ("www", "mta-sts"):
+			domains[subdomain + "." + domain] = {"user": False, "mail": False, "web": True, "auto": True}
+
+	custom_records = []
+	for i in range(RECORDS):
+		domain = "example%d.com" % (i % DOMAINS)
+		custom_records.append(("host%d.%s" % (i, domain), "A", "192.0.2.%d" % (i % 250 + 2), None))
+		if i % 10 == 0:
+			custom_records.append((domain, "TXT", "site-verification=%d" % i, None))
+
+	print("zones:            %d" % len(zones))
+	print("domains:          %d" % len(domains))
+	print("custom records:   %d" % len(custom_records))
+
+	start = time.perf_counter()
+	index = dns_update.ZoneIndex(domains, custom_records, env)
+	print("index:            %.2f s" % (time.perf_counter() - start))
+
+	start = time.perf_counter()
+	records = sum(len(dns_update.build_zone(zone, domains, custom_records, env, index=index)) for zone in zones)
+	elapsed = time.perf_counter() - start
+	print("records:          %d" % records)
+	print("zones built in:   %.2f s (%.2f ms per zone)" % (elapsed, elapsed / len(zones) * 1000))
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+# Tests management/dovecot_quota.py and mailconfig.set_mail_quotas against a
+# stand-in for the doveadm HTTP API on a local port, which counts the
+# connections and requests it gets.
+#
+# tests/dovecot_quota_test.py
+
+import sys, os, sqlite3, tempfile, threading, json, base64, logging, time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from checks import check, done
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "management"))
+import dovecot_quota
+import mailconfig
+
+API_KEY = "0123456789abcdef"
+connections = 0
+requests = []
+logged = []
+
+
+class Messages(logging.Handler):
+
+	def emit(self, record):
+		logged.append(record.getMessage())
+
+
+logging.getLogger("dovecot_quota").addHandler(Messages())
+
+
+class Doveadm(BaseHTTPRequestHandler):
+	protocol_version = "HTTP/1.1"
+
+	def setup(self):
+		global connections
+		connections += 1
+		super().setup()
+
+	def do_POST(self):
+		body = self.rfile.read(int(self.headers["Content-Length"]))
+		if self.headers["Authorization"] != "X-Dovecot-API " + base64.b64encode(API_KEY.encode()).decode():
+			self.send_response(401)
+			self.send_header("Content-Length", "0")
+			self.end_headers()
+			return
+		commands = json.loads(body)
+		requests.append(commands)
+		response = json.dumps([
+			["error", {"type": "exitCode", "exitCode": 67}, tag] if parameters["user"].startswith("nobody")
+			else ["doveadmResponse", [], tag]
+			for command, parameters, tag in commands
+		]).encode()
+		self.send_response(200)
+		self.send_header("Content-Type", "application/json")
+		self.send_header("Content-Length", str(len(response)))
+		self.end_headers()
+		self.wfile.write(response)
+
+	def log_message(self, *args):
+		pass
+
+
+server = ThreadingHTTPServer(("127.0.0.1", 0), Doveadm)
+threading.Thread(target=server.serve_forever, daemon=True).start()
+
+with tempfile.TemporaryDirectory() as storage_root:
+	dovecot_quota.API_URL = "http://127.0.0.1:%d/doveadm/v1" % server.server_port
+	dovecot_quota.API_KEY_FILE = os.path.join(storage_root, "doveadm-api.key")
+	with open(dovecot_quota.API_KEY_FILE, "w") as f:
+		f.write(API_KEY + "\n")
+
+	# Many users go in a few requests over one connection.
+	emails = ["user%d@example.com" % i for i in range(250)] + ["nobody@example.com"]
+	check("recalc() failures", dovecot_quota.recalc(emails), {"nobody@example.com": {"type": "exitCode", "exitCode": 67}})
+	check("number of requests", len(requests), 3)
+	check("users per request", [len(r) for r in requests], [100, 100, 51])
+	check("users recalculated", [parameters["user"] for r in requests for _, parameters, _ in r], emails)
+	check("number of connections", connections, 1)
+	check("logged failures", logged, ["Recalculating the quota of nobody@example.com failed with exit code 67"])
+
+	# The background thread logs what goes wrong, and carries on.
+	del logged[:]
+	recalc_users = dovecot_quota.recalc_users
+	dovecot_quota.recalc_users = lambda emails: 1 / 0
+	dovecot_quota.recalc_later(["user1@example.com"])
+	for i in range(100):
+		if logged:
+			break
+		time.sleep(0.05)
+	check("logged error of the background thread", logged, ["Recalculating the quotas of user1@example.com failed"])
+	dovecot_quota.recalc_users = recalc_users
+	del logged[:]
+	dovecot_quota.recalc_later(["nobody@example.com"])
+	for i in range(100):
+		if logged:
+			break
+		time.sleep(0.05)
+	check("logged failures of the background thread", logged, ["Recalculating the quota of nobody@example.com failed with exit code 67"])
+
+	# A connection that was closed by the server is opened again.
+	dovecot_quota.connection.sock.close()
+	check("recalc() after the connection closed", dovecot_quota.recalc(["user1@example.com"]), {})
+	check("number of connections after the connection closed", connections, 2)
+
+	# Setting quotas in bulk.
+	os.mkdir(os.path.join(storage_root, "mail"))
+	conn = sqlite3.connect(os.path.join(storage_root, "mail", "users.sqlite"))
+	conn.executescript("""
+		CREATE TABLE users (id INTEGER PRIMARY KEY AUTOINCREMENT, email TEXT NOT NULL UNIQUE, password TEXT NOT NULL, extra, privileges TEXT NOT NULL DEFAULT '', quota TEXT NOT NULL DEFAULT '0');
+		INSERT INTO users (email, password) VALUES ('user1@example.com', '');
+		INSERT INTO users (email, password) VALUES ('user2@example.com', '');
+	""")
+	conn.commit()
+	env = {"STORAGE_ROOT": storage_root}
+
+	del requests[:]
+	results = mailconfig.set_mail_quotas([
+		{"email": "user1@example.com", "quota": "10g"},
+		{"email": "user2@example.com", "quota": "1.5G"},
+		{"email": "other@example.com", "quota": "0"},
+		{"email": "user2@example.com", "quota": "500M"},
+	], env)
+	check("set_mail_quotas()", results, [
+		{"email": "user1@example.com", "result": "updated", "quota": "10G"},
+		{"email": "user2@example.com", "result": "error", "message": "Quotas cannot contain spaces, commas, or decimal points."},
+		{"email": "other@example.com", "result": "error", "message": "That's not a user (other@example.com)."},
+		{"email": "user2@example.com", "result": "updated", "quota": "500M"},
+	])
+	check("quotas", conn.execute("SELECT email, quota FROM users ORDER BY email").fetchall(),
+		[("user1@example.com", "10G"), ("user2@example.com", "500M")])
+	check("requests for set_mail_quotas()", [[parameters["user"] for _, parameters, _ in r] for r in requests],
+		[["user1@example.com", "user2@example.com"]])
+	conn.close()
+
+server.shutdown()
+
+done()
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+# Tests the address and domain lookups of management/mailconfig.py against a
+# users database like setup/mail-users.sh creates, in a temporary
+# STORAGE_ROOT, that threads share the snapshot of the users and aliases, and
+# that adding aliases in bulk doesn't save an address that is in more than one
+# row.
+#
+# tests/mail_addresses_test.py
+
+import sys, os, sqlite3, tempfile, threading
+
+from checks import check, done
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "management"))
+import mailconfig
+import database
+
+with tempfile.TemporaryDirectory() as storage_root:
+	os.mkdir(os.path.join(storage_root, "mail"))
+	conn = sqlite3.connect(os.path.join(storage_root, "mail", "users.sqlite"))
+	conn.executescript("""
+		CREATE TABLE users (id INTEGER PRIMARY KEY AUTOINCREMENT, email TEXT NOT NULL UNIQUE, password TEXT NOT NULL, extra, privileges TEXT NOT NULL DEFAULT '', quota TEXT NOT NULL DEFAULT '0');
+		CREATE TABLE aliases (id INTEGER PRIMARY KEY AUTOINCREMENT, source TEXT NOT NULL UNIQUE, destination TEXT NOT NULL, permitted_senders TEXT);
+		CREATE TABLE noreply (id INTEGER PRIMARY KEY AUTOINCREMENT, email TEXT NOT NULL UNIQUE);
+		CREATE TABLE mfa (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER NOT NULL, type TEXT NOT NULL, secret TEXT NOT NULL, mru_token TEXT, label TEXT, FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE);
+		CREATE TABLE auto_aliases (id INTEGER PRIMARY KEY AUTOINCREMENT, source TEXT NOT NULL UNIQUE, destination TEXT NOT NULL, permitted_senders TEXT);
+
+		INSERT INTO users (email, password, privileges) VALUES ('admin@example.com', '', 'admin');
+		INSERT INTO users (email, password) VALUES ('user@example.net', '');
+		INSERT INTO aliases (source, destination) VALUES ('sales@example.org', 'user@example.net');
+		INSERT INTO aliases (source, destination) VALUES ('@example.org', 'admin@example.com');
+		INSERT INTO aliases (source, destination) VALUES ('@example.info', '@example.com');
+		INSERT INTO auto_aliases (source, destination) VALUES ('postmaster@example.net', 'admin@example.com');
+		INSERT INTO auto_aliases (source, destination) VALUES ('@xn--bcher-kva.example', '@bücher.example');
+		INSERT INTO noreply (email) VALUES ('noreply@example.edu');
+	""")
+	conn.commit()
+
+	env = {"STORAGE_ROOT": storage_root, "PRIMARY_HOSTNAME": "box.example.com"}
+
+	# Catch-alls and domain aliases are only included when asked for.
+	addresses = {
+		"admin@example.com", "user@example.net", "sales@example.org",
+		"postmaster@example.net", "noreply@example.edu"
+	}
+	catchalls = {"@example.org", "@example.info", "@xn--bcher-kva.example"}
+	check("get_all_mail_addresses()", mailconfig.get_all_mail_addresses(env), addresses)
+	check("get_all_mail_addresses(no_catchalls=False)",
+		mailconfig.get_all_mail_addresses(env, no_catchalls=False), addresses | catchalls)
+
+	# Automatic aliases don't make a mail domain.
+	check("get_mail_domains()", mailconfig.get_mail_domains(env),
+		{"example.com", "example.net", "example.org", "example.info", "example.edu"})
+	check("get_mail_domains(users_only=True)", mailconfig.get_mail_domains(env, users_only=True),
+		{"example.com", "example.net"})
+	check("get_mail_domains(filter_aliases=...)",
+		mailconfig.get_mail_domains(env, filter_aliases=lambda alias: not alias.startswith("@")),
+		{"example.com", "example.net", "example.org", "example.edu"})
+
+	check("get_mail_users()", mailconfig.get_mail_users(env), ["admin@example.com", "user@example.net"])
+	check("get_admins()", mailconfig.get_admins(env), {"admin@example.com"})
+
+	# Pages of users and aliases, ordered by domain, with the filters done by SQLite.
+	check("get_mail_users_page(limit=1)", mailconfig.get_mail_users_page(env, limit=1),
+		([("admin@example.com", "admin", "0")], True))
+	check("get_mail_users_page(after=..., limit=1)", mailconfig.get_mail_users_page(env, after="admin@example.com", limit=1),
+		([("user@example.net", "", "0")], False))
+	check("get_mail_aliases_page(domain=...)", mailconfig.get_mail_aliases_page(env, domain="example.org"),
+		([("@example.org", "admin@example.com", None, 0), ("sales@example.org", "user@example.net", None, 0)], False))
+	check("get_mail_aliases_page(prefix=...)", mailconfig.get_mail_aliases_page(env, prefix="post"),
+		([("postmaster@example.net", "admin@example.com", None, 1)], False))
+
+	# Threads share the snapshot until the database changes, also when a thread makes the change.
+	def in_thread(f):
+		result = []
+		thread = threading.Thread(target=lambda: result.append(f()))
+		thread.start()
+		thread.join()
+		return result[0]
+
+	directory = mailconfig.get_directory(env)
+	check("get_directory() in another thread is the same snapshot", in_thread(lambda: mailconfig.get_directory(env)) is directory, True)
+	check("get_directory() again is the same snapshot", mailconfig.get_directory(env) is directory, True)
+
+	def add_alias():
+		with database.transaction(env) as c:
+			c.execute("INSERT INTO aliases (source, destination) VALUES ('info@example.com', 'admin@example.com')")
+		return mailconfig.get_directory(env)
+	changed = in_thread(add_alias)
+	check("get_directory() after a change in a thread is a new snapshot", changed is not directory, True)
+	check("get_directory() after a change in another thread is the same new snapshot", mailconfig.get_directory(env) is changed, True)
+	with database.transaction(env) as c:
+		c.execute("DELETE FROM aliases WHERE source='info@example.com'")
+
+	# The system isn't updated for aliases added in bulk here.
+	mailconfig.kick = lambda env, mail_result=None, domains=None: mail_result
+	for update_if_exists in (False, True):
+		results, output = mailconfig.add_mail_aliases([
+			{"address": "dup@example.com", "forwards_to": "admin@example.com"},
+			{"address": "new@example.com", "forwards_to": "admin@example.com"},
+			{"address": "DUP@example.com", "forwards_to": "user@example.net"},
+		], env, update_if_exists=update_if_exists)
+		check("add_mail_aliases(update_if_exists=%s) results" % update_if_exists,
+			[(result["address"], result["result"]) for result in results],
+			[("dup@example.com", "error"), ("new@example.com", "added" if not update_if_exists else "updated"),
+			("dup@example.com", "error")])
+		check("add_mail_aliases(update_if_exists=%s) saved" % update_if_exists,
+			[alias[0] for alias in mailconfig.get_mail_aliases_page(env, prefix="dup")[0] + mailconfig.get_mail_aliases_page(env, prefix="new")[0]],
+			["new@example.com"])
+	with database.transaction(env) as c:
+		c.execute("DELETE FROM aliases WHERE source='new@example.com'")
+
+	# A change is seen right away, also when made by another connection.
+	change_counter = database.change_counter(env)
+	conn.execute("INSERT INTO aliases (source, destination) VALUES ('@example.edu', 'admin@example.com')")
+	conn.commit()
+	conn.close()
+	check("database.change_counter() changed", database.change_counter(env) != change_counter, True)
+	check("get_all_mail_addresses() after a change", mailconfig.get_all_mail_addresses(env), addresses)
+	check("get_all_mail_addresses(no_catchalls=False) after a change",
+		mailconfig.get_all_mail_addresses(env, no_catchalls=False), addresses | catchalls | {"@example.edu"})
+
+done()
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+# Benchmarks management/mail_log.py against a synthetic mail log.
+#
+# tests/mail_log_benchmark.py [number of lines] [number of users]
+#
+# First the lines of each service type are parsed in memory, reporting the
+# lines/sec for each. Then a synthetic log is generated in a temporary
+# directory (half of it as a gzip-compressed rotated log, half as the
+# current log) and scanned, reporting the throughput in lines/sec, the
+# number of bytes the scan wrote to disk and how much the memory in use grew
+# while holding the collected data. Finally the log is scanned again in
+# parallel processes, reporting the throughput and the speedup the shards
+# allow with a CPU per process. tests/mail_log_parallel_test.py checks that
+# the parallel scan collects the same as the serial scan.
+
+import sys, os, gzip, tempfile, time, datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "management"))
+import mail_log
+
+LINES = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+USERS = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+
+TEMPLATES = (
+	"postfix/submission/smtpd[1234]: 3F2A1B{n:04X}: client=mail.example.org[192.0.2.{h}], sasl_method=PLAIN, sasl_username=user{u}@example.com",
+	"postfix/lmtp[1235]: 4B3C2D{n:04X}: to=<user{u}@example.com>, relay=127.0.0.1[127.0.0.1]:10025, delay=0.1, dsn=2.0.0, status=sent (250 2.0.0 <user{u}@example.com> Saved)",
+	"dovecot: imap-login: Info: Login: user=<user{u}@example.com>, method=PLAIN, rip=192.0.2.{h}, lip=192.0.2.1, mpid=1, TLS",
+	"postgrey[1236]: action=greylist, reason=new, client_name=mx{h}.example.net, client_address=192.0.2.{h}, sender=spam{n}@example.net, recipient=user{u}@example.com",
+	"postfix/smtpd[1237]: NOQUEUE: reject: RCPT from unknown[192.0.2.{h}]: 554 5.7.1 Service unavailable; from=<spam{n}@example.net> to=<user{u}@example.com> proto=ESMTP helo=<x>",
+	"postfix/qmgr[1238]: 5C4D3E{n:04X}: removed",
+)
+
+
+def write_log(f, start, count):
+	# Spread the lines evenly over the day before the scan ends.
+	step = datetime.timedelta(days=1) / LINES
+	for i in range(count):
+		date = start + step * i
+		f.write("{:%b %d %H:%M:%S} box ".format(date) + TEMPLATES[i % len(TEMPLATES)].format(n=i & 0xffff, u=i % USERS, h=i % 250) + "\n")
+
+
+def disk_writes():
+	# Bytes this process caused to be written to storage (Linux only).
+	try:
+		with open("/proc/self/io") as f:
+			for line in f:
+				if line.startswith("write_bytes:"):
+					return int(line.split()[1])
+	except OSError:
+		pass
+	return None
+
+
+def memory_in_use():
+	# Resident set size of this process in bytes (Linux only).
+	try:
+		with open("/proc/self/status") as f:
+			for line in f:
+				if line.startswith("VmRSS:"):
+					return int(line.split()[1]) * 1024
+	except OSError:
+		pass
+	return None
+
+
+end = datetime.datetime.now().replace(microsecond=0)
+start = end - datetime.timedelta(days=1)
+mail_log.START_DATE = start - datetime.timedelta(seconds=1)
+mail_log.END_DATE = mail_log.NOW = end + datetime.timedelta(seconds=1)
+mail_log.SCAN_GREY = mail_log.SCAN_BLOCKED = True
+
+for template in TEMPLATES:
+	lines = []
+	step = datetime.timedelta(days=1) / LINES
+	for i in range(min(LINES, 200000)):
+		lines.append("{:%b %d %H:%M:%S} box ".format(start + step * i) + template.format(n=i & 0xffff, u=i % USERS, h=i % 250))
+	collector = mail_log.new_collector()
+	t = time.perf_counter()
+	for line in lines:
+		mail_log.scan_mail_log_line(line, collector)
+	t = time.perf_counter() - t
+	print("%-26s %10.0f lines/sec" % (template.split("[")[0].split(":")[0], len(lines) / t))
+print()
+
+with tempfile.TemporaryDirectory() as d:
+	rotated, current = os.path.join(d, "mail.log.1.gz"), os.path.join(d, "mail.log")
+	with gzip.open(rotated, "wt") as f:
+		write_log(f, start, LINES // 2)
+	with open(current, "w") as f:
+		write_log(f, start + datetime.timedelta(days=1) * (LINES // 2) / LINES, LINES - LINES // 2)
+
+	mail_log.LOG_FILES = (rotated, current)
+
+	collector = mail_log.new_collector()
+
+	os.sync()
+	written = disk_writes()
+	memory = memory_in_use()
+	t = time.perf_counter()
+	mail_log.scan_files(collector)
+	t = t_serial = time.perf_counter() - t
+	os.sync()
+	if memory is not None:
+		memory = memory_in_use() - memory
+
+	print("lines scanned:  %d" % collector["scan_count"])
+	print("lines parsed:   %d" % collector["parse_count"])
+	print("time:           %.2f s" % t)
+	print("throughput:     %.0f lines/sec" % (collector["scan_count"] / t))
+	if written is not None:
+		print("written to disk: %d bytes" % (disk_writes() - written))
+	if memory is not None:
+		print("memory growth:  %.1f MB for %d users" % (memory / 1e6, USERS))
+
+	# The shards are also scanned one after the other, which shows the time the parallel scan takes
+	# with a CPU per job: that of the longest shard, or that of the jobs' share of all of them.
+	mail_log.JOBS = max(4, len(os.sched_getaffinity(0)))
+	sharded = mail_log.new_collector()
+	t = time.perf_counter()
+	mail_log.scan_files_parallel(sharded)
+	t = time.perf_counter() - t
+	times = []
+	for fn in mail_log.LOG_FILES:
+		for shard_start, shard_end in mail_log.split_file(fn, mail_log.JOBS):
+			t_shard = time.perf_counter()
+			mail_log.scan_shard((fn, shard_start, shard_end), sharded["settings"])
+			times.append(time.perf_counter() - t_shard)
+	t_cpus = max(max(times), sum(times) / mail_log.JOBS)
+	print()
+	print("parallel jobs:  %d on %d CPUs" % (mail_log.JOBS, len(os.sched_getaffinity(0))))
+	print("time:           %.2f s" % t)
+	print("throughput:     %.0f lines/sec" % (sharded["scan_count"] / t))
+	print("shards:         %d, longest %.2f s" % (len(times), max(times)))
+	print("with a CPU per job: %.2f s, %.1fx the serial scan" % (t_cpus, t_serial / t_cpus))
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+# Tests the persistent index of management/mail_log.py against synthetic mail
+# logs in a temporary directory and STORAGE_ROOT: that each run of
+# update_index only reads the lines appended since the last run, across a
+# line that is still being written, logrotate renaming mail.log and
+# compressing the rotated log, that the hourly buckets are local clock hours
+# in a time zone with a half hour offset, that the index doesn't depend on
+# the settings of the command line (like -n, which scans backwards), that
+# updates running at the same time don't index a line twice, and how repeated
+# blocked emails are read back.
+#
+# tests/mail_log_index_test.py
+
+import sys, os, gzip, shutil, sqlite3, tempfile, threading, time, datetime
+
+# Set the time zone before mail_log takes the current time.
+os.environ["TZ"] = "Asia/Kolkata"
+time.tzset()
+
+from checks import check, done
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "management"))
+import mail_log
+
+USER = "user@example.com"
+
+# Lines every seven minutes over the day before the index runs, so that they fall on both halves
+# of the clock hours.
+next_date = mail_log.NOW.replace(microsecond=0) - datetime.timedelta(days=1)
+hours_of_day = [0] * 24
+
+
+def line():
+	global next_date
+	date, next_date = next_date, next_date + datetime.timedelta(minutes=7)
+	hours_of_day[date.hour] += 1
+	return ("{:%b %d %H:%M:%S} box postfix/lmtp[1235]: 4B3C2D{:04X}: to=<{}>, relay=127.0.0.1[127.0.0.1]:10025, "
+		"delay=0.1, dsn=2.0.0, status=sent (250 2.0.0 <{}> Saved)\n".format(date, sum(hours_of_day), USER, USER))
+
+
+def append(fn, count):
+	with open(fn, "a") as f:
+		for i in range(count):
+			f.write(line())
+
+
+# The command line asks for the newest lines first, and to keep only the two most recent
+# greylisted emails.
+mail_log.NEWEST_FIRST = True
+mail_log.KEEP = 2
+
+with tempfile.TemporaryDirectory() as root:
+	env = {"STORAGE_ROOT": os.path.join(root, "storage")}
+	os.makedirs(os.path.join(env["STORAGE_ROOT"], "mail"))
+	log_dir = os.path.join(root, "log")
+	os.makedirs(log_dir)
+	compressed, rotated, current = (os.path.join(log_dir, fn) for fn in ("mail.log.2.gz", "mail.log.1", "mail.log"))
+	mail_log.LOG_FILES = (compressed, rotated, current)
+
+	def received():
+		with sqlite3.connect(os.path.join(env["STORAGE_ROOT"], "mail/mail_log.sqlite")) as conn:
+			return conn.execute("SELECT sum(count) FROM buckets WHERE kind='received'").fetchone()[0]
+
+	append(current, 100)
+	check("lines indexed at first", mail_log.update_index(env), 100)
+	check("emails received after the first run", received(), 100)
+
+	# The index reads on from where it stopped, and leaves a line that is still being written for
+	# the next run.
+	append(current, 50)
+	partial = line()
+	with open(current, "a") as f:
+		f.write(partial[:40])
+	check("lines indexed after appending", mail_log.update_index(env), 50)
+	check("emails received after appending", received(), 150)
+	with open(current, "a") as f:
+		f.write(partial[40:])
+	check("lines indexed after finishing a line", mail_log.update_index(env), 1)
+	check("emails received after finishing a line", received(), 151)
+
+	# logrotate renames mail.log, which keeps its inode.
+	os.rename(current, rotated)
+	append(current, 20)
+	check("lines indexed after a rotation", mail_log.update_index(env), 20)
+	check("emails received after a rotation", received(), 171)
+
+	# The next rotation compresses mail.log.1 to a new file, which starts with the same line. The
+	# syslog daemon wrote to mail.log right before it was renamed.
+	append(current, 5)
+	with open(rotated, "rb") as f_in, gzip.open(compressed, "wb") as f_out:
+		shutil.copyfileobj(f_in, f_out)
+	os.remove(rotated)
+	os.rename(current, rotated)
+	append(current, 10)
+	check("lines indexed after compressing a log", mail_log.update_index(env), 15)
+	check("emails received after compressing a log", received(), 186)
+	check("lines indexed when nothing changed", mail_log.update_index(env), 0)
+
+	# The index reads the lines oldest first however the command line scans them, so the most
+	# recent greylisted emails of the hour are kept.
+	with open(current, "a") as f:
+		for sender in ("first", "second", "third"):
+			f.write("{:%b %d %H:%M:%S} box postgrey[1236]: action=greylist, reason=new, client_name=mx.example.net, "
+				"client_address=192.0.2.1, sender={}@example.net, recipient={}\n".format(next_date, sender, USER))
+	check("lines indexed after greylisting", mail_log.update_index(env), 3)
+	check("NEWEST_FIRST after indexing", mail_log.NEWEST_FIRST, True)
+
+	with sqlite3.connect(os.path.join(env["STORAGE_ROOT"], "mail/mail_log.sqlite")) as conn:
+		check("greylisted emails", sorted(row[0] for row in conn.execute("SELECT key FROM buckets WHERE kind='greylist'")),
+			["mx.example.net\tsecond@example.net", "mx.example.net\tthird@example.net"])
+		check("indexed files", set(row[0] for row in conn.execute("SELECT inode FROM files")),
+			set(os.stat(fn).st_ino for fn in mail_log.LOG_FILES))
+		for hour, earliest, latest in conn.execute("SELECT hour, earliest, latest FROM buckets WHERE kind='received'"):
+			start = datetime.datetime.fromtimestamp(hour)
+			check("start of the bucket of %s" % start, (start.minute, start.second), (0, 0))
+			check("bucket of %s holds its times" % start, hour <= earliest <= latest < hour + 3600, True)
+
+	# Reading the index back gives the hours of the day the lines were logged at.
+	mail_log.START_DATE = mail_log.NOW - mail_log.TIME_DELTAS["all"]
+	collector = mail_log.new_collector()
+	mail_log.load_index(env, collector)
+	check("emails received by hour of day", list(collector["received_mail"][USER].by_hour), hours_of_day)
+
+	# The same sender blocked three times in an hour is counted three times, but listed once.
+	mail_log.SCAN_BLOCKED = True
+	with open(current, "a") as f:
+		for i in range(3):
+			f.write("{:%b %d %H:%M:%S} box postfix/smtpd[1237]: NOQUEUE: reject: RCPT from unknown[192.0.2.2]: "
+				"554 5.7.1 Service unavailable; from=<spam@example.net> to=<{}> proto=ESMTP helo=<x>\n".format(next_date, USER))
+	check("lines indexed after blocking", mail_log.update_index(env), 3)
+	collector = mail_log.new_collector()
+	mail_log.load_index(env, collector)
+	check("emails blocked", collector["rejected"][USER]["count"], 3)
+	check("blocked emails listed", [sender for date, sender, message in collector["rejected"][USER]["blocked"]],
+		["spam@example.net"])
+
+# Two updates at the same time, e.g. the management daemon's and mail_log.py -i, index each line once.
+with tempfile.TemporaryDirectory() as root:
+	env = {"STORAGE_ROOT": os.path.join(root, "storage")}
+	os.makedirs(os.path.join(env["STORAGE_ROOT"], "mail"))
+	current = os.path.join(root, "mail.log")
+	mail_log.LOG_FILES = (current,)
+	next_date = mail_log.NOW.replace(microsecond=0) - datetime.timedelta(days=1)
+	append(current, 200)
+
+	counts = []
+	threads = [threading.Thread(target=lambda: counts.append(mail_log.update_index(env))) for i in range(2)]
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+	check("lines indexed by concurrent updates", sorted(counts), [0, 200])
+	with sqlite3.connect(os.path.join(env["STORAGE_ROOT"], "mail/mail_log.sqlite")) as conn:
+		check("emails received after concurrent updates",
+			conn.execute("SELECT sum(count) FROM buckets WHERE kind='received'").fetchone()[0], 200)
+
+done()
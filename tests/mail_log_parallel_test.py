@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+# Tests that scanning the mail logs in parallel processes (mail_log.py -j)
+# collects the same as the serial scan, against a synthetic log in a
+# temporary directory that is split into many small shards: a compressed
+# rotated log and the current log, over the whole log and up to an end date
+# in the middle of either file.
+#
+# tests/mail_log_parallel_test.py
+
+import sys, os, gzip, tempfile, datetime
+
+from checks import check, done
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "management"))
+import mail_log
+
+LINES = 6000
+USERS = 20
+
+TEMPLATES = (
+	"postfix/submission/smtpd[1234]: 3F2A1B{n:04X}: client=mail.example.org[192.0.2.{h}], sasl_method=PLAIN, sasl_username=user{u}@example.com",
+	"postfix/lmtp[1235]: 4B3C2D{n:04X}: to=<user{u}@example.com>, relay=127.0.0.1[127.0.0.1]:10025, delay=0.1, dsn=2.0.0, status=sent (250 2.0.0 <user{u}@example.com> Saved)",
+	"dovecot: imap-login: Info: Login: user=<user{u}@example.com>, method=PLAIN, rip=192.0.2.{h}, lip=192.0.2.1, mpid=1, TLS",
+	"postgrey[1236]: action=greylist, reason=new, client_name=mx{h}.example.net, client_address=192.0.2.{h}, sender=spam{n}@example.net, recipient=user{u}@example.com",
+	"postfix/smtpd[1237]: NOQUEUE: reject: RCPT from unknown[192.0.2.{h}]: 554 5.7.1 Service unavailable; from=<spam{n}@example.net> to=<user{u}@example.com> proto=ESMTP helo=<x>",
+	"postfix/qmgr[1238]: 5C4D3E{n:04X}: removed",
+)
+
+end = datetime.datetime.now().replace(microsecond=0)
+start = end - datetime.timedelta(days=1)
+step = datetime.timedelta(days=1) / LINES
+
+
+def write_log(f, first, count):
+	for i in range(first, first + count):
+		f.write("{:%b %d %H:%M:%S} box ".format(start + step * i) + TEMPLATES[i % len(TEMPLATES)].format(n=i, u=i % USERS, h=i % 250) + "\n")
+
+
+def compare(what):
+	serial = mail_log.new_collector()
+	mail_log.scan_files(serial)
+	parallel = mail_log.new_collector()
+	mail_log.scan_files_parallel(parallel)
+
+	# The top blocked senders and greylisted hosts are partly approximate, and merging the shards'
+	# counts approximates them differently. The sketches they are estimated from add up exactly.
+	for key in ("blocked_senders", "greylisted_hosts"):
+		check("%s of the parallel scan %s" % (key, what), parallel[key].sketch == serial[key].sketch, True)
+		del serial[key], parallel[key]
+	del serial["scan_time"], parallel["scan_time"]
+	check("lines scanned in parallel %s" % what, parallel["scan_count"], serial["scan_count"])
+	check("parallel scan %s" % what, parallel == serial, True)
+	return serial
+
+
+mail_log.SCAN_GREY = mail_log.SCAN_BLOCKED = True
+mail_log.START_DATE = start - datetime.timedelta(seconds=1)
+mail_log.NOW = end + datetime.timedelta(seconds=1)
+mail_log.JOBS = 3
+mail_log.MIN_SHARD_SIZE = 16 << 10
+
+with tempfile.TemporaryDirectory() as d:
+	rotated, current = os.path.join(d, "mail.log.1.gz"), os.path.join(d, "mail.log")
+	with gzip.open(rotated, "wt") as f:
+		write_log(f, 0, LINES // 2)
+	with open(current, "w") as f:
+		write_log(f, LINES // 2, LINES - LINES // 2)
+	mail_log.LOG_FILES = (rotated, current)
+
+	check("shards of the compressed log", len(mail_log.split_file(rotated, 8)), 8)
+	check("shards of the current log", len(mail_log.split_file(current, 8)), 8)
+
+	mail_log.END_DATE = mail_log.NOW
+	check("lines scanned of the whole log", compare("of the whole log")["scan_count"], LINES)
+
+	# Both scans stop two lines past the end date.
+	for what, line in (("up to the compressed log", LINES // 4), ("up to the current log", LINES * 3 // 4)):
+		mail_log.END_DATE = start + step * line + step / 2
+		check("lines scanned %s" % what, compare(what)["scan_count"], line + 3)
+
+done()
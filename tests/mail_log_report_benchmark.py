@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+# Benchmarks the reports of management/mail_log.py for many users.
+#
+# tests/mail_log_report_benchmark.py [number of users]
+#
+# Fills a collector with synthetic sent, received and login data for the
+# given number of users (50000 by default) without scanning any log, then
+# reports the time it takes to aggregate and print the report tables (to
+# /dev/null) and to build the JSON report.
+
+import sys, os, time, datetime, contextlib, random
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "management"))
+import mail_log
+
+USERS = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+PROTOCOLS = ("imap", "pop3", "smtp", "sieve")
+
+random.seed(0)
+end = datetime.datetime.now().replace(microsecond=0)
+start = end - datetime.timedelta(days=1)
+mail_log.START_DATE, mail_log.END_DATE = start, end
+mail_log.VERBOSE = False
+
+collector = mail_log.new_collector()
+collector["scan_count"] = collector["parse_count"] = USERS * 30
+collector["scan_time"] = 0
+
+for u in range(USERS):
+	user = "user%d@example%d.com" % (u, u % 100)
+	for kind, record in (("sent_mail", mail_log.SentMail), ("received_mail", mail_log.Activity)):
+		data = collector[kind][user] = record()
+		for _ in range(10):
+			date = start + datetime.timedelta(seconds=random.randrange(86400))
+			data.add(int(date.timestamp()), date.hour)
+		if kind == "sent_mail":
+			data.hosts.add("192.0.2.%d" % (u % 250))
+	logins = collector["logins"][user] = mail_log.Logins()
+	for i in range(10):
+		date = start + datetime.timedelta(seconds=random.randrange(86400))
+		logins.add(PROTOCOLS[(u + i) % len(PROTOCOLS)], "192.0.2.%d" % (i % 3), int(date.timestamp()), date.hour)
+
+report = mail_log.Report(collector)
+
+with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+	t = time.perf_counter()
+	report.print_tables()
+	t = time.perf_counter() - t
+print("users:          %d" % USERS)
+print("tables:         %.2f s" % t)
+
+t = time.perf_counter()
+report.as_dict()
+t = time.perf_counter() - t
+print("JSON report:    %.2f s" % t)
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+# Benchmarks the users database queries behind the /mail/users API.
+#
+# tests/mail_users_benchmark.py [number of users] [seconds]
+#
+# Creates a users database like setup/mail-users.sh does in a temporary
+# STORAGE_ROOT, with the given number of users (10000 by default) and as many
+# aliases and mailboxes, then reports how long the data of
+# /mail/users?format=json (get_mail_users_ex) takes to read the first time
+# and how many times per second it, a page of 50 users of it
+# (/mail/users?format=json&limit=50) and the mail domains that every kick
+# looks up (get_mail_domains) can be read after that.
+
+import sys, os, sqlite3, tempfile, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "management"))
+import mailconfig
+
+USERS = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+SECONDS = float(sys.argv[2]) if len(sys.argv) > 2 else 5
+
+
+def requests_per_second(f):
+	count = 0
+	start = time.perf_counter()
+	while time.perf_counter() - start < SECONDS:
+		f()
+		count += 1
+	return count / (time.perf_counter() - start)
+
+
+with tempfile.TemporaryDirectory() as storage_root:
+	os.mkdir(os.path.join(storage_root, "mail"))
+	conn = sqlite3.connect(os.path.join(storage_root, "mail", "users.sqlite"))
+	conn.executescript("""
+		CREATE TABLE users (id INTEGER PRIMARY KEY AUTOINCREMENT, email TEXT NOT NULL UNIQUE, password TEXT NOT NULL, extra, privileges TEXT NOT NULL DEFAULT '', quota TEXT NOT NULL DEFAULT '0');
+		CREATE TABLE aliases (id INTEGER PRIMARY KEY AUTOINCREMENT, source TEXT NOT NULL UNIQUE, destination TEXT NOT NULL, permitted_senders TEXT);
+		CREATE TABLE noreply (id INTEGER PRIMARY KEY AUTOINCREMENT, email TEXT NOT NULL UNIQUE);
+		CREATE TABLE mfa (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER NOT NULL, type TEXT NOT NULL, secret TEXT NOT NULL, mru_token TEXT, label TEXT, FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE);
+		CREATE TABLE auto_aliases (id INTEGER PRIMARY KEY AUTOINCREMENT, source TEXT NOT NULL UNIQUE, destination TEXT NOT NULL, permitted_senders TEXT);
+		CREATE INDEX users_domain ON users (substr(email, instr(email, '@') + 1), email);
+		CREATE INDEX aliases_domain ON aliases (substr(source, instr(source, '@') + 1), source);
+	""")
+	for i in range(USERS):
+		conn.execute("INSERT INTO users (email, password) VALUES (?, ?)",
+			("user%d@example%d.com" % (i, i % 10), "{SHA512-CRYPT}x"))
+		conn.execute("INSERT INTO aliases (source, destination) VALUES (?, ?)",
+			("alias%d@example%d.com" % (i, i % 10), "user%d@example%d.com" % (i, i % 10)))
+	conn.commit()
+	conn.close()
+
+	for i in range(USERS):
+		mailbox = os.path.join(storage_root, "mail", "mailboxes", "example%d.com" % (i % 10), "user%d" % i)
+		os.makedirs(mailbox)
+		with open(os.path.join(mailbox, "maildirsize"), "w") as f:
+			f.write("0S\n%d %d\n" % (i * 1000, i))
+
+	env = {"STORAGE_ROOT": storage_root, "PRIMARY_HOSTNAME": "box.example.com"}
+
+	print("users:            %d" % USERS)
+	t = time.perf_counter()
+	mailconfig.get_mail_users_ex(env, with_archived=True)
+	print("first /mail/users: %.3f s" % (time.perf_counter() - t))
+	print("/mail/users:      %.0f requests/sec" %
+		requests_per_second(lambda: mailconfig.get_mail_users_ex(env, with_archived=True)))
+	print("/mail/users page: %.0f requests/sec" %
+		requests_per_second(lambda: mailconfig.get_mail_users_by_domain(
+			mailconfig.get_mail_users_page(env, after="user5000@example0.com", limit=50, with_archived=True)[0], env)))
+	print("get_mail_domains: %.0f calls/sec" %
+		requests_per_second(lambda: mailconfig.get_mail_domains(env)))
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+# Checks management/passwords.py against known password hashes, then
+# benchmarks it.
+#
+# tests/passwords_benchmark.py [seconds]
+#
+# The SHA512-CRYPT hashes are the test vectors of the SHA-crypt
+# specification, which doveadm produces as well since it hashes with the
+# system's crypt(3). Each is checked with both the built-in implementation
+# and, if Python has it, the crypt module, and hashing in bulk in processes of
+# their own is checked too. Then the number of logins per second
+# check_password can verify is reported, how many passwords hash_passwords
+# hashes per second, and if doveadm is installed, how many `doveadm pw -t`
+# (as used before) can verify.
+
+import sys, os, time, subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "management"))
+import passwords
+
+SECONDS = float(sys.argv[1]) if len(sys.argv) > 1 else 5
+
+SHA512_CRYPT = (
+	("Hello world!", "{SHA512-CRYPT}$6$saltstring$svn8UoSVapNtMuq1ukKS4tPQd8iKwSMHWjl/O817G3uBnIFNjnQJuesI68u4OTLiBFdcbYEdFCoEOfaS35inz1"),
+	("Hello world!", "{SHA512-CRYPT}$6$rounds=10000$saltstringsaltst$OW1/O6BYHV6BcXZu8QVeXbDWra3Oeqh0sbHbbMCVNSnCM/UrjmM0Dp8vOuZeHBy/YTBmSK6H9qs/y3RnOaw5v."),
+	("This is just a test", "{SHA512-CRYPT}$6$rounds=5000$toolongsaltstrin$lQ8jolhgVRVhY4b5pZKaysCLi0QBxGoNeKQzQ3glMhwllF7oGDZxUhx1yxdYcz/e1JSbq3y6JMxxl8audkUEm0"),
+	("a very much longer text to encrypt.  This one even stretches over morethan one line.", "{SHA512-CRYPT}$6$rounds=1400$anotherlongsalts$POfYwTEok97VWcjxIiSOjiykti.o/pQs.wPvMxQ6Fm7I6IoYN3CmLs66x9t0oSwbtEW7o7UmJEiDwGqd8p4ur1"),
+	("we have a short salt string but not a short password", "{SHA512-CRYPT}$6$rounds=77777$short$WuQyW2YR.hBNpjjRhpYD/ifIw05xdfeEyQoMxIXbkvr0gge1a1x3yRULJ5CCaUeOxFmtlcGZelFl5CxtgfiAc0"),
+	("a short string", "{SHA512-CRYPT}$6$rounds=123456$asaltof16chars..$BtCwjqMJGx5hrJhZywWvt0RLE8uZ4oPwcelCjmw2kSYu.Ec6ycULevoBK25fs2xXgMNrCzIMVcgEJAstJeonj1"),
+	("the minimum number is still observed", "{SHA512-CRYPT}$6$rounds=1000$roundstoolow$kUMsbe306n21p9R.FRkW3IGn.S9NPN0x50YhH1xhLsPuWGsUSklZt58jaTfF4ZEQpyUNGc0dqbpBYYBaHHrsX."),
+)
+
+# Checked with crypt(3), if Python has the crypt module.
+OTHER_CRYPT = (
+	("U*U", "{BLF-CRYPT}$2a$05$CCCCCCCCCCCCCCCCCCCCC.E5YPO9kmyuRGyh0XouQYb4YMJKvyOeW"),
+)
+
+
+def per_second(f):
+	count = 0
+	start = time.perf_counter()
+	while time.perf_counter() - start < SECONDS:
+		f()
+		count += 1
+	return count / (time.perf_counter() - start)
+
+
+failed = False
+for pw, pw_hash in SHA512_CRYPT:
+	setting = pw_hash[len("{SHA512-CRYPT}"):]
+	if passwords.sha512_crypt(pw, setting) != setting:
+		print("sha512_crypt does not match: %s" % pw_hash)
+		failed = True
+	if not passwords.check_password(pw, pw_hash) or passwords.check_password(pw + "x", pw_hash):
+		print("check_password fails for: %s" % pw_hash)
+		failed = True
+for pw, pw_hash in OTHER_CRYPT:
+	if passwords.crypt is not None and (not passwords.check_password(pw, pw_hash) or passwords.check_password(pw + "x", pw_hash)):
+		print("check_password fails for: %s" % pw_hash)
+		failed = True
+
+pw_hash = passwords.hash_password("s3curE_pa5Sw0rD")
+if not pw_hash.startswith("{SHA512-CRYPT}$6$") or not passwords.check_password("s3curE_pa5Sw0rD", pw_hash):
+	print("hash_password made a hash check_password doesn't accept: %s" % pw_hash)
+	failed = True
+
+# Bulk hashing in processes of their own, even on a single CPU.
+pool_size = passwords.POOL_SIZE
+passwords.POOL_SIZE = max(2, pool_size)
+bulk = ["pw%d" % i for i in range(2 * passwords.POOL_MIN_PASSWORDS + 1)]
+if not all(passwords.check_password(pw, pw_hash) for pw, pw_hash in zip(bulk, passwords.hash_passwords(bulk))):
+	print("hash_passwords made hashes check_password doesn't accept")
+	failed = True
+passwords.POOL_SIZE = pool_size
+
+if failed:
+	sys.exit(1)
+print("All known hashes match.")
+print()
+
+print("check_password:    %.0f logins/sec" % per_second(lambda: passwords.check_password("s3curE_pa5Sw0rD", pw_hash)))
+setting = pw_hash[len("{SHA512-CRYPT}"):]
+print("sha512_crypt:      %.0f logins/sec" % per_second(lambda: passwords.sha512_crypt("s3curE_pa5Sw0rD", setting)))
+bulk = ["pw%d" % i for i in range(1000)]
+print("hash_passwords:    %.0f passwords/sec in %d processes" % (
+	per_second(lambda: passwords.hash_passwords(bulk)) * len(bulk), passwords.POOL_SIZE))
+if os.path.exists("/usr/bin/doveadm"):
+	print("doveadm pw -t:     %.0f logins/sec" % per_second(lambda: subprocess.check_call(
+		["/usr/bin/doveadm", "pw", "-p", "s3curE_pa5Sw0rD", "-t", pw_hash], stdout=subprocess.DEVNULL)))